@@ -44,6 +44,8 @@
 #     api request method below. if a request is not successful (typically due to violating the limts), sleep(30) and try again. 
 #     this seemed highly stable and you can see in the Strava user login SETTINGS | it has API status monitor where the requests 
 #     grow to 600..610 and stop, then t each :00 :15 :30 :45 minute threshold the limit resets & events start showing up again on the activity view
+#     (the sleep(30) polling has since been replaced by StravaRateScheduler which reads strava's X-RateLimit headers
+#     and sleeps straight to the next :00 :15 :30 :45 threshold)
 #  
 #  **Windows standard output  print() limitations for non-ASCII characters. you'll see in my mgtextout() how I dealt with this. 
 #     anyhow, trying to print() a string with UTF-8 or other emoji encoding will cause an exception... I didn't fully 
@@ -61,9 +63,47 @@
 #                 release as v1.0 in git
 #
 import requests as r
+from requests.adapters import HTTPAdapter
 import time 
 import sys
+import os
+import json
+import calendar
+import sqlite3
+import zlib
+import csv
+import io
+import gzip
+import array
+import mmap
+import itertools
+try:
+    import numpy as np # optional; needed for the map geometry columns, stream arrays fall back to memoryviews
+except ImportError:
+    np = None
+try:
+    import zstandard # optional; only needed for OUTPUTCOMPRESSION = 'zstd'
+except ImportError:
+    zstandard = None
+try:
+    import pyarrow as pa # optional; only needed for the columnar (parquet / arrow) export
+    import pyarrow.parquet as pq
+    import pyarrow.ipc
+except ImportError:
+    pa = None
+try:
+    import orjson # optional; the fastest json backend for the responses (see JSONBACKEND)
+except ImportError:
+    orjson = None
+try:
+    import ujson # optional; the next fastest
+except ImportError:
+    ujson = None
 import codecs
+import threading
+import multiprocessing
+import collections
+import concurrent.futures
 from datetime import datetime
 
 #
@@ -83,37 +123,538 @@ M1_STRAVA_CLIENT_SECRET= None # '' #you can code your value here if you want for
 #       in absence of a legit oAUTH server, this request fails but STRAVA re-forms the URL to include the required App Code 
 M1_APP_CODE = None #'' # you have to get it from Web once, but you can code your value here if you want for a local copy until it expires (24 hrs)
 
-# use simple stdout redirection to create a .CSV file
-class MG_OutputRedirect:
-    def __init__(self, redirfile, otherflags=0):
-        self.stdout = None
-        self.makestdoutredirect(redirfile)
-
-    def makestdoutredirect(self,basetag,resetredirection=False ):
-            if  resetredirection:  #just reset any existing redirect
-                if self.stdout:
-                    sys.stdout = self.stdout
-                    self.stdout = None
-                return 
-
-            # change BASEPATH if you want output to different location 
-            fname = BASEPATH+"%s-%d-%s.csv"%(basetag,logtyperadioval,(datetime.now()).strftime("%Y-%m-%d-%H-%M-%S"))  #,self.gettimedaystr())
+# root of the strava REST API (the benchmark suite points this at its local mock server)
+STRAVAAPIBASE = "https://www.strava.com/api/v3"
+STRAVATOKENURL = "https://www.strava.com/oauth/token"
+
+## M O D I F Y these values to keep the oauth tokens between runs
+# the access and refresh tokens from the first authorization are saved here; later runs start straight from the file
+# (no prompts, no browser) and refresh the six hour access token themselves. None asks for an App Code every run
+TOKENSTOREFILE = None # BASEPATH + "stravatokens.json"
+# refresh this many seconds before the access token expires
+TOKENREFRESHAHEAD = 15*60
+
+## M O D I F Y these values to tune the activity detail fetch engine
+# number of activity/kudos/comment requests kept in flight at once. 1 restores the original one-after-another behavior
+FETCHWORKERS = 4
+# listing pages fetched at once for a full listing (see strava_prefetchsummaries). 1 lists page after page
+LISTWORKERS = 4
+# activities per listing page, for both the sequential and the concurrent listing (200 is the api maximum)
+LISTPAGESIZE = 200
+# strava application limits; every fetch worker draws from this one shared budget
+RATELIMIT15MIN = 600
+RATELIMIT24HR = 30000
+# requests held back from each window so other clients of the same strava application don't push us into a 429
+RATELIMITMARGIN = 5
+## M O D I F Y these values for incremental sync
+# when True only activities newer than the saved high-water mark (less the lookback) are requested in detail and their
+# rows are appended to the CSV written by the previous run. the state file keeps the mark and every exported activity id
+INCREMENTALSYNC = False
+SYNCSTATEFILE = BASEPATH + "stravasync-state.json"
+# late uploads can carry a start date older than the mark; re-list this many days back and skip the ids already exported
+SYNCLOOKBACKDAYS = 2
+
+## M O D I F Y these values for the local response cache
+# activity, kudos, comment and listing page responses are kept in a sqlite file so reruns don't spend API quota. None disables it
+RESPONSECACHE = None # BASEPATH + "stravacache.sqlite"
+# seconds a cached response stays fresh, per endpoint
+CACHETTLS = {'list': 60*60, 'activity': 30*24*60*60, 'kudos': 24*60*60, 'comments': 24*60*60, 'streams': 30*24*60*60}
+# least recently used responses are dropped once the compressed bodies pass this size
+CACHEMAXBYTES = 500*1024*1024
+# True replays only from the cache: no authentication and no network; anything not cached counts as a failed request
+CACHEOFFLINE = False
+
+## M O D I F Y these values to archive the raw responses
+# a directory keeps every response body exactly as strava sent it in an append-only gzip ndjson file with a block
+# offset index (see StravaResponseArchive). None disables it
+RESPONSEARCHIVE = None # BASEPATH + "stravaarchive/"
+# uncompressed bytes per gzip block; a lookup decompresses one block
+ARCHIVEBLOCKBYTES = 1024*1024
+# the json parser for the responses, the cache and the archive: 'orjson', 'ujson', 'json' or None for the fastest
+# one installed
+JSONBACKEND = None
+
+## M O D I F Y these values for the csv output files (written when DOREDIRECTION is True, otherwise rows go to the console)
+# None, 'gzip' or 'zstd' (zstd needs the zstandard module) streaming compression
+OUTPUTCOMPRESSION = None
+# True writes each record type (activities, laps, segment_efforts, splits..., kudos, comments) to its own csv file
+OUTPUTSPLITBYTYPE = False
+# write buffer per file and the number of rows collected before they are handed to the file in one batch
+OUTPUTBUFFERBYTES = 1024*1024
+OUTPUTBATCHROWS = 2000
+
+## M O D I F Y these values for the output units
+# True writes distances in miles, speeds in mph and elevations in feet; False keeps strava's own meters and meters/second.
+# times are minutes either way
+STDUNITS = True
+# True converts the unit columns of an activity's laps, splits and segment efforts together (see mgcompilebatch)
+BATCHUNITS = True
+
+## M O D I F Y these values to add route geometry columns to the Activity rows
+# True decodes each activity's map polyline (numpy needed) and adds point count, path length and bounding box columns
+EXPORTMAPGEOMETRY = False
+# 'polyline' (full detail route) or 'summary_polyline' (simplified; the only one in listing summaries)
+MAPPOLYLINEKEY = 'polyline'
+# activities whose routes are decoded together in one numpy batch
+MAPGEOMETRYBATCH = 200
+
+## M O D I F Y these values to make long exports resumable
+# journal of completed activities and csv file lengths (see StravaCheckpoint). None disables it. needs DOREDIRECTION
+# and uncompressed csv output
+CHECKPOINTFILE = None # BASEPATH + "stravadata-checkpoint.jsonl"
+# True continues the export the journal describes instead of starting a new one
+RESUMEEXPORT = False
+# completed activities between journal entries (each entry fsyncs the csv files)
+CHECKPOINTEVERY = 25
+
+## M O D I F Y this value for a summary-only export
+# True writes the Activity rows straight from the activity listing pages (up to 199 summaries per request) and makes
+# no detail, kudos, comment or stream requests. columns only the detail response carries are left empty, and there
+# are no laps, segment, split, kudo or comment rows
+SUMMARYONLY = False
+
+## M O D I F Y this value to keep the raw json dicts
+# True converts every detail, kudos and comment response into compact slotted records (see MGRecord) holding only the
+# template keys as soon as it is parsed; the rows written are the same
+RECORDSLOTS = True
+
+## M O D I F Y this value to write segments as their own table
+# True writes each segment once, as a 'segment' row (its own file / table when split by type) the first time an effort
+# on it shows up, and the segment effort rows carry segment_id in place of the segment's columns. segments written by
+# an earlier run (sync state) or before an interruption (checkpoint journal) are not written again
+SEGMENTTABLE = False
+
+## M O D I F Y these values to fetch activity streams (the per-sample channels behind an activity)
+# a directory turns it on: each activity's streams are stored there as typed binary arrays (see StravaStreamStore),
+# never as csv text. activities already in the store are not fetched again. None disables it
+STREAMSDIR = None # BASEPATH + "stravastreams/"
+STREAMKEYS = ['time', 'latlng', 'distance', 'altitude', 'heartrate', 'cadence', 'watts', 'temp', 'moving',
+              'velocity_smooth', 'grade_smooth']
+
+## M O D I F Y these values to choose the export format
+# 'csv' writes the interleaved csv; 'parquet' or 'arrow' write one typed columnar table per record type into COLUMNARDIR;
+# 'sqlite' upserts every record into the indexed tables of SQLITEFILE (see StravaSQLiteStore, query it with
+# MGstravaquery.py)
+EXPORTFORMAT = 'csv'
+COLUMNARDIR = BASEPATH + "stravadata-columnar/"
+# rows buffered per table before a row group is written
+COLUMNARROWGROUP = 50000
+SQLITEFILE = BASEPATH + "stravadata.sqlite"
+# activities per sqlite transaction
+SQLITECOMMITEVERY = 200
+
+## M O D I F Y these values to keep the rollup tables (see StravaRollups)
+# True keeps per athlete / sport type / period totals of every exported activity up to date as the export runs; they
+# live in the sqlite store (EXPORTFORMAT = 'sqlite') or else in ROLLUPFILE
+ROLLUPS = False
+ROLLUPFILE = BASEPATH + "stravadata-rollups.sqlite"
+ROLLUPPERIODS = ['week', 'month']
+
+## M O D I F Y these values to save the run metrics (see StravaMetrics). None skips the file
+# json report of requests, latency, retries, bytes and formatting time per endpoint / record type
+METRICSREPORT = None # BASEPATH + "stravadata-metrics.json"
+# the same in prometheus text format, e.g. into the node exporter's textfile collector directory
+METRICSPROMFILE = None # "/var/lib/node_exporter/textfile_collector/strava_export.prom"
+
+## M O D I F Y these values to profile the field converters (mgtextout, mgdistanceout, ...) of the csv output
+# True times every converter call per record type and field (see MGConverterProfiler); best on an offline cache replay
+PROFILECONVERTERS = False
+# hot-field report; None prints it
+PROFILEREPORT = None # BASEPATH + "stravadata-profile.txt"
+# collapsed stacks (record;field;converter microseconds) for flamegraph.pl / speedscope
+PROFILECOLLAPSED = None # BASEPATH + "stravadata-profile.collapsed"
+# cProfile of the whole export loop (open with pstats or snakeviz)
+PROFILECPROFILE = None # BASEPATH + "stravadata-profile.pstats"
+
+# keep-alive connections held open to www.strava.com (raised to FETCHWORKERS if that is larger)
+HTTPPOOLSIZE = 8
+
+# build a keep-alive requests session so every API call reuses pooled TLS connections instead of a fresh handshake.
+# gzip/deflate are always accepted; with an access token the Authorization header is built once for the session.
+# requests sessions are fine to share between fetch worker threads for plain GETs; pool_block keeps the
+# connection count at poolsize when more workers than connections are running
+def mghttpsession(poolsize=HTTPPOOLSIZE, accesstoken=None):
+    session = r.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolsize, pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    if accesstoken:
+        session.headers['Authorization'] = 'Bearer %s'%accesstoken
+    return session
+
+# the body size of a response for the metrics: the length of the body a plain request has already read (a chunked
+# response has no Content-Length at all), the Content-Length header of a streamed one (stream=True) not read yet
+def mgresponsebytes(response):
+    if response._content is False:
+        return int(response.headers.get('Content-Length', 0))
+    return len(response.content)
+
+# buffered csv output sink, replacing the print()-to-redirected-stdout path. each route (one interleaved 'all' file,
+# or one file per record type with splitbytype) gets a large write buffer, explicit UTF-8 encoding and optional
+# gzip / zstd streaming compression. rows are formatted by the compiled formatters and handed to csv.writer in
+# batches of batchrows instead of one write per line.
+# appendfiles {route: filename} reopens the files of an earlier run (incremental sync); tostdout keeps the
+# rows on the console like the original non-redirected mode
+class MG_OutputSink:
+    def __init__(self, basetag, basepath=BASEPATH, compression=OUTPUTCOMPRESSION, splitbytype=OUTPUTSPLITBYTYPE,
+                 appendfiles=None, batchrows=OUTPUTBATCHROWS, bufferbytes=OUTPUTBUFFERBYTES, tostdout=False):
+        self.basetag = basetag
+        self.basepath = basepath
+        self.compression = compression
+        self.splitbytype = splitbytype and not tostdout
+        self.appendfiles = appendfiles if appendfiles else {}
+        self.batchrows = batchrows
+        self.bufferbytes = bufferbytes
+        self.tostdout = tostdout
+        self.formatters = None # None: the compiled formatters of the current settings; profiling sets timed ones
+        self.rowsetup = None # (row templates, row formatters, batch formatters), looked up when a file opens
+        self.stamp = (datetime.now()).strftime("%Y-%m-%d-%H-%M-%S")
+        self.filenames = dict(self.appendfiles) # routes this run doesn't write keep their earlier file
+        self.files = {}
+        self.writers = {}
+        self.pending = {}
+
+    # which output a record type goes to
+    def route(self, rectype):
+        return MGCOLUMNARTABLES[rectype] if self.splitbytype else 'all'
+
+    # open (or reopen for append) the file of a route; new files get their header rows
+    def openroute(self, route):
+        self.rowsetup = mgrowsetup()
+        appending = False
+        if self.tostdout:
+            self.files[route] = sys.stdout
+        else:
+            fname = self.appendfiles.get(route)
+            appending = bool(fname) and os.path.exists(fname)
+            if not appending:
+                extension = {None:'', 'gzip':'.gz', 'zstd':'.zst'}[self.compression]
+                tag = self.basetag if route == 'all' else '%s-%s'%(self.basetag, route)
+                fname = self.basepath + "%s-%s.csv%s"%(tag, self.stamp, extension)
+            print("opening %s"%fname)
+            raw = open(fname, 'ab' if appending else 'wb', buffering=self.bufferbytes)
+            # appending to a compressed file starts a new gzip member / zstd frame; readers handle both
+            if self.compression == 'gzip':
+                raw = gzip.GzipFile(fileobj=raw, mode='ab' if appending else 'wb')
+            elif self.compression == 'zstd':
+                if zstandard is None:
+                    raise RuntimeError("OUTPUTCOMPRESSION = 'zstd' needs the zstandard module (pip install zstandard)")
+                raw = zstandard.ZstdCompressor().stream_writer(raw)
+            self.files[route] = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+            self.filenames[route] = fname
+        self.writers[route] = csv.writer(self.files[route], lineterminator='\n')
+        self.pending[route] = []
+        if appending:
+            return # the earlier run wrote the header rows
+        if route == 'all':
+            self.pending[route] += mgheaderrows(self.rowsetup[0])
+        else:
+            for rectype, table in MGCOLUMNARTABLES.items():
+                if table == route:
+                    self.pending[route].append(mgtableheader(rectype, self.rowsetup[0]))
+
+    # format one record and queue its row; a full batch goes to the file in one writerows
+    def add(self, rectype, activity_n, record):
+        route = self.route(rectype)
+        if route not in self.writers:
+            self.openroute(route)
+        pending = self.pending[route]
+        rowtemplates, formatters, batchformatters = self.rowsetup
+        formatters = self.formatters if self.formatters else formatters
+        pending.append([str(activity_n), rowtemplates[rectype][3]] + formatters[rectype](record, activity_n))
+        if len(pending) >= self.batchrows:
+            self.writers[route].writerows(pending)
+            pending.clear()
+
+    # flush and fsync every file; returns {route: file length in bytes} for the checkpoint journal
+    def offsets(self):
+        self.flush()
+        offsets = {}
+        for route, f in self.files.items():
+            if f is not sys.stdout:
+                os.fsync(f.buffer.fileno())
+                offsets[route] = f.buffer.tell()
+        return offsets
+
+    # format a list of records of one type (batch formatter when there is one) and queue their rows
+    def addbatch(self, rectype, activity_n, records):
+        if rectype not in MGBATCHTYPES or len(records) < MGBATCHMINROWS or self.formatters:
+            # the Activity, kudos and comments, a few laps (the batch setup costs more than it saves) or profiling
+            for record in records:
+                self.add(rectype, activity_n, record)
+            return
+        route = self.route(rectype)
+        if route not in self.writers:
+            self.openroute(route)
+        pending = self.pending[route]
+        rowtemplates, formatters, batchformatters = self.rowsetup
+        prefix = [str(activity_n), rowtemplates[rectype][3]]
+        pending.extend([prefix + row for row in batchformatters[rectype](records, activity_n)])
+        if len(pending) >= self.batchrows:
+            self.writers[route].writerows(pending)
+            pending.clear()
+
+    # hand every queued row to its file and flush the file buffers
+    def flush(self):
+        for route, pending in self.pending.items():
+            if pending:
+                self.writers[route].writerows(pending)
+                pending.clear()
+            self.files[route].flush()
+
+    def close(self):
+        self.flush()
+        for route, f in self.files.items():
+            if f is not sys.stdout:
+                f.close()
+        self.files = {}
+        self.writers = {}
+        self.pending = {}
+
+# crash-safe checkpoint journal for long exports. every 'every' completed activities the csv files are flushed and
+# fsynced, then one json line {files, done, offsets} is appended (and fsynced) to the journal: the ids completed
+# since the last line and the byte length of each csv file at that point. a torn last line from a crash is ignored
+# and cut off before the journal is appended to again.
+# resuming truncates each csv back to its last recorded length (rows of activities that were written but never
+# journaled are dropped), reopens it for append and skips the journaled ids, so no row is duplicated and no
+# completed activity is requested again. the ids of the segments written (segment table mode) are journaled the same
+# way, so a resumed export doesn't write them again. byte offsets need plain files: uncompressed csv only
+class StravaCheckpoint:
+    def __init__(self, journalfile, resume=False, every=CHECKPOINTEVERY):
+        self.journalfile = journalfile
+        self.every = every
+        self.done = set()
+        self.segments = set()
+        self.offsets = {}
+        self.files = {}
+        self.pending = []
+        self.pendingsegments = []
+        if resume:
             try:
-                #print("starting redir")
-                if self.stdout != sys.stdout:
-                    if self.stdout:
-                        self.stdout.close()
-                self.stdout = sys.stdout
-                print("opening %s"% fname)
-                sys.stdout = open(fname, 'w')
-                return fname
-            except:
-                #print("ending redir")
-                if sys.stdout:
-                    self.stdout = None
-                print("MGU-stdout redirect failed: ", fname)
-                return None
-                
+                validbytes = 0 # the journal up to the end of its last complete line
+                with open(journalfile, 'rb') as f:
+                    for line in f:
+                        if not line.endswith(b'\n'):
+                            break # torn write
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            break # torn write
+                        self.files.update(entry['files'])
+                        self.done.update(entry['done'])
+                        self.segments.update(entry.get('segments', []))
+                        self.offsets.update(entry['offsets'])
+                        validbytes += len(line)
+                # cut the torn tail off, or the next entry would be appended to it and both lost on a resume
+                if os.path.getsize(journalfile) > validbytes:
+                    os.truncate(journalfile, validbytes)
+            except FileNotFoundError:
+                pass # nothing to resume
+        self.journal = open(journalfile, 'a' if resume else 'w')
+
+    # cut the files back to the journaled lengths; returns the {route: filename} to reopen for append. a file with
+    # no journaled length never got past its header rows safely, so it is removed and the route starts over
+    def resumefiles(self):
+        appendfiles = {}
+        for route, fname in self.files.items():
+            if not os.path.exists(fname):
+                continue
+            if route in self.offsets:
+                with open(fname, 'r+b') as f:
+                    f.truncate(self.offsets[route])
+                appendfiles[route] = fname
+            else:
+                os.remove(fname)
+        if self.done:
+            print("resuming: %d activities already exported"%len(self.done))
+        return appendfiles
+
+    # one activity's rows are all in the output, with the rows of the segments it wrote first
+    def completed(self, activity_n, output, segment_ids=()):
+        self.pending.append(activity_n)
+        self.pendingsegments.extend(segment_ids)
+        if len(self.pending) >= self.every:
+            self.commit(output)
+
+    def commit(self, output):
+        offsets = output.offsets() # flushed and fsynced before the journal says so
+        entry = {'files': output.filenames, 'done': self.pending, 'offsets': offsets}
+        if self.pendingsegments:
+            entry['segments'] = self.pendingsegments
+        self.journal.write(json.dumps(entry) + '\n')
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.done.update(self.pending)
+        self.segments.update(self.pendingsegments)
+        self.offsets.update(offsets)
+        self.pending = []
+        self.pendingsegments = []
+
+    # the export stopped: journal what is in the output (call before output.close()). a finished export removes the
+    # journal, so the next resume starts a new export
+    def close(self, output, finished=False):
+        self.commit(output)
+        self.journal.close()
+        if finished:
+            os.remove(self.journalfile)
+
+
+# convert a strava timestamp like '2019-06-15T16:11:52Z' to epoch seconds
+def mgisoepoch(datestr):
+    return calendar.timegm(time.strptime(datestr, '%Y-%m-%dT%H:%M:%SZ'))
+
+# saved state for incremental sync: the high-water mark (newest exported start_date, epoch seconds),
+# the set of exported activity ids, the csv files the rows went to ({route: filename}, see MG_OutputSink) and the
+# ids of the segments written as segment rows (SEGMENTTABLE).
+# the listing is newest first, so the first activity of a run already carries its newest start_date: the high-water
+# mark only moves when the run got through the whole listing (save(finished=True)). a run that stopped part way keeps
+# the previous mark, so the next run lists the activities it never reached again and skips the exported ids
+class StravaSyncState:
+    def __init__(self, statefile=SYNCSTATEFILE):
+        self.statefile = statefile
+        self.highwater = None
+        self.newest = None # newest start_date exported this run
+        self.exported_ids = set()
+        self.outputfiles = {}
+        self.segment_ids = set()
+        try:
+            with open(statefile, 'r') as f:
+                state = json.load(f)
+            self.highwater = state['highwater']
+            self.exported_ids = set(state['exported_ids'])
+            self.outputfiles = state.get('outputfiles', {})
+            self.segment_ids = set(state.get('segment_ids', []))
+            if state.get('outputfile'):
+                self.outputfiles = {'all': state['outputfile']} # state saved before the output sink
+        except FileNotFoundError:
+            pass # first run, full export
+
+    # the after= cursor for the activity listing; None means list everything
+    def aftercursor(self, lookbackdays=SYNCLOOKBACKDAYS):
+        if self.highwater is None:
+            return None
+        return self.highwater - lookbackdays*24*60*60
+
+    # record an exported activity from its detail response
+    def markexported(self, activity_n, respdata_activity):
+        self.exported_ids.add(activity_n)
+        if respdata_activity.get('start_date'):
+            start = mgisoepoch(respdata_activity['start_date'])
+            if self.newest is None or start > self.newest:
+                self.newest = start
+
+    # write the state atomically so an interrupted save never leaves a truncated file. finished: the listing and
+    # the export both completed, so the high-water mark can advance
+    def save(self, finished=False):
+        if finished and self.newest is not None and (self.highwater is None or self.newest > self.highwater):
+            self.highwater = self.newest
+        tmpfile = self.statefile + '.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump({'highwater':self.highwater, 'exported_ids':sorted(self.exported_ids),
+                       'outputfiles':self.outputfiles, 'segment_ids':sorted(self.segment_ids)}, f)
+        os.replace(tmpfile, self.statefile)
+
+# persistent oauth tokens, so a run starts without prompts or a browser round trip.
+# strava's token exchange answers {access_token, refresh_token, expires_at, ...}; the access token lives six hours,
+# the refresh token until the athlete revokes the app. the file keeps both, the expiry and the client id / secret
+# the refresh needs, so keep it private. start() runs a background thread that refreshes refreshahead seconds before
+# expiry; renew() is the mid-run path when strava answers 401 anyway. every request reads accesstoken as it is sent,
+# so requests in flight finish with the old token and the next ones pick up the new one
+class StravaTokenStore:
+    def __init__(self, tokenfile, clientid=None, clientsecret=None, refreshahead=TOKENREFRESHAHEAD,
+                 tokenurl=STRAVATOKENURL, seed=None):
+        self.tokenfile = tokenfile
+        self.refreshahead = refreshahead
+        self.tokenurl = tokenurl
+        self.lock = threading.RLock() # one refresh at a time; store() runs inside it
+        self.stopped = threading.Event()
+        self.thread = None
+        self.session = mghttpsession(1)
+        self.tokens = dict(seed) if seed else {}
+        try:
+            with open(tokenfile, 'r') as f:
+                self.tokens.update(json.load(f))
+        except FileNotFoundError:
+            pass
+        if clientid:
+            self.tokens['client_id'] = clientid
+        if clientsecret:
+            self.tokens['client_secret'] = clientsecret
+
+    @property
+    def accesstoken(self):
+        return self.tokens.get('access_token')
+
+    def expiresin(self):
+        return self.tokens.get('expires_at', 0) - time.time()
+
+    # a run can start from the store when it has a live access token or a refresh token to get one
+    def usable(self):
+        if self.accesstoken and self.expiresin() > self.refreshahead:
+            return True
+        if self.refresh():
+            return True
+        return bool(self.accesstoken) and self.expiresin() > 0
+
+    # keep the response of a token exchange (authorization code or refresh) and write it out
+    def store(self, respdata):
+        with self.lock:
+            for key in ['access_token', 'refresh_token', 'expires_at']:
+                if key in respdata:
+                    self.tokens[key] = respdata[key]
+            self.save()
+
+    # write the tokens atomically (same pattern as the sync state)
+    def save(self):
+        tmpfile = self.tokenfile + '.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump(self.tokens, f)
+        os.replace(tmpfile, self.tokenfile)
+
+    # exchange the refresh token for a new access token
+    def refresh(self):
+        if not self.tokens.get('refresh_token'):
+            return False
+        with self.lock:
+            try:
+                resp = self.session.post(self.tokenurl, data={'client_id': self.tokens.get('client_id'),
+                                                              'client_secret': self.tokens.get('client_secret'),
+                                                              'grant_type': 'refresh_token',
+                                                              'refresh_token': self.tokens['refresh_token']})
+            except r.exceptions.RequestException as err:
+                print("token refresh error:", err)
+                return False
+            if not resp.ok:
+                print("Failed to refresh token: ", resp)
+                return False
+            self.store(resp.json())
+            return True
+
+    # a request sent with stale token got 401. refresh unless another thread already has; True when a newer token exists
+    def renew(self, stale):
+        with self.lock:
+            if self.accesstoken != stale:
+                return True
+            return self.refresh()
+
+    # background refresh ahead of expiry; failed refreshes are retried every minute
+    def start(self):
+        if self.thread is None and self.tokens.get('refresh_token'):
+            self.thread = threading.Thread(target=self.refresher, daemon=True)
+            self.thread.start()
+        return self
+
+    def refresher(self):
+        while not self.stopped.wait(max(self.expiresin() - self.refreshahead, 0)):
+            if not self.refresh():
+                self.stopped.wait(60)
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
 
 
 defaultcodes = {'1':(M1_STRAVA_CLIENT_ID,M1_STRAVA_CLIENT_SECRET,M1_APP_CODE), '2':('','','')}
@@ -143,7 +684,7 @@ defaultcodes = {'1':(M1_STRAVA_CLIENT_ID,M1_STRAVA_CLIENT_SECRET,M1_APP_CODE), '
 # if no App Code, then step3 is required to obtain and App Code from Strava. 
 # After the App Code is present, the authentication is completed by a call to Strava API to get a validated Access Code
 class StravaAPIauthenticator():
-    def __init__(self, clientcode=None):
+    def __init__(self, clientcode=None, tokenstore=None):
         self.clientid= defaultcodes['1'][0] #clientid
         self.clientsecret= defaultcodes['1'][1] #clientsecret
         if not clientcode:
@@ -151,6 +692,11 @@ class StravaAPIauthenticator():
         else:
             self.clientcode = clientcode
         self.accesstoken = None
+        self.tokenstore = tokenstore # optional StravaTokenStore
+        self.session = mghttpsession(1)
+        if tokenstore is not None and tokenstore.usable():
+            self.accesstoken = tokenstore.accesstoken # saved tokens still good (or refreshed): no secrets sequence
+            return
         if not self.clientcode: #if we got a code in the instantiation, don't go through the secrets sequence
             retstat = self.saa_getsecrets()
             if not self.clientcode:
@@ -217,81 +763,808 @@ class StravaAPIauthenticator():
     def saa_validatedstravatoken(self,clientid,clientsecret,clientcode):
         # the specific Strava POST URL query to get a validated accesstoken given an athlete clientid,clientsecret,code
         request_url= "https://www.strava.com/oauth/token?client_id=%s&client_secret=%s&code=%s&grant_type=authorization_code"%(clientid, clientsecret, clientcode)
-        resp = r.post(request_url)
+        resp = self.session.post(request_url)
         if not resp.ok:
             print("Failed to validate token: ", resp)
             return False
         # make the response into a structure I can decode to extract authenticated, validated token 
         respdata = resp.json()
         self.accesstoken = respdata['access_token']
+        if self.tokenstore is not None:
+            # keep the refresh token and expiry so the next run can skip all of this
+            self.tokenstore.tokens['client_id'], self.tokenstore.tokens['client_secret'] = clientid, clientsecret
+            self.tokenstore.store(respdata)
         return True
 
 
+# header-driven request scheduler for the strava application rate limits ("< 600 requests per 15 minutes, < 30,000 per day").
+# strava reports the limits and the current usage of both windows on every API response:
+#     X-RateLimit-Limit: 600,30000       X-RateLimit-Usage: 314,27536
+# the scheduler counts the requests it lets through, trusts the server usage whenever a response arrives and holds
+# back RATELIMITMARGIN requests of headroom, so requests are paced to stay under the limit rather than running into 429s.
+# when a window is used up it sleeps exactly until the next :00 :15 :30 :45 boundary (midnight UTC for the daily window).
+# one scheduler is shared (thread safe) by every fetch worker
+class StravaRateScheduler:
+    # windowseconds is the short window length; only the benchmark mock server uses anything but 15 minutes
+    def __init__(self, limit15min=RATELIMIT15MIN, limit24hr=RATELIMIT24HR, margin=RATELIMITMARGIN, windowseconds=15*60):
+        self.lock = threading.Lock()
+        self.windowseconds = windowseconds
+        self.limit15min = limit15min
+        self.limit24hr = limit24hr
+        self.margin = margin
+        self.requestcounterper15min = 0
+        self.requestcounterper24hr = 0
+        self.base15mins = None # start of the current 15 minute window
+        self.base24hr = None # start of the current daily window
+
+    # move the window bases forward when a boundary has passed. caller holds the lock
+    def rollwindows(self, now):
+        if self.base15mins is None or now - self.base15mins >= self.windowseconds:
+            self.base15mins = now - now % self.windowseconds
+            self.requestcounterper15min = 0
+        if self.base24hr is None or now - self.base24hr >= 24*60*60:
+            self.base24hr = now - now % (24*60*60)
+            self.requestcounterper24hr = 0
+
+    # block until one request fits in both windows, count it and return the time it was issued
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.rollwindows(now)
+                if self.requestcounterper24hr >= self.limit24hr - self.margin:
+                    waittime = self.base24hr + 24*60*60 - now
+                elif self.requestcounterper15min >= self.limit15min - self.margin:
+                    waittime = self.base15mins + self.windowseconds - now
+                else:
+                    self.requestcounterper15min += 1
+                    self.requestcounterper24hr += 1
+                    return now
+            print("API request budget used up; waiting %d seconds for the next rate window"%waittime)
+            time.sleep(waittime)
+
+    # fold the X-RateLimit headers of a response into the counters. responses to requests issued
+    # before the current window started describe the old window and are ignored
+    def update(self, headers, issuedat):
+        try:
+            limits = [int(i) for i in headers['X-RateLimit-Limit'].split(',')]
+            usage = [int(i) for i in headers['X-RateLimit-Usage'].split(',')]
+        except (KeyError, ValueError, AttributeError):
+            return
+        with self.lock:
+            self.rollwindows(time.time())
+            self.limit15min, self.limit24hr = limits[0], limits[1]
+            if issuedat >= self.base15mins:
+                self.requestcounterper15min = max(self.requestcounterper15min, usage[0])
+            if issuedat >= self.base24hr:
+                self.requestcounterper24hr = max(self.requestcounterper24hr, usage[1])
+
+    # strava answered 429: treat the 15 minute window as used up so every worker waits for the boundary
+    def exhausted(self, issuedat):
+        with self.lock:
+            self.rollwindows(time.time())
+            if issuedat >= self.base15mins:
+                self.requestcounterper15min = self.limit15min
+
+    # requests left in the (15 minute, daily) windows
+    def remaining(self):
+        with self.lock:
+            self.rollwindows(time.time())
+            return self.limit15min - self.requestcounterper15min, self.limit24hr - self.requestcounterper24hr
+
+
+# a float slot of the shared state array exposed as a scheduler attribute (NaN stands for None)
+def mgsharedfield(i):
+    def getfield(self):
+        value = self.shared[i]
+        return None if value != value else value
+    def setfield(self, value):
+        self.shared[i] = float('nan') if value is None else value
+    return property(getfield, setfield)
+
+# the application rate budget shared by several worker processes (multi-athlete harvest). the window counters live in
+# multiprocessing shared memory behind one process-safe lock, so every worker process paces against the same
+# application-wide usage. on top of the application limits each worker slot gets a fair share of every window:
+# (limit - margin) divided by the number of athletes being harvested at the moment, so one big backfill can't
+# starve the others. create it in the parent, hand it to the worker processes, and call forslot(n) in worker n
+class StravaSharedRateScheduler(StravaRateScheduler):
+    base15mins = mgsharedfield(0)
+    base24hr = mgsharedfield(1)
+    requestcounterper15min = mgsharedfield(2)
+    requestcounterper24hr = mgsharedfield(3)
+    limit15min = mgsharedfield(4)
+    limit24hr = mgsharedfield(5)
+    activeslots = mgsharedfield(6)
+
+    def __init__(self, nslots, limit15min=RATELIMIT15MIN, limit24hr=RATELIMIT24HR, margin=RATELIMITMARGIN,
+                 windowseconds=15*60):
+        self.shared = multiprocessing.RawArray('d', 7)
+        self.slotcounters = multiprocessing.RawArray('d', 2*nslots) # (15 minute, daily) requests per worker slot
+        self.slot = None
+        StravaRateScheduler.__init__(self, limit15min, limit24hr, margin, windowseconds)
+        self.lock = multiprocessing.Lock()
+        self.activeslots = 0
+
+    # the scheduler as seen from worker slot n (each worker process harvests one athlete at a time)
+    def forslot(self, slot):
+        self.slot = slot
+        return self
+
+    # an athlete harvest starts / ends on this slot; the fair share is recomputed from the active count. the slot's
+    # usage stays with the slot until its window rolls over, so the next athlete on it starts from what was used
+    def activate(self, active):
+        with self.lock:
+            self.activeslots = max(0, self.activeslots + (1 if active else -1))
+
+    def rollwindows(self, now):
+        base15mins, base24hr = self.base15mins, self.base24hr
+        StravaRateScheduler.rollwindows(self, now)
+        for i in range(len(self.slotcounters)//2):
+            if self.base15mins != base15mins:
+                self.slotcounters[2*i] = 0
+            if self.base24hr != base24hr:
+                self.slotcounters[2*i+1] = 0
+
+    # like StravaRateScheduler.acquire, plus this slot's fair share of both windows
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.rollwindows(now)
+                active = max(1, self.activeslots)
+                share15min = max(1, (self.limit15min - self.margin)//active)
+                share24hr = max(1, (self.limit24hr - self.margin)//active)
+                if (self.requestcounterper24hr >= self.limit24hr - self.margin or
+                        self.slotcounters[2*self.slot+1] >= share24hr):
+                    waittime = self.base24hr + 24*60*60 - now
+                elif (self.requestcounterper15min >= self.limit15min - self.margin or
+                        self.slotcounters[2*self.slot] >= share15min):
+                    waittime = self.base15mins + self.windowseconds - now
+                else:
+                    self.requestcounterper15min += 1
+                    self.requestcounterper24hr += 1
+                    self.slotcounters[2*self.slot] += 1
+                    self.slotcounters[2*self.slot+1] += 1
+                    return now
+            # a share can grow when another athlete finishes, so check again at least every few seconds
+            time.sleep(min(waittime, 5))
+
+
+# pluggable json backend: (name, loads(bytes or str), dumps(obj) -> bytes). orjson and ujson parse detail responses
+# several times faster than the stdlib; every backend gives the same dicts, lists, ints and floats
+def mgjsonbackend(name=JSONBACKEND):
+    if name in (None, 'orjson') and orjson is not None:
+        return 'orjson', orjson.loads, orjson.dumps
+    if name in (None, 'ujson') and ujson is not None:
+        return 'ujson', ujson.loads, lambda obj: ujson.dumps(obj, ensure_ascii=False).encode()
+    return 'json', json.loads, lambda obj: json.dumps(obj, separators=(',',':'), ensure_ascii=False).encode()
+
+MGJSONBACKEND, mgjsonloads, mgjsondumps = mgjsonbackend()
+
+
+# on-disk cache of API responses keyed by (endpoint, key) e.g. ('activity','2452708685') or ('list','per_page=200&page=3').
+# bodies are stored zlib-compressed in sqlite. an entry is fresh for ttls[endpoint] seconds (offline mode takes
+# anything it has), every hit refreshes its last-used time, and the least recently used entries are evicted
+# when the total passes maxbytes. one connection behind a lock is shared by all fetch workers
+class StravaResponseCache:
+    def __init__(self, cachefile, ttls=CACHETTLS, maxbytes=CACHEMAXBYTES, offline=False):
+        self.ttls = ttls
+        self.maxbytes = maxbytes
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(cachefile, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses (endpoint TEXT, key TEXT, fetched REAL, lastused REAL,'
+                        ' size INTEGER, body BLOB, PRIMARY KEY (endpoint, key))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_lastused ON responses (lastused)')
+        self.totalbytes = self.db.execute('SELECT COALESCE(SUM(size),0) FROM responses').fetchone()[0]
+
+    # return the cached response data or None when missing or stale
+    def get(self, endpoint, key):
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT fetched, body FROM responses WHERE endpoint=? AND key=?',
+                                  (endpoint, str(key))).fetchone()
+            if row is None:
+                return None
+            if not self.offline and now - row[0] > self.ttls.get(endpoint, 0):
+                return None
+            self.db.execute('UPDATE responses SET lastused=? WHERE endpoint=? AND key=?', (now, endpoint, str(key)))
+        return mgjsonloads(zlib.decompress(row[1]))
+
+    # the response body as strava sent it (bytes), or the parsed data
+    def put(self, endpoint, key, respdata):
+        body = zlib.compress(respdata if isinstance(respdata, bytes) else mgjsondumps(respdata))
+        now = time.time()
+        with self.lock:
+            old = self.db.execute('SELECT size FROM responses WHERE endpoint=? AND key=?', (endpoint, str(key))).fetchone()
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?,?,?,?,?,?)',
+                            (endpoint, str(key), now, now, len(body), body))
+            self.totalbytes += len(body) - (old[0] if old else 0)
+            if self.totalbytes > self.maxbytes:
+                self.evict()
+
+    # drop least recently used entries until the cache is back under 90% of maxbytes. caller holds the lock
+    def evict(self):
+        while self.totalbytes > self.maxbytes*0.9:
+            victims = self.db.execute('SELECT endpoint, key, size FROM responses ORDER BY lastused LIMIT 100').fetchall()
+            if not victims:
+                self.totalbytes = 0
+                return
+            for endpoint, key, size in victims:
+                self.db.execute('DELETE FROM responses WHERE endpoint=? AND key=?', (endpoint, key))
+                self.totalbytes -= size
+                if self.totalbytes <= self.maxbytes*0.9:
+                    return
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+# append-only archive of the raw responses. the bodies strava sent (not the parsed dicts) are kept as ndjson lines
+# {"endpoint": ..., "key": ..., "fetched": ..., "status": ..., "body": <the response json as sent>} (a body that
+# isn't json, like an html error page, goes in as a "text" string). lines are collected into blocks of blockbytes and
+# each block is written as its own gzip member, so the file is plain gzip ndjson for zcat / jq / pandas, and
+# responses.idx gets one json line per block: {offset, size, records: [[endpoint, key, fetched, status, start,
+# length], ...]} with each body's place in the uncompressed block. get() finds a response by (endpoint, key) in the
+# index and inflates one block; records() replays everything block by block handing out the body bytes, so
+# only what the caller parses gets parsed. a block torn by a crash is past the last index line and is cut off on open
+class StravaResponseArchive:
+    def __init__(self, archivedir, blockbytes=ARCHIVEBLOCKBYTES):
+        os.makedirs(archivedir, exist_ok=True)
+        self.datafile = os.path.join(archivedir, 'responses.ndjson.gz')
+        self.indexfile = os.path.join(archivedir, 'responses.idx')
+        self.blockbytes = blockbytes
+        self.lock = threading.Lock()
+        self.blocks = [] # [offset, size] per written block
+        self.latest = {} # (endpoint, key) -> (block number, start, length, fetched, status); block None is pending
+        self.end = 0
+        indexend = 0
+        try:
+            with open(self.indexfile, 'rb') as f:
+                for line in f:
+                    try:
+                        entry = mgjsonloads(line)
+                    except ValueError:
+                        break # torn write
+                    if not line.endswith(b'\n'):
+                        break
+                    self.addblock(entry)
+                    indexend += len(line)
+        except FileNotFoundError:
+            pass
+        # cut a torn index line and the block it didn't get to index
+        for fname, end in [(self.indexfile, indexend), (self.datafile, self.end)]:
+            with open(fname, 'ab') as f:
+                if f.tell() > end:
+                    f.truncate(end)
+        self.data = open(self.datafile, 'ab')
+        self.index = open(self.indexfile, 'ab')
+        self.reader = None
+        self.pending = []
+        self.pendingrecords = []
+        self.pendingbytes = 0
+        self.cachedblock = (None, None)
+        self.countrawbytes = 0
+
+    def addblock(self, entry):
+        blockn = len(self.blocks)
+        self.blocks.append((entry['offset'], entry['size']))
+        for endpoint, key, fetched, status, start, length in entry['records']:
+            self.latest[(endpoint, key)] = (blockn, start, length, fetched, status)
+        self.end = entry['offset'] + entry['size']
+
+    # archive one response; body is the raw bytes, isjson says it parsed (error bodies are kept as text)
+    def append(self, endpoint, key, status, body, isjson=True, fetched=None):
+        fetched = time.time() if fetched is None else fetched
+        key = str(key)
+        head = mgjsondumps({'endpoint': endpoint, 'key': key, 'fetched': fetched, 'status': status})[:-1]
+        if isjson:
+            # json has no raw newlines inside strings, so these are whitespace between tokens
+            body = body.replace(b'\n', b' ').replace(b'\r', b' ')
+            head += b',"body":'
+        else:
+            body = mgjsondumps(body.decode('utf-8', 'replace') if isinstance(body, bytes) else str(body))
+            head += b',"text":'
+        with self.lock:
+            start = self.pendingbytes + len(head)
+            self.pending.append(head + body + b'}\n')
+            self.pendingbytes += len(head) + len(body) + 2
+            self.pendingrecords.append([endpoint, key, fetched, status, start, len(body)])
+            # not in a block yet: the pending line number and where its body starts in the line
+            self.latest[(endpoint, key)] = (None, len(self.pending) - 1, len(head), fetched, status)
+            self.countrawbytes += len(body)
+            if self.pendingbytes >= self.blockbytes:
+                self.flushblock()
+
+    # compress the pending lines as one gzip member, then index it. caller holds the lock
+    def flushblock(self):
+        if not self.pending:
+            return
+        block = gzip.compress(b''.join(self.pending), compresslevel=6)
+        self.data.write(block)
+        self.data.flush()
+        entry = {'offset': self.end, 'size': len(block), 'records': self.pendingrecords}
+        self.index.write(mgjsondumps(entry) + b'\n')
+        self.index.flush()
+        self.addblock(entry)
+        self.pending = []
+        self.pendingrecords = []
+        self.pendingbytes = 0
+
+    def readblock(self, blockn):
+        if self.cachedblock[0] != blockn:
+            if self.reader is None:
+                self.reader = open(self.datafile, 'rb')
+            offset, size = self.blocks[blockn]
+            self.reader.seek(offset)
+            self.cachedblock = (blockn, gzip.decompress(self.reader.read(size)))
+        return self.cachedblock[1]
+
+    def __contains__(self, endpointkey):
+        return (endpointkey[0], str(endpointkey[1])) in self.latest
+
+    # the latest archived body bytes for (endpoint, key), or None
+    def getbody(self, endpoint, key):
+        with self.lock:
+            found = self.latest.get((endpoint, str(key)))
+            if found is None:
+                return None
+            blockn, start, length = found[:3]
+            if blockn is None:
+                return self.pending[start][length:-2]
+            self.data.flush()
+            return self.readblock(blockn)[start:start + length]
+
+    # the latest archived response for (endpoint, key) parsed, or None
+    def get(self, endpoint, key):
+        body = self.getbody(endpoint, key)
+        return None if body is None else mgjsonloads(body)
+
+    # replay the archive in write order: yields (endpoint, key, fetched, status, body bytes) for every response,
+    # or only those of 'endpoint'
+    def records(self, endpoint=None):
+        with self.lock:
+            self.flushblock()
+            blocks = list(self.blocks)
+        with open(self.indexfile, 'rb') as f, open(self.datafile, 'rb') as data:
+            for blockn, line in enumerate(f):
+                if blockn >= len(blocks):
+                    break
+                entry = mgjsonloads(line)
+                if endpoint is not None and all(record[0] != endpoint for record in entry['records']):
+                    continue
+                data.seek(entry['offset'])
+                block = gzip.decompress(data.read(entry['size']))
+                for recendpoint, key, fetched, status, start, length in entry['records']:
+                    if endpoint is None or recendpoint == endpoint:
+                        yield recendpoint, key, fetched, status, block[start:start + length]
+
+    def close(self):
+        with self.lock:
+            self.flushblock()
+            self.data.close()
+            self.index.close()
+            if self.reader is not None:
+                self.reader.close()
+                self.reader = None
+
+
+# typed storage of activity streams (the per-sample time, latlng, heartrate, watts... channels).
+# each activity's channels go into one binary file <activity id>.streams as contiguous machine arrays, each channel
+# starting on an 8 byte boundary, and streams-index.json records per activity {channel: [typecode, offset, count, width]}
+# (width 2 for latlng pairs). get() memory-maps the file and returns numpy arrays (memoryviews without numpy) that
+# read straight from the page cache: nothing is parsed back into python lists and nothing goes through csv text
+STREAMTYPECODES = {'time': 'i', 'latlng': 'd', 'distance': 'd', 'altitude': 'f', 'velocity_smooth': 'f',
+                   'heartrate': 'i', 'cadence': 'i', 'watts': 'i', 'temp': 'i', 'moving': 'b', 'grade_smooth': 'f'}
+
+class StravaStreamStore:
+    def __init__(self, storedir, keys=STREAMKEYS, indexsaveevery=100):
+        self.storedir = storedir
+        self.keys = keys
+        self.indexfile = os.path.join(storedir, 'streams-index.json')
+        self.indexsaveevery = indexsaveevery
+        self.lock = threading.Lock()
+        self.unsaved = 0
+        os.makedirs(storedir, exist_ok=True)
+        try:
+            with open(self.indexfile, 'r') as f:
+                self.index = json.load(f)
+        except FileNotFoundError:
+            self.index = {}
+
+    def __contains__(self, activity_n):
+        return str(activity_n) in self.index
+
+    def filename(self, activity_n):
+        return os.path.join(self.storedir, '%d.streams'%activity_n)
+
+    # store the streams response of one activity. accepts the key_by_type dict or the plain list of stream objects;
+    # safe to call from the fetch worker threads
+    def put(self, activity_n, respdata):
+        if isinstance(respdata, list):
+            respdata = {stream['type']: stream for stream in respdata}
+        entry = {}
+        offset = 0
+        tmpfile = self.filename(activity_n) + '.tmp'
+        with open(tmpfile, 'wb') as f:
+            for channel, stream in respdata.items():
+                typecode = STREAMTYPECODES.get(channel, 'd')
+                data = stream.get('data') or []
+                width = 2 if channel == 'latlng' else 1
+                values = array.array(typecode, itertools.chain.from_iterable(data) if width == 2 else data)
+                pad = -offset % 8
+                f.write(b'\0'*pad)
+                offset += pad
+                values.tofile(f)
+                entry[channel] = [typecode, offset, len(values)//width, width]
+                offset += len(values)*values.itemsize
+        os.replace(tmpfile, self.filename(activity_n))
+        with self.lock:
+            self.index[str(activity_n)] = entry
+            self.unsaved += 1
+            if self.unsaved >= self.indexsaveevery:
+                self.saveindex()
+
+    # memory-map one activity's channels; returns {channel: array} ((count, 2) for latlng) or None when not stored
+    def get(self, activity_n):
+        entry = self.index.get(str(activity_n))
+        if entry is None:
+            return None
+        with open(self.filename(activity_n), 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                buf = b'' # mmap refuses empty files
+        channels = {}
+        for channel, (typecode, offset, count, width) in entry.items():
+            if np is not None:
+                values = np.frombuffer(buf, dtype=np.dtype(typecode), count=count*width, offset=offset)
+                channels[channel] = values.reshape(count, 2) if width == 2 else values
+            else:
+                nbytes = count*width*array.array(typecode).itemsize
+                view = memoryview(buf)[offset:offset+nbytes]
+                channels[channel] = view.cast(typecode, (count, 2)) if width == 2 and count else view.cast(typecode)
+        return channels
+
+    # write the index atomically (same pattern as the sync state). caller holds the lock or is the only thread
+    def saveindex(self):
+        tmpfile = self.indexfile + '.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmpfile, self.indexfile)
+        self.unsaved = 0
+
+    def close(self):
+        with self.lock:
+            self.saveindex()
+
+
+# run metrics: per endpoint (list, activity, kudos, comments, streams, athlete, stats) the requests sent, cache hits,
+# responses by status, retries, 429s, body bytes, time spent waiting on the rate budget and a latency histogram;
+# per record type the rows and the time spent formatting them into the output. report() gives the whole set as
+# a dict (plus the remaining rate budget), writejson() / writeprometheus() save it at the end of a run.
+# thread safe; shared by all fetch workers
+METRICSLATENCYBUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+class StravaMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.endpoints = {}
+        self.records = {}
+
+    def endpoint(self, name):
+        if name not in self.endpoints:
+            self.endpoints[name] = {'requests': 0, 'cache_hits': 0, 'status': {}, 'retries': 0, 'rate_limited': 0,
+                                    'bytes_received': 0, 'rate_wait_seconds': 0.0, 'latency_seconds': 0.0,
+                                    'latency_buckets': [0]*(len(METRICSLATENCYBUCKETS) + 1)}
+        return self.endpoints[name]
+
+    # one http request finished (status None: connection error). nbytes counts the body as read (mgresponsebytes)
+    def request(self, name, latency, status, nbytes, ratewait):
+        with self.lock:
+            counters = self.endpoint(name)
+            counters['requests'] += 1
+            counters['status'][str(status)] = counters['status'].get(str(status), 0) + 1
+            counters['bytes_received'] += nbytes
+            counters['rate_wait_seconds'] += ratewait
+            counters['latency_seconds'] += latency
+            bucket = 0
+            while bucket < len(METRICSLATENCYBUCKETS) and latency > METRICSLATENCYBUCKETS[bucket]:
+                bucket += 1
+            counters['latency_buckets'][bucket] += 1
+
+    def cachehit(self, name):
+        with self.lock:
+            self.endpoint(name)['cache_hits'] += 1
+
+    def retry(self, name, ratelimited=False):
+        with self.lock:
+            counters = self.endpoint(name)
+            counters['retries'] += 1
+            counters['rate_limited'] += ratelimited
+
+    # records formatted into the output (called from the export loop only)
+    def converted(self, rectype, seconds, rows=1):
+        counters = self.records.get(rectype)
+        if counters is None:
+            counters = self.records[rectype] = {'rows': 0, 'seconds': 0.0}
+        counters['rows'] += rows
+        counters['seconds'] += seconds
+
+    def report(self, ratescheduler=None, **extra):
+        with self.lock:
+            report = {'started': self.started, 'wall_seconds': time.time() - self.started,
+                      'latency_bucket_bounds': METRICSLATENCYBUCKETS,
+                      'endpoints': json.loads(json.dumps(self.endpoints)), 'records': json.loads(json.dumps(self.records))}
+        if ratescheduler is not None:
+            remaining = ratescheduler.remaining()
+            report['budget_remaining'] = {'15min': remaining[0], 'daily': remaining[1]}
+        report.update(extra)
+        return report
+
+    def writejson(self, filename, report):
+        tmpfile = filename + '.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump(report, f, indent=1)
+        os.replace(tmpfile, filename)
+
+    # prometheus text exposition format, for the node exporter's textfile collector
+    def writeprometheus(self, filename, report):
+        lines = []
+        def metric(name, kind, helptext, samples):
+            lines.append('# HELP strava_export_%s %s'%(name, helptext))
+            lines.append('# TYPE strava_export_%s %s'%(name, kind))
+            for labels, value in samples:
+                labeltext = ','.join('%s="%s"'%(k, v) for k, v in labels)
+                lines.append('strava_export_%s%s %s'%(name, '{%s}'%labeltext if labeltext else '', repr(float(value))))
+        endpoints = sorted(report['endpoints'].items())
+        metric('requests_total', 'counter', 'API requests by endpoint and http status (None: connection error)',
+               [((('endpoint', name), ('status', status)), count)
+                for name, counters in endpoints for status, count in sorted(counters['status'].items())])
+        for key, helptext in [('cache_hits', 'responses served from the response cache'),
+                              ('retries', 'requests retried'), ('rate_limited', 'requests answered 429'),
+                              ('bytes_received', 'response body bytes received, decompressed'),
+                              ('rate_wait_seconds', 'seconds spent waiting for the rate budget')]:
+            metric('%s_total'%key, 'counter', helptext, [((('endpoint', name),), counters[key]) for name, counters in endpoints])
+        lines.append('# HELP strava_export_request_latency_seconds API request latency')
+        lines.append('# TYPE strava_export_request_latency_seconds histogram')
+        for name, counters in endpoints:
+            cumulative = 0
+            for bound, count in zip(METRICSLATENCYBUCKETS + ['+Inf'], counters['latency_buckets']):
+                cumulative += count
+                lines.append('strava_export_request_latency_seconds_bucket{endpoint="%s",le="%s"} %d'%(name, bound, cumulative))
+            lines.append('strava_export_request_latency_seconds_sum{endpoint="%s"} %r'%(name, counters['latency_seconds']))
+            lines.append('strava_export_request_latency_seconds_count{endpoint="%s"} %d'%(name, counters['requests']))
+        records = sorted(report['records'].items())
+        metric('rows_total', 'counter', 'records written by record type', [((('record_type', k),), v['rows']) for k, v in records])
+        metric('format_seconds_total', 'counter', 'seconds spent formatting records into the output',
+               [((('record_type', k),), v['seconds']) for k, v in records])
+        if 'budget_remaining' in report:
+            metric('budget_remaining', 'gauge', 'requests left in the strava rate windows',
+                   [((('window', k),), v) for k, v in sorted(report['budget_remaining'].items())])
+        metric('wall_seconds', 'gauge', 'duration of the export run', [((), report['wall_seconds'])])
+        tmpfile = filename + '.tmp'
+        with open(tmpfile, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmpfile, filename)
+
+
 # Strava API class construct requests, invoke web transaction, decode responses and display data in .CSV usable lines output
 # 
 # Class is fully working prototype. all the output converter functions should either be moved into this class, 
 #  or they should be replaced with more efficient/ integral python converters
 class StravaCSVgenerator:
-    def __init__(self, stravaaccesstoken, redirectionfile=None):
+    def __init__(self, stravaaccesstoken, redirectionfile=None, ratescheduler=None, httppoolsize=HTTPPOOLSIZE,
+                 responsecache=None, apibase=STRAVAAPIBASE, streamstore=None, tokenstore=None, metrics=None,
+                 archive=None):
         if not stravaaccesstoken:
             return False  #mandatory! 
             #accesstoken = StravaAPIauthenticator()
             #self.stravaapipost() # an already authenticated athlete accesstoken
-        self.requestcounterper15min = 0 # we'll track requests per 15 minutes strava limit is 600 & per day limit is 30,000
-        self.requestcounterper24hr = 0
-        self.base15mins = None # put in a base time
+        # we'll track requests per 15 minutes strava limit is 600 & per day limit is 30,000.
+        # pass in a scheduler to share one budget between several generator instances
+        self.ratescheduler = ratescheduler if ratescheduler else StravaRateScheduler()
+        self.responsecache = responsecache # optional StravaResponseCache
+        self.streamstore = streamstore # optional StravaStreamStore; bundles then fetch the activity streams too
+        self.tokenstore = tokenstore # optional StravaTokenStore; its current token goes on every request
+        self.metrics = metrics if metrics else StravaMetrics()
+        self.archive = archive # optional StravaResponseArchive; every response body goes in as it came
         self.accesstoken = stravaaccesstoken
+        self.apibase = apibase
+        # one pooled keep-alive session (Authorization header included) shared by all fetch workers
+        self.session = mghttpsession(max(httppoolsize, FETCHWORKERS), stravaaccesstoken)
         self.activity_response = None
         self.activity_ids = []
+        self.listed_ids = set() # every id of the last listing; a full listing tells the rollups what was deleted
+        self.listed_athlete = None # the athlete the listing belongs to, from its summaries
         self.athlete_response = None
         self.redirectionfile = redirectionfile
         pass
 
     # make a generic STRAVA web API request for any given STRAVA api function
     # All requests require an **already-authenticated** strava.com access token in this instance
-    def stravaapirequest(self, request_url, maxretries=20, retrydelay=30):
+    # every request is paced by the rate scheduler; a 429 waits for the next rate window instead of polling,
+    # server errors and dropped connections back off from retrydelay seconds, other 4xx errors are not retried.
+    # with a token store a 401 (token expired or revoked mid-run) refreshes the token and retries the request
+    # cachekey=(endpoint, key) serves the request from the response cache when it holds a fresh copy.
+    # with an archive every response body is archived as received (keyed by the cachekey, else the url).
+    # endpoint names the request in the metrics (the cachekey endpoint when there is one)
+    def stravaapirequest(self, request_url, maxretries=20, retrydelay=2, cachekey=None, endpoint=None):
+        endpoint = endpoint if endpoint else (cachekey[0] if cachekey else 'other')
+        if self.responsecache and cachekey:
+            respdata = self.responsecache.get(*cachekey)
+            if respdata is not None:
+                self.metrics.cachehit(endpoint)
+                return True, respdata
+            if self.responsecache.offline:
+                return False, None
         for retrycount in range(maxretries):
-            # r.get is in the standard python request library
-            #print('url',request_url,'token',self.accesstoken)
-            request = r.get(request_url, 
-                             headers={'Authorization': 'Bearer %s'%self.accesstoken}) #access token is associated with athelete
-            respdata = request.json()
-            if request.status_code == 200:
-                return True, respdata  # return good response
+            if retrycount:
+                self.metrics.retry(endpoint, ratelimited=request is not None and request.status_code == 429)
+            waitstart = time.time()
+            issuedat = self.ratescheduler.acquire()
+            token = self.tokenstore.accesstoken if self.tokenstore is not None else None
+            try:
+                # the session carries the Authorization header; access token is associated with athelete
+                #print('url',request_url,'token',self.accesstoken)
+                if token:
+                    request = self.session.get(request_url, headers={'Authorization': 'Bearer %s'%token})
+                else:
+                    request = self.session.get(request_url)
+            except r.exceptions.RequestException as err:
+                print("API request error:", err, request_url)
+                request = None
+            latency = time.time() - issuedat
+            if request is None:
+                self.metrics.request(endpoint, latency, None, 0, issuedat - waitstart)
             else:
+                self.metrics.request(endpoint, latency, request.status_code, mgresponsebytes(request),
+                                     issuedat - waitstart)
+                self.ratescheduler.update(request.headers, issuedat)
+                # only a 200 body is parsed; a proxy's html error page or a truncated body is retried
+                body = request.content
+                parsed = False
+                if request.status_code == 200:
+                    try:
+                        respdata = mgjsonloads(body)
+                        parsed = True
+                    except ValueError:
+                        print("API response is not json:", request_url)
+                if self.archive is not None:
+                    self.archive.append(endpoint, cachekey[1] if cachekey else request_url, request.status_code, body,
+                                        parsed)
+                if parsed:
+                    if self.responsecache and cachekey:
+                        self.responsecache.put(cachekey[0], cachekey[1], body)
+                    return True, respdata  # return good response
                 print(request, request_url)
-                pass #print('failed',request)
-            if True :#self.redirectionfile != None:
-                print("API request failed; retrying... #", retrycount)
-            time.sleep(retrydelay)
+                if request.status_code == 429:
+                    self.ratescheduler.exhausted(issuedat)
+                    print("API rate limit reached; retrying in the next rate window... #", retrycount)
+                    continue
+                if request.status_code == 401 and token and self.tokenstore.renew(token):
+                    print("API access token renewed; retrying... #", retrycount)
+                    continue
+                if 400 <= request.status_code < 500:
+                    return False, None # not found, unauthorized... retrying won't help
+            delay = min(retrydelay * 2**retrycount, 60)
+            print("API request failed; retrying in %d seconds... #%d"%(delay, retrycount))
+            time.sleep(delay)
         return False, None #retry count expired without success
 
     # the STRAVA Get List of Activities request. gets all activities for the authenticated Athlete
-    def strava_getactivities(self):        
+    # after= (epoch seconds) limits the listing to activities that started later; used by incremental sync
+    def strava_getactivities(self, after=None):        
+        for activityid in self.strava_iteractivities(after):
+            self.activity_ids.append(activityid)
+        return self.activity_ids
+
+    # first stage of the streaming pipeline: yield activity IDs page by page as the listing arrives, so detail
+    # requests can start on page 1 while later pages are still being listed. activity_listok is False if a page failed
+    def strava_iteractivities(self, after=None):
+        for summary in self.strava_itersummaries(after):
+            yield summary['id']
+
+    # summary-only mode: the listing summaries stand in for the detail responses, as bundles shaped like
+    # strava_activitybundle's (no kudos or comments) so they go through the same output loop
+    def strava_summarybundles(self, after=None, skip_ids=()):
+        for summary in self.strava_itersummaries(after):
+            if summary['id'] not in skip_ids:
+                yield summary['id'], (True, None, summary, None, None)
+
+    # the activity listing one summary (dict) at a time. a full listing fetches its pages concurrently when
+    # LISTWORKERS > 1; an after= listing (incremental sync) is usually a single page and stays sequential
+    def strava_itersummaries(self, after=None, listworkers=None):
+        listworkers = LISTWORKERS if listworkers is None else listworkers
+        self.listed_ids = set()
+        self.listed_athlete = None
+        if after is None and listworkers > 1:
+            for summary in self.strava_prefetchsummaries(listworkers):
+                self.listed_ids.add(summary['id'])
+                self.listed_athlete = (summary.get('athlete') or {}).get('id', self.listed_athlete)
+                yield summary
+            return
         page = 1
+        aftertag = '' if after is None else '&after=%d'%after
+        self.activity_listok = True
         while True:   
             # get page of activities from Strava
-            stat,respdata = self.stravaapirequest(
-                request_url="https://www.strava.com/api/v3/athlete/activities?per_page=199&page="+str(page))
-                # "Authorization: Bearer [[access_token['access_token']]]"    
-                #request_header={'Authorization': 'Bearer %s'%self.accesstoken },
-                #maxretries=10, retrydelay=30 )
+            stat,respdata = self.strava_listpage(page, aftertag)
+            if not stat:
+                self.activity_listok = False
+                break
             rlen = len(respdata)
             if not rlen:
                 break 
-            # build a list of activity IDs
-            for activityid in respdata:
-                self.activity_ids.append(activityid['id'])
+            for summary in respdata:
+                self.listed_ids.add(summary['id'])
+                self.listed_athlete = (summary.get('athlete') or {}).get('id', self.listed_athlete)
+                yield summary
             #self.activities_response.append(respdata)
             page += 1
         self.activity_pages = page
-        return self.activity_ids
         # r = requests.get(url + '?' + access_token + '&per_page=50' + '&page=' + str(page))
 
+    # one page of the activity listing. both listing paths page and cache the same way, so changing LISTWORKERS
+    # still finds the cached pages
+    def strava_listpage(self, page, aftertag=''):
+        query = 'per_page=%d&page=%d%s'%(LISTPAGESIZE, page, aftertag)
+        return self.stravaapirequest(request_url=self.apibase+"/athlete/activities?"+query, cachekey=('list', query))
+
+    # rough activity count from the athlete stats. strava only counts rides, runs and swims there, so it is a lower
+    # bound; None when the athlete or stats request fails
+    def strava_estimateactivities(self):
+        stat, athlete = self.stravaathleterequest()
+        if not stat:
+            return None
+        stat, stats = self.stravastatsrequest(athlete['id'])
+        if not stat:
+            return None
+        return sum((stats.get('all_%s_totals'%i) or {}).get('count', 0) for i in ['ride', 'run', 'swim'])
+
+    # concurrent listing: pages of LISTPAGESIZE are requested 'workers' at a time from the shared rate
+    # budget, up to the page count estimated from the athlete stats, then in further batches of 'workers' pages
+    # while pages keep coming back full. the pages go through a reorder window (like strava_fetchbundles) so the
+    # summaries come out in listing order, and an id seen on an earlier page is dropped (an upload during the
+    # listing shifts every later page by one)
+    def strava_prefetchsummaries(self, workers=LISTWORKERS):
+        self.activity_listok = True
+        estimate = self.strava_estimateactivities()
+        lastpage = (estimate or 0)//LISTPAGESIZE + 1 # pages submitted without waiting for a short one
+        seen = set()
+        reorderwindow = collections.deque()
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        nextpage = 1
+        try:
+            while True:
+                while len(reorderwindow) < workers*2 and (nextpage <= lastpage or not reorderwindow):
+                    if nextpage > lastpage:
+                        lastpage += workers # past the estimate and the last page was full: another batch
+                    reorderwindow.append(pool.submit(self.strava_listpage, nextpage))
+                    nextpage += 1
+                stat, respdata = reorderwindow.popleft().result()
+                if not stat:
+                    self.activity_listok = False
+                    break
+                for summary in respdata:
+                    if summary['id'] not in seen:
+                        seen.add(summary['id'])
+                        yield summary
+                if len(respdata) < LISTPAGESIZE:
+                    break # the last page
+        finally:
+            for future in reorderwindow:
+                future.cancel()
+            pool.shutdown(wait=True)
+        self.activity_pages = nextpage - 1
+
     # the STRAVA Get Activity Detail by ID request for currently authenticated athlete
     def strava_activityrequest(self, activity_n):
         stat,respdata = self.stravaapirequest(
-                request_url="https://www.strava.com/api/v3/activities/%d?include_all_efforts="%activity_n)
+                request_url=self.apibase+"/activities/%d?include_all_efforts="%activity_n,
+                cachekey=('activity', activity_n))
                 # "Authorization: Bearer [[access_token['access_token']]]"    
                 #request_header={'Authorization': 'Bearer %s'%self.accesstoken },
                 #maxretries=10, retrydelay=30 )
@@ -303,7 +1576,7 @@ class StravaCSVgenerator:
 
     # Strava API Get Athlete info for currently authenticated athlete
     def stravaathleterequest(self):
-        stat,respdata = self.stravaapirequest( request_url = "https://www.strava.com/api/v3/athlete")
+        stat,respdata = self.stravaapirequest( request_url = self.apibase+"/athlete", endpoint='athlete')
         #header = {'Authorization': 'Bearer %s'%self.accesstoken }
         #self.athlete_response = r.get(url, headers=header).json()
         #return self.athlete_response
@@ -311,7 +1584,15 @@ class StravaCSVgenerator:
             self.athlete_response = respdata
         else:
             self.athlete_response= None
-        return stat, self.aathlete_response
+        return stat, self.athlete_response
+
+    # STRAVA API Get Athlete Stats: activity counts and totals (ride, run and swim only) for the athlete
+    def stravastatsrequest(self, athlete_id):
+        stat,respdata = self.stravaapirequest(request_url=self.apibase+"/athletes/%d/stats"%athlete_id, endpoint='stats')
+        if stat:
+            return True, respdata
+        else:
+            return False, None
 
     # STRAVA API Get kudos By-Activity_ID
     def stravakudorequest(self, activity_n):
@@ -321,7 +1602,7 @@ class StravaCSVgenerator:
         self.activity_kudo_response = r.get(url, headers=header).json()
         '''
         stat,respdata = self.stravaapirequest(
-                request_url="https://www.strava.com/api/v3/activities/%d/kudos"%activity_n) 
+                request_url=self.apibase+"/activities/%d/kudos"%activity_n, cachekey=('kudos', activity_n)) 
         if stat:
             self.activity_kudo_response = respdata
             return True, self.activity_kudo_response
@@ -331,16 +1612,83 @@ class StravaCSVgenerator:
     # STRAVA API Get Comments By-Activity_ID
     def stravacommentrequest(self,activity_n):
         stat,respdata = self.stravaapirequest(
-                request_url = "https://www.strava.com/api/v3/activities/%d/comments"%activity_n)
+                request_url = self.apibase+"/activities/%d/comments"%activity_n, cachekey=('comments', activity_n))
         if stat:
             self.activity_comment_response = respdata
             return True, self.activity_comment_response
         else:
             return False, None
 
+    # STRAVA API Get Activity Streams By-Activity_ID; keys selects the channels, key_by_type returns {type: stream}
+    def stravastreamsrequest(self, activity_n, keys=STREAMKEYS):
+        stat,respdata = self.stravaapirequest(
+                request_url=self.apibase+"/activities/%d/streams?keys=%s&key_by_type=true"%(activity_n, ','.join(keys)),
+                cachekey=('streams', '%d:%s'%(activity_n, ','.join(keys))))
+        if stat:
+            return True, respdata
+        else:
+            return False, None
+
+    # fetch one activity detail plus its kudos and comments (only when the counts say there are any).
+    # with a stream store the streams of recorded (non manual) activities are fetched and stored here as well,
+    # so the big sample arrays never travel through the reorder window.
+    # returns (stat, failed request name, activity, kudos, comments); safe to call from fetch worker threads
+    def strava_activitybundle(self, activity_n):
+        stat, respdata_activity = self.strava_activityrequest(activity_n)
+        if not stat:
+            return False, 'GetActivities', None, None, None
+        respdata_kudos = None
+        if respdata_activity['kudos_count'] > 0:
+            stat, respdata_kudos = self.stravakudorequest(activity_n)
+            if not stat:
+                return False, 'GetKudos', respdata_activity, None, None
+        respdata_comments = None
+        if respdata_activity['comment_count'] > 0:
+            stat, respdata_comments = self.stravacommentrequest(activity_n)
+            if not stat:
+                return False, 'Get Comments', respdata_activity, respdata_kudos, None
+        if self.streamstore is not None and not respdata_activity.get('manual') and activity_n not in self.streamstore:
+            stat, respdata_streams = self.stravastreamsrequest(activity_n, self.streamstore.keys)
+            if not stat:
+                return False, 'GetStreams', respdata_activity, respdata_kudos, respdata_comments
+            self.streamstore.put(activity_n, respdata_streams)
+        if RECORDSLOTS:
+            # only the records are kept from here on (reorder window, geometry batches, output)
+            return (True, None) + mgbundleslotted(respdata_activity, respdata_kudos, respdata_comments)
+        return True, None, respdata_activity, respdata_kudos, respdata_comments
+
+    # iterate the activity ids and yield (activity_n, bundle) in the original order while up to 'workers'
+    # bundles are fetched concurrently. finished bundles wait in the reorder window (a queue of futures in
+    # submission order) until every earlier activity has been yielded, so output rows keep the listing order
+    def strava_fetchbundles(self, activity_ids, workers=FETCHWORKERS):
+        if workers <= 1:
+            for activity_n in activity_ids:
+                yield activity_n, self.strava_activitybundle(activity_n)
+            return
+        reorderwindow = collections.deque()
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        try:
+            for activity_n in activity_ids:
+                reorderwindow.append((activity_n, pool.submit(self.strava_activitybundle, activity_n)))
+                # keep a couple of bundles per worker queued so no worker sits idle behind a slow activity
+                if len(reorderwindow) >= workers*2:
+                    nextid, future = reorderwindow.popleft()
+                    yield nextid, future.result()
+            while reorderwindow:
+                nextid, future = reorderwindow.popleft()
+                yield nextid, future.result()
+        finally:
+            # the caller may stop early (failed request); don't start anything still queued
+            for nextid, future in reorderwindow:
+                future.cancel()
+            pool.shutdown(wait=True)
+
 #
 # all the output converters for various Strava distance, time, text, GPS, elevation, speed, etc...
 #
+METERSPERMILE=1609.34
+FEETPERMETER = 3.2808399 
+
 def mgintout(key,val,idval=0):
     try:
         if val==None:
@@ -350,36 +1698,51 @@ def mgintout(key,val,idval=0):
         return 'mgint fail!  %s:%d'%(key,idval)
 
 # return a distance string from a value
-# Strava defaults to meters. converter defaults to MILES, use stdunits=False to get metric output
-def mgdistanceout(key,val,idval=0,stdunits=True):
+# Strava defaults to meters. converter defaults to MILES (STDUNITS), use stdunits=False to get metric output
+def mgdistanceout(key,val,idval=0,stdunits=None):
     try:
         if val==None:
             return ''
-        METERSPERMILE=1609.34
         divisor=1
-        if stdunits:
+        if STDUNITS if stdunits is None else stdunits:
             divisor = METERSPERMILE
         return '%5.2f'%(val/divisor)
     except:
         return 'mgfloatmiles fail! %s:%d'%(key,idval)
 
-# default Strava data is Meters. this converter defaults to FEET, stdunits=False to get metric output
-def mgelevationout(key,val,idval=0,stdunits=True):
+# default Strava data is Meters. this converter defaults to FEET (STDUNITS), stdunits=False to get metric output
+def mgelevationout(key,val,idval=0,stdunits=None):
     try:
         if val==None:
             return ''
-        FEETPERMETER = 3.2808399 
         multiplier=1
-        if stdunits:
-            multipler = FEETPERMETER
+        if STDUNITS if stdunits is None else stdunits:
+            multiplier = FEETPERMETER
         return '%5.2f'%(val*multiplier)
     except:
         return 'mgelevationout fail!  %s:%d'%(key,idval)
+
+# return a grade string; segment grades are percentages, written as they are whatever the units
+def mggradeout(key,val,idval=0):
+    try:
+        if val==None:
+            return ''
+        return '%5.2f'%val
+    except:
+        return 'mggradeout fail!  %s:%d'%(key,idval)
     
 # return a speed string from value
-# default strava data is meters/second.  this decoder default converts that to Miles/Hr, stdunits=False to get metric output
-def mgspeedout(key,val,idval=0):
-    return mgdistanceout(key,val*3600)
+# default strava data is meters/second.  this decoder default converts that to Miles/Hr (STDUNITS), stdunits=False
+# keeps meters/second
+def mgspeedout(key,val,idval=0,stdunits=None):
+    if val==None:
+        return ''
+    if not (STDUNITS if stdunits is None else stdunits):
+        return mgdistanceout(key,val,idval,False)
+    try:
+        return mgdistanceout(key,val*3600,idval,True)
+    except:
+        return 'mgspeedout fail!  %s:%d'%(key,idval)
 
 # return minutes value from value
 # Strava data defaults to seconds. converter defaults to MINUTES
@@ -537,8 +1900,8 @@ segmentkeys = {
     'athlete': mgotherout, # dummy data for athlete id/resource state
     'activity_type': mgtextout,#: 'Run':
     'distance': mgdistanceout,#: 3222.7,
-    'average_grade': mgelevationout,#: 0.0, 
-    'maximum_grade': mgelevationout,#: 3.5, 
+    'average_grade': mggradeout,#: 0.0, 
+    'maximum_grade': mggradeout,#: 3.5, 
     'elevation_high': mgelevationout,#: 4.9,
     'elevation_low': mgelevationout,#: 1.1,
     'start_latlng': mgfloatlist,#: [37.81062, -122.261604],
@@ -601,6 +1964,13 @@ segmenteffortkeys = {
     'hidden':mgboolout #: False},
     }
 
+# the segment effort template for the segment table mode (SEGMENTTABLE): the segment's columns are replaced by its id
+SegmentEffortRefKeys = [(key, conv) if key != 'segment' else ('segment_id', mgintout)
+                        for key, conv in segmenteffortkeys.items()]
+
+# the template of the segment table rows: the segment keys with the segment id first
+SegmentTableKeys = [('id', mgintout)] + list(segmentkeys.items())
+
 # algorithmically decode and generate rows for a list of SegmentEfforts (segmenteffort is wrapper of Segment)
 def mgsegmenteffortsout(key,segmentsdb,activityid=0, gethdrrow=False):
     # the csv headings for the SegmentEfforts records
@@ -613,10 +1983,10 @@ def mgsegmenteffortsout(key,segmentsdb,activityid=0, gethdrrow=False):
             retstr += istr+','
         return [retstr]
     # the csv data row for a lap 
+    return list(mgsegmenteffortsiter(key,segmentsdb,activityid))
 
-    segstrs = []
-    retstr = '\"Segment_effort: %d segments\"'%len(segmentsdb)
-    #print(retstr)
+# generate the SegmentEffort rows one at a time (streaming pipeline); mgsegmenteffortsout collects them in a list
+def mgsegmenteffortsiter(key,segmentsdb,activityid=0):
     for segs in segmentsdb:
         #for i in segmentsdb:
             segeffstr = '%d,Segment,'%activityid  #+ (','*69) # add the commas to offset to align with segment header
@@ -631,10 +2001,7 @@ def mgsegmenteffortsout(key,segmentsdb,activityid=0, gethdrrow=False):
                 #print(j[0],retstr)
                 segeffstr =segeffstr+ segretstr + ','
                 #separatorstr = ','
-            segstrs.append(segeffstr)
-    #for sstr in segstrs:
-    #    print(sstr)
-    return segstrs
+            yield segeffstr
 
 # template for the SPLIT data inputs
 Splitinfokey = {   # both _metric and _standard {'distance', #: 1000.3, 'elapsed_time', #: 1164, 'elevation_difference', #: 4.8, 'moving_time', #: 803, 'split', #: 2, 'average_speed', #: 1.25, 'pace_zone', #: 0}, {'distance', #: 998.4, 'elapsed_time', #: 1168, 'elevation_difference', #: 0.1, 'moving_time', #: 837, 'split', #: 3, 'average_speed', #: 1.19, 'pace_zone', #: 0}, {'distance', #: 1001.3, 'elapsed_time', #: 1662, 'elevation_difference', #: -14.0, 'moving_time', #: 861, 'split', #: 4, 'average_speed', #: 1.16, 'pace_zone', #: 0}, {'distance', #: 329.9, 'elapsed_time', #: 414, 'elevation_difference', #: 0.3, 'moving_time', #: 278, 'split', #: 5, 'average_speed', #: 1.19, 'pace_zone', #: 0}], 
@@ -684,7 +2051,11 @@ def  mgsplitsout(key,splitsdb,activ_id=0, gethdrrow=False):
             retstr += i+','
         return [retstr]
     # the csv data row for a lap 
-    splitstrs = []
+    return list(mgsplitsiter(key,splitsdb,activ_id))
+    #return retstr, hdrstr, segstrs 
+
+# generate the SPLITS rows one at a time (streaming pipeline)
+def mgsplitsiter(key,splitsdb,activ_id=0):
     for eachsplit in splitsdb:
         mystr = ''
         separatorstr = ','
@@ -695,9 +2066,7 @@ def  mgsplitsout(key,splitsdb,activ_id=0, gethdrrow=False):
                 argval = eachsplit[i]
             mystr = mystr+ Splitinfokey[i](i,argval) + separatorstr
             separatorstr = ','
-        splitstrs.append('%d,%s,%s'%(activ_id,key,mystr))
-    return splitstrs
-    #return retstr, hdrstr, segstrs 
+        yield '%d,%s,%s'%(activ_id,key,mystr)
 
 # algorithmically decode and generate rows for a list of LAPS
 def  mglapsout(key,lapsdb,activ_id=0, gethdrrow=False):
@@ -708,7 +2077,10 @@ def  mglapsout(key,lapsdb,activ_id=0, gethdrrow=False):
             retstr += i+','
         return [retstr]
     # the csv data row for a lap 
-    lapstrs = []
+    return list(mglapsiter(key,lapsdb,activ_id))
+
+# generate the LAPS rows one at a time (streaming pipeline)
+def mglapsiter(key,lapsdb,activ_id=0):
     for eachlap in lapsdb:
         mystr = ''
         separatorstr = ','
@@ -719,8 +2091,7 @@ def  mglapsout(key,lapsdb,activ_id=0, gethdrrow=False):
                 argval = eachlap[i]
             mystr = mystr+ Lapinfokey[i](i,argval) + separatorstr
             separatorstr = ','
-        lapstrs.append('%d,%s,%s'%(activ_id,key,mystr))
-    return lapstrs
+        yield '%d,%s,%s'%(activ_id,key,mystr)
 
 # convert a summary line of laps data
 def  mglenout(key,lapsdb,activ_id=0):
@@ -769,7 +2140,7 @@ ActivityInfoKeys = [('resource_state', mgintout), #:3
     ('private', mgboolout), #: False, 
     ('visibility', mgtextout), #: 'everyone',
     ('flagged', mgintout), #: False, 
-    ('gear_id', mgintout), #: None,
+    ('gear_id', mgtextout), #: None, or 'b1234567' for a bike
     ('from_accepted_tag', mgintout), #: False,
     ('upload_id_str', mgtextout), #:'2606342610',
     ('average_speed', mgspeedout), #: 1.213,
@@ -822,6 +2193,17 @@ Mapinfokeys = [
     #'o_d~EnjggVAQ@_@HGY]e@{@IKEAECWk@IUa@m@i@SIGEAEBAGQKGMQu@OqA?c@Fq@@{@EOOYCOLi@\\o@b@kAx@wBTc@`@m@HWp@kAZ]NGBERe@@WJ[`@e@NUv@y@Hy@LUZw@JADFJEJDLGJBFHFAl@i@zA_Af@_@d@Sl@OAEDM?OAGWWm@]s@WiBeAYMOOOICCAOUUOHCFIVGJMB[Ac@HM?Yb@?PE^CFQDADKt@@LGTP\\NN@HALGVOPGJEZC^KPE@Gf@?TBl@R|@LL@HWj@SVKVORQf@e@~@_@j@_@bACDMKWb@NJMPG\\MZaAzBSx@MPQj@Ud@AY_@u@G_@}A|@m@XSDk@ZkB`@CTBTC`@D\\FRCFOAK@K`@BC?GOQYIi@BKBY@c@Ci@W_A@a@CIDBKEEOCAFIHELE@G^w@x@E`@EBOVDVEb@CHONWFANKZy@jBSXk@d@GJCRYPGJBLD@LSGPIHJHGR@FAFORQb@AHB^AFHJNb@VVb@t@BNA`@V\\`@\\TZj@hBPnACJH\\^VRTD?HILA@L@OE@ENFRFFDAAFBBZTJ@PHDENHfAz@PT`@VBDALBBBLITFEH[BFVJ`@T@D?F@FAFOTkAn@MD[@YH?F@GEGG?KFc@h@EVUv@EV?NCXMr@_@`AShAMZIn@Kb@C`@K\\Al@@ZDPARED?FD\\BDD?KJK?GBIVIHGNHJ?GBDD\\JL\\TARPD'}, 
     ]
 
+# template for the columns derived from the decoded map polyline (see mgmapgeometry); appended to the Activity
+# rows when EXPORTMAPGEOMETRY is True
+MapGeometryKeys = [
+    ('map_points', mgintout), # points in the decoded route
+    ('map_distance', mgdistanceout), # haversine length of the route
+    ('map_minlat', mgfloatout), # bounding box
+    ('map_maxlat', mgfloatout),
+    ('map_minlng', mgfloatout),
+    ('map_maxlng', mgfloatout),
+    ]
+
 # template (placeholder!) for PHOTO data item
 Photoinfokeys = [
     'primary', # None
@@ -862,104 +2244,1122 @@ def StravaActivityOut(key, resp, acti_id=0, gethdrrow=False, ):
         retstr = i[1](i[0],resp[i[0]], acti_id)            
         mystr +=  retstr+','
     return mystr
-  
+
+#
+# compiled row formatters. each template is compiled once into a specialized python function that looks up every
+# field with a single dict.get, calls its converter directly and returns the row as one list of field strings for
+# csv.writer (which does the quoting). the legacy string builders above are kept as-is for existing callers
+#
+
+# csv.writer quotes fields itself, so the converters that wrap their output in quotes are swapped for plain versions
+def mgfloatlistraw(key,val,idval=0):
+    try:
+        if val==None:
+            return ''
+        return '[%s]'%','.join(['%5.2f'%i for i in val])
+    except:
+        return 'mgfloatlist fail!  %s:%d'%(key,idval)
+
+def mglenraw(key,lapsdb,activ_id=0):
+    try:
+        return '%s: %d items'%(key,len(lapsdb))
+    except:
+        return "%s/lenerr"%key
+
+MGCSVCONVERTERS = {mgqtextout:mgtextout, mgfloatlist:mgfloatlistraw, mglenout:mglenraw}
+
+_MGMISSING = object() # marks a key absent from the record
+
+# templates are either [(key, converter)...] lists or {key: converter} dicts
+def mgtemplateitems(template):
+    return list(template.items()) if isinstance(template, dict) else list(template)
+
+# compile a template into mgrow(rec, idval=0) -> [field strings]. the returned list always ends with an empty field,
+# matching the trailing comma of the legacy rows.
+#   missing: None passes None to the converter for absent keys (laps/splits behavior), otherwise the text written
+#            for an absent key; a %s in it is replaced by the key name
+#   nested: {converter: template} flattens a sub-record in place of the converter's column, e.g. the segment
+#           inside a segment effort, followed by an empty field where the legacy output had its extra comma
+#   profiler: an MGConverterProfiler; every converter is then called through its timing wrapper
+def mgcompiletemplate(template, missing=None, nested=None, converters=MGCSVCONVERTERS, profiler=None, rectype=''):
+    nested = nested if nested else {}
+    namespace = {'_M':_MGMISSING, '_EMPTY':{}}
+    body = []
+    fields = []
+    def newname(prefix):
+        name = '%s%d'%(prefix, len(namespace))
+        namespace[name] = None
+        return name
+    def compileitems(items, recname, missingtext, prefix=''):
+        for key, conv in items:
+            conv = converters.get(conv, conv)
+            value = newname('v')
+            if conv in nested:
+                body.append('    %s = %s.get(%r) or _EMPTY'%(value, recname, key))
+                compileitems(mgtemplateitems(nested[conv]), value, None, prefix + key + '.')
+                fields.append("''")
+                continue
+            func = newname('c')
+            namespace[func] = profiler.wrap(rectype, prefix + key, conv) if profiler else conv
+            if missingtext is None:
+                fields.append('%s(%r, %s.get(%r), idval)'%(func, key, recname, key))
+            else:
+                text = missingtext%key if '%s' in missingtext else missingtext
+                body.append('    %s = %s.get(%r, _M)'%(value, recname, key))
+                fields.append('(%r if %s is _M else %s(%r, %s, idval))'%(text, value, func, key, value))
+    compileitems(mgtemplateitems(template), 'rec', missing)
+    fields.append("''")
+    source = 'def mgrow(rec, idval=0):\n%s\n    return [%s]\n'%('\n'.join(body), ',\n        '.join(fields))
+    exec(compile(source, '<mgcompiletemplate>', 'exec'), namespace)
+    mgrow = namespace['mgrow']
+    mgrow.source = source
+    return mgrow
+
+# the column names for a compiled template, in the same order as its rows
+def mgtemplateheader(template, nested=None):
+    nested = nested if nested else {}
+    names = []
+    for key, conv in mgtemplateitems(template):
+        if conv in nested:
+            names += mgtemplateheader(nested[conv])
+        names.append(key)
+    return names
+
+# per record type: (template, missing, nested, tag written in the record type column), for the given
+# SEGMENTTABLE, SUMMARYONLY and EXPORTMAPGEOMETRY settings. MGROWTEMPLATES is the set of the settings at import;
+# the export takes the set of the settings it runs with from mgrowsetup()
+def mgbuildrowtemplates(segmenttable, summaryonly, mapgeometry):
+    return {
+        'Activity': (ActivityInfoKeys + (MapGeometryKeys if mapgeometry else []), '' if summaryonly else '<nodata>',
+                     None, 'Activity'),
+        'laps': (Lapinfokey, None, None, 'laps'),
+        'segment_efforts': (SegmentEffortRefKeys, '<nodata: %s>', None, 'Segment') if segmenttable else
+                           (segmenteffortkeys, '<nodata: %s>', {mgsegmentout:segmentkeys}, 'Segment'),
+        'segment': (SegmentTableKeys, '', None, 'segment'),
+        'splits_metric': (Splitinfokey, None, None, 'splits_metric'),
+        'splits_standard': (Splitinfokey, None, None, 'splits_standard'),
+        'kudo': (commentathleteitem, '', None, 'kudo'),
+        'comment': (commentitem, '', {mgathleteout:commentathleteitem}, 'comment'),
+        }
+
+MGROWTEMPLATES = mgbuildrowtemplates(SEGMENTTABLE, SUMMARYONLY, EXPORTMAPGEOMETRY)
+
+# converter profiling. mgcompileformatters(profiler=...) compiles every field's converter call through wrap(), which
+# counts calls and perf_counter time per (record type, field, converter). nested fields show as 'segment.name'.
+# the timer adds roughly a call's worth of overhead to every field, so compare fields with each other rather than
+# with an unprofiled run. report() is the hot-field table, writecollapsed() the 'frame;frame;frame weight' lines
+# flamegraph.pl and speedscope read (weights in microseconds)
+class MGConverterProfiler:
+    def __init__(self):
+        self.stats = {} # (record type, field, converter name): [calls, seconds]
+
+    def wrap(self, rectype, field, conv):
+        counters = self.stats.setdefault((rectype, field, conv.__name__), [0, 0.0])
+        timer = time.perf_counter
+        def profiled(key, val, idval=0):
+            started = timer()
+            try:
+                return conv(key, val, idval)
+            finally:
+                counters[0] += 1
+                counters[1] += timer() - started
+        return profiled
+
+    # the hot fields (most time first) and the totals per converter, as text
+    def report(self, top=40):
+        total = sum(seconds for calls, seconds in self.stats.values()) or 1e-9
+        fields = sorted(self.stats.items(), key=lambda i: -i[1][1])
+        lines = ['%-16s %-36s %-14s %10s %10s %9s %6s'%('record', 'field', 'converter', 'calls', 'seconds', 'us/call', 'share')]
+        for (rectype, field, convname), (calls, seconds) in fields[:top]:
+            lines.append('%-16s %-36s %-14s %10d %10.4f %9.2f %5.1f%%'%(rectype, field, convname, calls, seconds,
+                         1e6*seconds/calls if calls else 0, 100*seconds/total))
+        byconverter = {}
+        for (rectype, field, convname), (calls, seconds) in self.stats.items():
+            counters = byconverter.setdefault(convname, [0, 0.0])
+            counters[0] += calls
+            counters[1] += seconds
+        lines.append('')
+        lines.append('%-14s %10s %10s %9s %6s'%('converter', 'calls', 'seconds', 'us/call', 'share'))
+        for convname, (calls, seconds) in sorted(byconverter.items(), key=lambda i: -i[1][1]):
+            lines.append('%-14s %10d %10.4f %9.2f %5.1f%%'%(convname, calls, seconds, 1e6*seconds/calls if calls else 0,
+                                                           100*seconds/total))
+        return '\n'.join(lines) + '\n'
+
+    def writecollapsed(self, filename):
+        with open(filename, 'w') as f:
+            for (rectype, field, convname), (calls, seconds) in sorted(self.stats.items()):
+                if calls:
+                    f.write('%s;%s;%s %d\n'%(rectype, field.replace('.', ';'), convname, max(1, round(seconds*1e6))))
+
+
+# compile every record type once; returns {record type: row function}. the templates default to the current settings'
+def mgcompileformatters(rowtemplates=None, profiler=None):
+    rowtemplates = rowtemplates if rowtemplates else mgrowtemplates()
+    formatters = {}
+    for rectype, (template, missing, nested, tag) in rowtemplates.items():
+        formatters[rectype] = mgcompiletemplate(template, missing, nested, profiler=profiler, rectype=rectype)
+    return formatters
+
+MGROWFORMATTERS = mgcompileformatters(MGROWTEMPLATES)
+
+# the csv header rows as field lists: Activity first, then the compound items
+def mgheaderrows(rowtemplates=None):
+    rowtemplates = rowtemplates if rowtemplates else mgrowtemplates()
+    rows = []
+    for rectype in ['Activity','laps'] + (['segment'] if SEGMENTTABLE else []) + ['segment_efforts','splits_metric','splits_standard']:
+        template, missing, nested, tag = rowtemplates[rectype]
+        rows.append(['0', '0-%s:header'%rectype] + mgtemplateheader(template, nested) + [''])
+    return rows
+
+# segment interning for the segment table mode. club riders and commuters repeat the same few local segments
+# hundreds of times, and the nested template writes the whole segment (name, place, lat/lng lists, grades, elevations)
+# on every effort row. the index keeps one segment per id: intern() points each effort at the shared segment, sets
+# its segment_id and returns the segments not written yet, which the caller writes once as 'segment' rows.
+# 'written' holds the ids written by earlier runs (the sync state's set, updated in place); takenew() hands the ids
+# written since the last call to the checkpoint journal
+class StravaSegmentIndex:
+    def __init__(self, written=None):
+        self.segments = {}
+        self.written = written if written is not None else set()
+        self.new = []
+
+    def intern(self, efforts):
+        segments = []
+        for effort in efforts:
+            segment = effort.get('segment')
+            if not segment or segment.get('id') is None:
+                continue
+            segment_id = segment['id']
+            effort['segment_id'] = segment_id
+            if segment_id in self.segments:
+                effort['segment'] = self.segments[segment_id]
+                continue
+            self.segments[segment_id] = segment
+            if segment_id not in self.written:
+                self.written.add(segment_id)
+                self.new.append(segment_id)
+                segments.append(segment)
+        return segments
+
+    def takenew(self):
+        new, self.new = self.new, []
+        return new
+
+    def __len__(self):
+        return len(self.segments)
+
+# walk one fetched activity bundle and yield (record type, record) for every item in output order;
+# the Activity itself, then laps, segment efforts, splits, kudos and comments. with a segmentindex (segment table
+# mode) the segments seen for the first time come right before the segment efforts
+def mgbundlerecords(activity_n, bundle, segmentindex=None):
+    stat, failedrequest, respdata_activity, respdata_kudos, respdata_comments = bundle
+    yield 'Activity', respdata_activity
+    # TBD add photos, maps, ...
+    for i in ['laps','segment_efforts','splits_metric','splits_standard']:
+        if i in respdata_activity:
+            if i == 'segment_efforts' and segmentindex is not None:
+                for segment in segmentindex.intern(respdata_activity[i]):
+                    yield 'segment', segment
+            for item in respdata_activity[i]:
+                yield i, item
+    if respdata_kudos is not None:
+        for kud in respdata_kudos:
+            yield 'kudo', kud
+    if respdata_comments is not None:
+        for comm in respdata_comments:
+            yield 'comment', comm
+
+# batch unit conversion for the compound records. a batch formatter takes all the laps (or splits, or segment efforts)
+# of an activity at once and works column by column: the distance, speed, elevation and minutes columns are scaled
+# in one numpy operation per column (a list comprehension for short columns or without numpy) and formatted with
+# one '%5.2f' string operation per column. the arithmetic is the same as the single value converters', so the rows
+# are identical to the per-record path
+MGUNITCOLUMNS = {mgdistanceout:'distance', mgspeedout:'speed', mgelevationout:'elevation', mgminsout:'minutes'}
+
+# scale a column of native strava values (meters, m/s, seconds) to the output units. numpy only pays off on longer
+# columns (a whole activity's splits); a handful of laps is scaled in a list comprehension
+MGNUMPYMINCOLUMN = 64
+
+def mgunitscale(kind, values, stdunits=None):
+    stdunits = STDUNITS if stdunits is None else stdunits
+    if np is not None and len(values) >= MGNUMPYMINCOLUMN:
+        column = np.array(values, dtype=np.float64)
+        if kind == 'minutes':
+            column = column/60.0
+        elif stdunits and kind == 'distance':
+            column = column/METERSPERMILE
+        elif stdunits and kind == 'speed':
+            column = column*3600/METERSPERMILE
+        elif stdunits and kind == 'elevation':
+            column = column*FEETPERMETER
+        return column.tolist()
+    if kind == 'minutes':
+        return [val/60.0 for val in values]
+    if stdunits and kind == 'distance':
+        return [val/METERSPERMILE for val in values]
+    if stdunits and kind == 'speed':
+        return [val*3600/METERSPERMILE for val in values]
+    if stdunits and kind == 'elevation':
+        return [val*FEETPERMETER for val in values]
+    return list(values)
+
+# format a whole column in one string operation
+def mgformatcolumn(values, fmt='%5.2f'):
+    if not values:
+        return []
+    return ((fmt + '\0')*len(values)%tuple(values)).split('\0')[:-1]
+
+# one unit column: the values (None or _MGMISSING where absent) scaled and formatted in bulk. a column holding
+# anything but numbers (sum() refuses None and strings) is done value by value with the converter, which gives the
+# missing text, '' or the converter's own fail text exactly as the single record path does
+def mgunitcolumn(kind, column, conv, key, idval, missingtext):
+    try:
+        sum(column)
+    except TypeError:
+        return [(missingtext if val is _MGMISSING else conv(key, val, idval)) for val in column]
+    return mgformatcolumn(mgunitscale(kind, column))
+
+# compile a template into mgrows(records, idval=0) -> [[field strings], ...]. the records are formatted column by
+# column: the unit columns in bulk (mgunitcolumn), every other field with its converter as in mgcompiletemplate,
+# and the columns are zipped into rows at the end. the rows equal mgcompiletemplate's row for each record
+def mgcompilebatch(template, missing=None, nested=None, converters=MGCSVCONVERTERS):
+    nested = nested if nested else {}
+    namespace = {'_M':_MGMISSING, '_EMPTY':{}, '_unitcolumn':mgunitcolumn, '_repeat':itertools.repeat}
+    body = []
+    columns = []
+    def newname(prefix):
+        name = '%s%d'%(prefix, len(namespace))
+        namespace[name] = None
+        return name
+    def compileitems(items, recsname, missingtext):
+        for key, conv in items:
+            conv = converters.get(conv, conv)
+            column = newname('col')
+            if conv in nested:
+                body.append('    %s = [rec.get(%r) or _EMPTY for rec in %s]'%(column, key, recsname))
+                compileitems(mgtemplateitems(nested[conv]), column, None)
+                columns.append("_repeat('')")
+                continue
+            func = newname('c')
+            namespace[func] = conv
+            text = None if missingtext is None else (missingtext%key if '%s' in missingtext else missingtext)
+            if conv in MGUNITCOLUMNS:
+                getter = 'rec.get(%r)'%key if text is None else 'rec.get(%r, _M)'%key
+                body.append('    %s = _unitcolumn(%r, [%s for rec in %s], %s, %r, idval, %r)'%(
+                    column, MGUNITCOLUMNS[conv], getter, recsname, func, key, text))
+            elif text is None:
+                body.append('    %s = [%s(%r, rec.get(%r), idval) for rec in %s]'%(column, func, key, key, recsname))
+            else:
+                body.append('    %s = [(%r if val is _M else %s(%r, val, idval)) for val in [rec.get(%r, _M) for rec in %s]]'%(
+                    column, text, func, key, key, recsname))
+            columns.append(column)
+    compileitems(mgtemplateitems(template), 'records', missing)
+    columns.append("_repeat('')")
+    source = 'def mgrows(records, idval=0):\n%s\n    return list(map(list, zip(%s)))\n'%('\n'.join(body), ', '.join(columns))
+    exec(compile(source, '<mgcompilebatch>', 'exec'), namespace)
+    mgrows = namespace['mgrows']
+    mgrows.source = source
+    return mgrows
+
+
+# the record types formatted in batch; the Activity, kudo and comment records stay one at a time. batches shorter
+# than MGBATCHMINROWS are formatted record by record too: on a handful of laps the column setup costs more than the
+# bulk conversion saves (measured ~1.4x faster than the per-record path on a 44 split activity, slower on 4 laps)
+MGBATCHTYPES = ['laps', 'segment_efforts', 'splits_metric', 'splits_standard']
+MGBATCHMINROWS = 16
+MGBATCHFORMATTERS = {rectype: mgcompilebatch(*MGROWTEMPLATES[rectype][:3]) for rectype in MGBATCHTYPES}
+
+# the templates depend on SEGMENTTABLE, SUMMARYONLY and EXPORTMAPGEOMETRY, which the command line, a harvest or a
+# test can set after import. the export looks them up when it runs, and each combination of the settings is built
+# and compiled once: (SEGMENTTABLE, SUMMARYONLY, EXPORTMAPGEOMETRY) -> (row templates, row formatters, batch formatters)
+MGROWSETUPS = {(SEGMENTTABLE, SUMMARYONLY, EXPORTMAPGEOMETRY): (MGROWTEMPLATES, MGROWFORMATTERS, MGBATCHFORMATTERS)}
+
+def mgrowsetup():
+    key = (SEGMENTTABLE, SUMMARYONLY, EXPORTMAPGEOMETRY)
+    if key not in MGROWSETUPS:
+        rowtemplates = mgbuildrowtemplates(*key)
+        MGROWSETUPS[key] = (rowtemplates, mgcompileformatters(rowtemplates),
+                            {rectype: mgcompilebatch(*rowtemplates[rectype][:3]) for rectype in MGBATCHTYPES})
+    return MGROWSETUPS[key]
+
+def mgrowtemplates():
+    return mgrowsetup()[0]
+
+# like mgbundlerecords, with the compound items of each type as one list: yields (record type, [records])
+def mgbundlebatches(activity_n, bundle, segmentindex=None):
+    stat, failedrequest, respdata_activity, respdata_kudos, respdata_comments = bundle
+    yield 'Activity', [respdata_activity]
+    for i in MGBATCHTYPES:
+        if respdata_activity.get(i):
+            if i == 'segment_efforts' and segmentindex is not None:
+                segments = segmentindex.intern(respdata_activity[i])
+                if segments:
+                    yield 'segment', segments
+            yield i, respdata_activity[i]
+    if respdata_kudos:
+        yield 'kudo', respdata_kudos
+    if respdata_comments:
+        yield 'comment', respdata_comments
+
+#
+# slotted records. a parsed detail response is a tree of dicts holding every key strava sends (the polyline, the
+# similar activities, the best efforts, the hide_from_home flags...), most of which no template writes, in a
+# ~1KB hash table per lap or split. with RECORDSLOTS each response is converted as soon as it is parsed into
+# __slots__ records generated from the row templates, holding only the template keys, and the dicts are dropped.
+# a record answers get(), [], in, keys() and iteration like the dict did, so the compiled formatters, the batch
+# formatters, mgmapgeometry and the columnar export work on either. an absent key stays an unset slot, so missing
+# fields still write their missing text
+#
+class MGRecord:
+    __slots__ = ()
+    _fields = frozenset()
+    _children = {} # key -> record class of the nested dict, or of each item of the nested list
+
+    def get(self, key, default=None):
+        if key in self._fields:
+            return getattr(self, key, default)
+        return default
+
+    def __getitem__(self, key):
+        if key in self._fields:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self._fields:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self._fields and hasattr(self, key)
+
+    def keys(self):
+        return [key for key in self.__slots__ if hasattr(self, key)]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return '%s(%s)'%(type(self).__name__, ', '.join('%s=%r'%item for item in self.items()))
+
+    # back to plain dicts and lists, e.g. for json.dumps
+    def todict(self):
+        respdata = {}
+        for key, value in self.items():
+            if isinstance(value, MGRecord):
+                value = value.todict()
+            elif isinstance(value, list) and key in self._children:
+                value = [i.todict() for i in value]
+            respdata[key] = value
+        return respdata
+
+    # convert a parsed response (dict) into a record; keys the template doesn't write are dropped. the small dicts
+    # kept as they are (the {'id', 'resource_state'} activity and athlete references on every lap and effort) are
+    # shared through 'shared' when equal, one copy per bundle instead of one per item
+    @classmethod
+    def fromdict(cls, respdata, shared=None):
+        rec = cls()
+        children = cls._children
+        for key in cls.__slots__:
+            if key in respdata:
+                value = respdata[key]
+                if key in children:
+                    if isinstance(value, list):
+                        value = [children[key].fromdict(i, shared) for i in value]
+                    elif isinstance(value, dict):
+                        value = children[key].fromdict(value, shared)
+                elif shared is not None and isinstance(value, dict):
+                    try:
+                        value = shared.setdefault(tuple(value.items()), value)
+                    except TypeError: # holds a list or dict
+                        pass
+                setattr(rec, key, value)
+        return rec
+
+# keys a record keeps beyond the ones its template writes: the segment id (its template column is commented out)
+MGRECORDEXTRAKEYS = {'segment': ['id', 'resource_state']}
+
+# generate the record class for a template. nested templates ({converter: template}) become child record classes
+# of the key using that converter; 'children' adds classes for keys holding lists of records
+def mgrecordclass(name, template, nested=None, children=None):
+    nested = nested if nested else {}
+    children = dict(children) if children else {}
+    keys = []
+    for key, conv in mgtemplateitems(template):
+        if conv in nested:
+            children[key] = mgrecordclass(key, nested[conv])
+        keys.append(key)
+    keys += [key for key in MGRECORDEXTRAKEYS.get(name, []) if key not in keys]
+    return type('MGRecord_%s'%name, (MGRecord,), {'__slots__': tuple(keys), '_fields': frozenset(keys),
+                                                   '_children': children})
+
+# record class per record type (segments are the segment efforts' child records). an Activity holds its laps, segment efforts and splits as lists of their records,
+# and always has the map geometry slots (mgmapgeometry fills them in)
+def mgrecordclasses(rowtemplates=MGROWTEMPLATES):
+    classes = {rectype: mgrecordclass(rectype, rowtemplates[rectype][0], rowtemplates[rectype][2])
+               for rectype in MGBATCHTYPES + ['kudo', 'comment']}
+    # a segment effort keeps its whole segment whichever template writes it; the segment table mode interns it
+    classes['segment_efforts'] = mgrecordclass('segment_efforts', mgtemplateitems(segmenteffortkeys) +
+                                               [('segment_id', mgintout)], {mgsegmentout:segmentkeys})
+    template = mgtemplateitems(rowtemplates['Activity'][0])
+    template += [item for item in MapGeometryKeys if item not in template]
+    classes['Activity'] = mgrecordclass('Activity', template, None, {rectype: classes[rectype] for rectype in MGBATCHTYPES})
+    return classes
+
+MGRECORDCLASSES = mgrecordclasses()
+
+# a fetched bundle's responses as records: (activity, kudos, comments)
+def mgbundleslotted(respdata_activity, respdata_kudos, respdata_comments, classes=MGRECORDCLASSES):
+    shared = {}
+    return (classes['Activity'].fromdict(respdata_activity, shared),
+            None if respdata_kudos is None else [classes['kudo'].fromdict(i, shared) for i in respdata_kudos],
+            None if respdata_comments is None else [classes['comment'].fromdict(i, shared) for i in respdata_comments])
+
+
+# the header row of a single record type csv (MG_OutputSink split by type)
+def mgtableheader(rectype, rowtemplates=None):
+    template, missing, nested, tag = (rowtemplates if rowtemplates else mgrowtemplates())[rectype]
+    return ['activity_id', 'record_type'] + mgtemplateheader(template, nested) + ['']
+
+# last stage of the streaming pipeline: yield (record type, csv row fields) for one fetched activity bundle as each
+# row is made
+def mgbundlerows(activity_n, bundle, formatters=None, segmentindex=None):
+    idstr = str(activity_n)
+    rowtemplates, rowformatters, batchformatters = mgrowsetup()
+    formatters = formatters if formatters else rowformatters
+    for rectype, record in mgbundlerecords(activity_n, bundle, segmentindex):
+        yield rectype, [idstr, rowtemplates[rectype][3]] + formatters[rectype](record, activity_n)
+
+#
+# columnar export. the same templates double as the table schemas: each converter maps to a typed column holding
+# the converted number (miles, minutes, mph...) rather than its '%5.2f' text. mgotherout style placeholders are dropped,
+# nested segments / comment athletes become prefixed columns
+#
+# converter -> (arrow type, value function); a function raising on bad input stores a null
+MGTYPEDCONVERTERS = {
+    mgintout: ('int64', int),
+    mgfloatout: ('float64', float),
+    mggradeout: ('float64', float),
+    mgdistanceout: ('float64', lambda val: val/METERSPERMILE if STDUNITS else float(val)),
+    mgelevationout: ('float64', lambda val: val*FEETPERMETER if STDUNITS else float(val)),
+    mgspeedout: ('float64', lambda val: val*3600/METERSPERMILE if STDUNITS else float(val)),
+    mgminsout: ('float64', lambda val: val/60.0),
+    mgfloatlist: ('list<float64>', lambda val: [float(i) for i in val]),
+    mgtextout: ('string', str),
+    mgqtextout: ('string', str),
+    mgboolout: ('bool', bool),
+    mglenout: ('int32', len),
+    }
+
+# record type -> table name
+MGCOLUMNARTABLES = {'Activity':'activities', 'laps':'laps', 'splits_metric':'splits_metric',
+                    'splits_standard':'splits_standard', 'segment_efforts':'segment_efforts',
+                    'kudo':'kudos', 'comment':'comments', 'segment':'segments'}
+
+# build the typed column list for a template: [(column name, arrow type, value function, (key, subkey))]
+def mgcolumnarschema(template, nested=None):
+    nested = nested if nested else {}
+    columns = []
+    for key, conv in mgtemplateitems(template):
+        if conv in nested:
+            for subkey, subconv in mgtemplateitems(nested[conv]):
+                if subconv in MGTYPEDCONVERTERS:
+                    typename, func = MGTYPEDCONVERTERS[subconv]
+                    columns.append(('%s_%s'%(key, subkey), typename, func, (key, subkey)))
+        elif conv in MGTYPEDCONVERTERS:
+            typename, func = MGTYPEDCONVERTERS[conv]
+            columns.append((key, typename, func, (key, None)))
+    return columns
+
+def mgarrowtype(typename):
+    if typename == 'list<float64>':
+        return pa.list_(pa.float64())
+    return pa.type_for_alias(typename)
+
+# typed columnar writer, one parquet (or arrow ipc) file per table. rows are buffered column-wise and written as a
+# row group every rowgroupsize rows. every table except activities and segments has an activity_id column (prepended
+# if the template doesn't carry one).
+# file names carry a run timestamp so incremental runs add files to the same dataset directory
+class StravaColumnarExport:
+    def __init__(self, outdir=COLUMNARDIR, fileformat='parquet', rowgroupsize=COLUMNARROWGROUP, rowtemplates=None):
+        if pa is None:
+            raise RuntimeError('columnar export needs pyarrow (pip install pyarrow)')
+        rowtemplates = rowtemplates if rowtemplates else mgrowtemplates()
+        os.makedirs(outdir, exist_ok=True)
+        self.outdir = outdir
+        self.fileformat = fileformat
+        self.rowgroupsize = rowgroupsize
+        self.runtag = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+        self.columns = {}
+        self.schemas = {}
+        self.buffers = {}
+        self.writers = {}
+        for rectype, table in MGCOLUMNARTABLES.items():
+            template, missing, nested, tag = rowtemplates[rectype]
+            columns = mgcolumnarschema(template, nested)
+            if rectype not in ('Activity', 'segment') and 'activity_id' not in [i[0] for i in columns]:
+                columns = [('activity_id', 'int64', int, None)] + columns
+            self.columns[table] = columns
+            self.schemas[table] = pa.schema([(name, mgarrowtype(typename)) for name, typename, func, path in columns])
+            self.buffers[table] = [[] for i in columns]
+
+    # convert one record into its table's column buffers
+    def add(self, rectype, activity_n, record):
+        table = MGCOLUMNARTABLES[rectype]
+        buffers = self.buffers[table]
+        for buf, (name, typename, func, path) in zip(buffers, self.columns[table]):
+            if path is None:
+                val = activity_n
+            elif path[1] is None:
+                val = record.get(path[0])
+            else:
+                val = (record.get(path[0]) or {}).get(path[1])
+            if val is not None:
+                try:
+                    val = func(val)
+                except (TypeError, ValueError):
+                    val = None
+            buf.append(val)
+        if len(buffers[0]) >= self.rowgroupsize:
+            self.flush(table)
+
+    # write the buffered rows of a table as one row group
+    def flush(self, table):
+        buffers = self.buffers[table]
+        if not buffers[0]:
+            return
+        schema = self.schemas[table]
+        arrays = [pa.array(buf, type=field.type) for buf, field in zip(buffers, schema)]
+        batch = pa.Table.from_arrays(arrays, schema=schema)
+        if table not in self.writers:
+            fname = os.path.join(self.outdir, '%s-%s.%s'%(table, self.runtag, self.fileformat))
+            if self.fileformat == 'parquet':
+                self.writers[table] = pq.ParquetWriter(fname, schema, compression='zstd')
+            else:
+                self.writers[table] = pa.ipc.new_file(fname, schema)
+        self.writers[table].write_table(batch)
+        self.buffers[table] = [[] for i in buffers]
+
+    def close(self):
+        for table in self.buffers:
+            self.flush(table)
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+#
+# sqlite analytics store. the same typed columns as the columnar export (numbers in the output units, lat/lng lists as
+# json text) in normalized tables: activities and segments keyed by strava id, laps, splits, segment efforts, kudos and
+# comments keyed to their activity, and every segment effort refers to its segment by segment_id whether or not the
+# csv uses the segment table mode. records are upserted, so an incremental run or a re-export updates rows in place:
+# a detail Activity (resource_state 3) replaces its row and clears its laps, splits, efforts, kudos and comments
+# before the new ones come in; a summary (SUMMARYONLY) only fills the columns it has, keeping what an earlier detail
+# export stored. indexes on the activity start_date, type and gear_id and the effort segment_id (with elapsed_time,
+# for best efforts) keep the usual questions to an index lookup
+#
+SQLITETYPES = {'int64':'INTEGER', 'int32':'INTEGER', 'float64':'REAL', 'bool':'INTEGER', 'string':'TEXT',
+               'list<float64>':'TEXT'}
+
+# table -> primary key column; the tables without one are replaced per activity through their activity_id
+SQLITEKEYS = {'activities':'id', 'segments':'id', 'laps':'id', 'segment_efforts':'id', 'comments':'id'}
+
+SQLITEINDEXES = [
+    ('activities', ['start_date']), ('activities', ['type', 'start_date']), ('activities', ['gear_id', 'start_date']),
+    ('activities', ['athlete_id', 'start_date']),
+    ('segment_efforts', ['segment_id', 'elapsed_time']), ('segment_efforts', ['activity_id']),
+    ('laps', ['activity_id']), ('splits_metric', ['activity_id']), ('splits_standard', ['activity_id']),
+    ('kudos', ['activity_id']), ('comments', ['activity_id']),
+    ]
+
+class StravaSQLiteStore:
+    def __init__(self, dbfile=SQLITEFILE, rowtemplates=None, commitevery=SQLITECOMMITEVERY):
+        rowtemplates = rowtemplates if rowtemplates else mgrowtemplates()
+        self.dbfile = dbfile
+        self.commitevery = commitevery
+        self.db = sqlite3.connect(dbfile)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.columns = {}
+        self.inserts = {}
+        self.summaryupsert = None
+        self.segmentids = set() # segments stored this run
+        self.activities = 0
+        for rectype, table in MGCOLUMNARTABLES.items():
+            template, missing, nested, tag = rowtemplates[rectype]
+            if rectype == 'segment_efforts':
+                # normalized: the segment goes to its own table, the effort keeps the id
+                template, nested = SegmentEffortRefKeys, None
+            columns = mgcolumnarschema(template, nested)
+            if rectype == 'segment_efforts':
+                columns = [(name, typename, func, ('segment', 'id') if name == 'segment_id' else path)
+                           for name, typename, func, path in columns]
+            if rectype == 'Activity':
+                columns = columns + [('athlete_id', 'int64', int, ('athlete', 'id'))] # one file can hold a harvest
+            elif rectype != 'segment' and 'activity_id' not in [i[0] for i in columns]:
+                columns = [('activity_id', 'int64', int, None)] + columns
+            self.columns[table] = columns
+            self.createtable(table, columns)
+            names = ', '.join('"%s"'%i[0] for i in columns)
+            self.inserts[table] = 'INSERT OR REPLACE INTO %s (%s) VALUES (%s)'%(table, names, ', '.join('?'*len(columns)))
+        columns = self.columns['activities']
+        self.summaryupsert = 'INSERT INTO activities (%s) VALUES (%s) ON CONFLICT(id) DO UPDATE SET %s'%(
+            ', '.join('"%s"'%i[0] for i in columns), ', '.join('?'*len(columns)),
+            ', '.join('"%s"=COALESCE(excluded."%s", "%s")'%(i[0], i[0], i[0]) for i in columns if i[0] != 'id'))
+        for table, keys in SQLITEINDEXES:
+            self.db.execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)'%(table, '_'.join(keys), table, ', '.join(keys)))
+        self.db.commit()
+
+    # create the table, or add the columns a newer template has (e.g. the map geometry columns) to an existing one
+    def createtable(self, table, columns):
+        key = SQLITEKEYS.get(table)
+        existing = [row[1] for row in self.db.execute('PRAGMA table_info(%s)'%table)]
+        if not existing:
+            self.db.execute('CREATE TABLE %s (%s)'%(table, ', '.join('"%s" %s%s'%(name, SQLITETYPES[typename],
+                            ' PRIMARY KEY' if name == key else '') for name, typename, func, path in columns)))
+            return
+        for name, typename, func, path in columns:
+            if name not in existing:
+                self.db.execute('ALTER TABLE %s ADD COLUMN "%s" %s'%(table, name, SQLITETYPES[typename]))
+
+    # one record as a row of its table's typed values
+    def row(self, table, activity_n, record):
+        values = []
+        for name, typename, func, path in self.columns[table]:
+            if path is None:
+                val = activity_n
+            elif path[1] is None:
+                val = record.get(path[0])
+            else:
+                val = (record.get(path[0]) or {}).get(path[1])
+            if val is not None:
+                try:
+                    val = func(val)
+                except (TypeError, ValueError):
+                    val = None
+                if isinstance(val, list):
+                    val = json.dumps(val)
+            values.append(val)
+        return values
+
+    def add(self, rectype, activity_n, record):
+        self.addbatch(rectype, activity_n, [record])
+
+    # upsert the records of one type of one activity
+    def addbatch(self, rectype, activity_n, records):
+        table = MGCOLUMNARTABLES[rectype]
+        if rectype == 'Activity':
+            for record in records:
+                if record.get('resource_state', 3) >= 3:
+                    for child in ['laps', 'splits_metric', 'splits_standard', 'segment_efforts', 'kudos', 'comments']:
+                        self.db.execute('DELETE FROM %s WHERE activity_id=?'%child, (activity_n,))
+                    self.db.execute(self.inserts[table], self.row(table, activity_n, record))
+                else:
+                    self.db.execute(self.summaryupsert, self.row(table, activity_n, record))
+            self.activities += 1
+            if self.activities%self.commitevery == 0:
+                self.db.commit()
+            return
+        if rectype == 'segment_efforts':
+            segments = [record.get('segment') for record in records]
+            self.addsegments([segment for segment in segments if segment])
+        elif rectype == 'segment':
+            self.addsegments(records)
+            return
+        self.db.executemany(self.inserts[table], [self.row(table, activity_n, record) for record in records])
+
+    def addsegments(self, segments):
+        rows = []
+        for segment in segments:
+            segment_id = segment.get('id')
+            if segment_id is not None and segment_id not in self.segmentids:
+                self.segmentids.add(segment_id)
+                rows.append(self.row('segments', None, segment))
+        if rows:
+            self.db.executemany(self.inserts['segments'], rows)
+
+    def close(self):
+        self.db.commit()
+        self.db.execute('PRAGMA optimize')
+        self.db.close()
+
+#
+# rollups: distance, moving_time, total_elevation_gain and kudos_count totals (and the activity count) per athlete,
+# sport type and period (ISO week starting monday, month, year; from start_date_local), kept up to date as each
+# Activity record is exported so a dashboard reads a few hundred rows instead of the whole history.
+# rollup_contributions holds what every activity currently adds to the totals. exporting an activity again (a
+# re-fetch, an edited type or distance, a summary after a detail) takes its old contribution off its old periods and
+# adds the new one; delete() takes it off for good, and reconcile() deletes the activities a full listing no longer
+# has. the totals are in strava's own units (meters, seconds), so they stay consistent whatever STDUNITS a run used
+#
+ROLLUPFIELDS = ['distance', 'moving_time', 'total_elevation_gain', 'kudos_count']
+
+# the period an activity falls in, from its 'YYYY-MM-DDTHH:MM:SSZ' start date: the monday of the week, the month or
+# the year, as a date string
+def mgperiodstart(period, datestr):
+    day = datetime.strptime(datestr[:10], '%Y-%m-%d')
+    if period == 'week':
+        return datetime.fromordinal(day.toordinal() - day.weekday()).strftime('%Y-%m-%d')
+    if period == 'month':
+        return datestr[:7]
+    return datestr[:4]
+
+class StravaRollups:
+    def __init__(self, db=ROLLUPFILE, periods=ROLLUPPERIODS, commitevery=SQLITECOMMITEVERY):
+        # an open connection (the sqlite store's) or a file name
+        self.db = db if isinstance(db, sqlite3.Connection) else sqlite3.connect(db)
+        self.owndb = self.db is not db
+        self.periods = periods
+        self.commitevery = commitevery
+        self.updates = 0
+        self.db.execute('CREATE TABLE IF NOT EXISTS rollups (athlete_id INTEGER, type TEXT, period TEXT,'
+                        ' period_start TEXT, activities INTEGER, %s,'
+                        ' PRIMARY KEY (athlete_id, type, period, period_start))'%', '.join('%s REAL'%i for i in ROLLUPFIELDS))
+        self.db.execute('CREATE INDEX IF NOT EXISTS rollups_period ON rollups (period, period_start)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS rollup_contributions (activity_id INTEGER PRIMARY KEY,'
+                        ' athlete_id INTEGER, type TEXT, start_date TEXT, %s)'%', '.join('%s REAL'%i for i in ROLLUPFIELDS))
+        self.addsql = ('INSERT INTO rollups VALUES (?, ?, ?, ?, ?, %s) ON CONFLICT (athlete_id, type, period, period_start)'
+                       ' DO UPDATE SET activities = activities + excluded.activities, %s'%(', '.join('?'*len(ROLLUPFIELDS)),
+                       ', '.join('%s = %s + excluded.%s'%(i, i, i) for i in ROLLUPFIELDS)))
+        self.db.commit()
+
+    # add (sign 1) or take off (sign -1) one contribution (athlete_id, type, start_date, values...) to its periods
+    def apply(self, contribution, sign):
+        athlete_id, sporttype, start_date = contribution[:3]
+        values = [sign*(val or 0) for val in contribution[3:]]
+        for period in self.periods:
+            key = (athlete_id, sporttype, period, mgperiodstart(period, start_date))
+            self.db.execute(self.addsql, key + (sign,) + tuple(values))
+            if sign < 0:
+                self.db.execute('DELETE FROM rollups WHERE athlete_id=? AND type=? AND period=? AND period_start=?'
+                                ' AND activities <= 0', key)
+
+    def contribution(self, activity_id):
+        return self.db.execute('SELECT athlete_id, type, start_date, %s FROM rollup_contributions WHERE activity_id=?'%(
+                               ', '.join(ROLLUPFIELDS)), (activity_id,)).fetchone()
+
+    # apply one exported Activity record (detail or summary): the delta against what it contributed before
+    def update(self, activity_id, record):
+        start_date = record.get('start_date_local') or record.get('start_date')
+        if not start_date:
+            return
+        athlete = record.get('athlete') or {}
+        new = (athlete.get('id') or 0, record.get('type') or '', start_date) + tuple(
+               float(record.get(i) or 0) for i in ROLLUPFIELDS)
+        old = self.contribution(activity_id)
+        if old == new:
+            return
+        if old is not None:
+            self.apply(old, -1)
+        self.apply(new, 1)
+        self.db.execute('INSERT OR REPLACE INTO rollup_contributions VALUES (?, %s)'%', '.join('?'*len(new)),
+                        (activity_id,) + new)
+        self.updates += 1
+        if self.updates%self.commitevery == 0:
+            self.db.commit()
+
+    # the activity is gone from strava
+    def delete(self, activity_id):
+        old = self.contribution(activity_id)
+        if old is not None:
+            self.apply(old, -1)
+            self.db.execute('DELETE FROM rollup_contributions WHERE activity_id=?', (activity_id,))
+
+    # after a complete listing of one athlete: every activity of theirs it didn't list was deleted. the other
+    # athletes of a harvest sharing the tables are left alone. returns how many
+    def reconcile(self, listed_ids, athlete_id):
+        gone = [row[0] for row in self.db.execute('SELECT activity_id FROM rollup_contributions WHERE athlete_id=?',
+                                                  (athlete_id,))
+                if row[0] not in listed_ids]
+        for activity_id in gone:
+            self.delete(activity_id)
+        return len(gone)
+
+    def close(self):
+        self.db.commit()
+        if self.owndb:
+            self.db.close()
+
+
+#
+# map geometry. the detail response carries the route as a google encoded polyline (Mapinfokeys 'polyline' /
+# 'summary_polyline'). the decoder below works on a whole batch of activities at once with numpy: every polyline's
+# bytes are concatenated, the 5-bit chunks are grouped and summed with np.add.reduceat, zig-zag decoded and
+# cumulatively summed per route - no python loop per character or per point.
+# decoded batches use a CSR layout: coords is an (N,2) float64 [lat, lng] array for all routes and route i is
+# coords[offsets[i]:offsets[i+1]]
+#
+def mgpolylinedecodebatch(polylines):
+    if np is None:
+        raise RuntimeError('polyline decoding needs numpy (pip install numpy)')
+    polylines = [p if p else '' for p in polylines]
+    data = np.frombuffer(''.join(polylines).encode('ascii'), dtype=np.uint8).astype(np.int64) - 63
+    bytecounts = np.array([len(p) for p in polylines], dtype=np.int64)
+    if not len(data):
+        return np.zeros((0, 2)), np.zeros(len(polylines)+1, dtype=np.int64)
+    ends = (data & 0x20) == 0 # last chunk of each value
+    groupstarts = np.flatnonzero(np.concatenate(([True], ends[:-1])))
+    position = np.arange(len(data)) - np.repeat(groupstarts, np.diff(np.append(groupstarts, len(data))))
+    values = np.add.reduceat((data & 0x1f) << (5*position), groupstarts)
+    deltas = np.where(values & 1, ~(values >> 1), values >> 1).reshape(-1, 2)
+    # number of values (two per point) in each polyline = count of chunk ends inside its bytes
+    endtotals = np.concatenate(([0], np.cumsum(ends)))
+    byteends = np.cumsum(bytecounts)
+    endcounts = endtotals[byteends] - endtotals[byteends - bytecounts]
+    offsets = np.concatenate(([0], np.cumsum(endcounts//2))).astype(np.int64)
+    total = np.cumsum(deltas, axis=0)
+    # restart the running sum at the first point of every route
+    base = np.vstack((np.zeros((1, 2), dtype=np.int64), total))[offsets[:-1]]
+    coords = (total - np.repeat(base, np.diff(offsets), axis=0)) / 1e5
+    return coords, offsets
+
+# decode a single polyline into an (n,2) [lat, lng] array
+def mgpolylinedecode(polyline):
+    coords, offsets = mgpolylinedecodebatch([polyline])
+    return coords
+
+EARTHRADIUSMETERS = 6371008.8
+
+# per-route point count, haversine path length (meters) and bounding box for a decoded batch; NaN for empty routes
+def mgpolylinemetrics(coords, offsets):
+    nroutes = len(offsets) - 1
+    npoints = np.diff(offsets)
+    routeids = np.repeat(np.arange(nroutes), npoints)
+    lat, lng = np.radians(coords[:, 0]), np.radians(coords[:, 1])
+    same = routeids[1:] == routeids[:-1] # consecutive points of one route
+    dlat, dlng = lat[1:] - lat[:-1], lng[1:] - lng[:-1]
+    hav = np.sin(dlat/2)**2 + np.cos(lat[1:])*np.cos(lat[:-1])*np.sin(dlng/2)**2
+    legs = 2*EARTHRADIUSMETERS*np.arcsin(np.sqrt(np.clip(hav, 0, 1)))
+    distance = np.bincount(routeids[1:][same], weights=legs[same], minlength=nroutes).astype(np.float64)
+    bbox = np.full((nroutes, 4), np.nan) # minlat, maxlat, minlng, maxlng
+    nonempty = npoints > 0
+    if nonempty.any():
+        starts = offsets[:-1][nonempty]
+        bbox[nonempty, 0] = np.minimum.reduceat(coords[:, 0], starts)
+        bbox[nonempty, 1] = np.maximum.reduceat(coords[:, 0], starts)
+        bbox[nonempty, 2] = np.minimum.reduceat(coords[:, 1], starts)
+        bbox[nonempty, 3] = np.maximum.reduceat(coords[:, 1], starts)
+    distance[~nonempty] = np.nan
+    return {'npoints': npoints, 'distance': distance, 'minlat': bbox[:, 0], 'maxlat': bbox[:, 1],
+            'minlng': bbox[:, 2], 'maxlng': bbox[:, 3]}
+
+# decode the routes of a list of activity detail (or summary) dicts in one batch and add the MapGeometryKeys
+# columns to each dict. returns the decoded (coords, offsets) arrays for callers that want the points themselves
+def mgmapgeometry(activities, polylinekey=MAPPOLYLINEKEY):
+    polylines = []
+    for activity in activities:
+        routemap = activity.get('map') or {}
+        polylines.append(routemap.get(polylinekey) or routemap.get('summary_polyline') or '')
+    coords, offsets = mgpolylinedecodebatch(polylines)
+    metrics = mgpolylinemetrics(coords, offsets)
+    for i, activity in enumerate(activities):
+        activity['map_points'] = int(metrics['npoints'][i])
+        if not activity['map_points']:
+            continue # no route: the other columns stay missing
+        activity['map_distance'] = float(metrics['distance'][i])
+        for key in ['minlat', 'maxlat', 'minlng', 'maxlng']:
+            activity['map_'+key] = float(metrics[key][i])
+    return coords, offsets
+
+# pipeline stage between the fetch and the output: collect batchsize bundles, decode their routes in one batch
+# and pass the bundles on in the same order
+def mgbatchgeometry(bundles, batchsize=MAPGEOMETRYBATCH):
+    batch = []
+    for activity_n, bundle in bundles:
+        batch.append((activity_n, bundle))
+        if len(batch) >= batchsize or not bundle[0]:
+            mgmapgeometry([b[2] for n, b in batch if b[0]])
+            for item in batch:
+                yield item
+            batch = []
+    if batch:
+        mgmapgeometry([b[2] for n, b in batch if b[0]])
+        for item in batch:
+            yield item
+
+
+# the export loop shared by the single athlete run and the multi-athlete harvest: list the activities, fetch what
+# isn't exported yet and hand every record to the output. returns (failed request name or None, requests made);
+# a failed listing shows as stravaapi.activity_listok False
+def mgexportactivities(stravaapi, output, syncstate=None, workers=FETCHWORKERS, checkpoint=None, rollups=None):
+    countrequests = 0
+    after = syncstate.aftercursor() if syncstate else None
+    # the activities we exported before (sync state) or earlier in an interrupted run (checkpoint) are skipped
+    skipids = set()
+    if syncstate:
+        skipids |= syncstate.exported_ids
+    if checkpoint:
+        skipids |= checkpoint.done
+    # segment table mode: the segments written by earlier runs or before an interruption aren't written again
+    segmentindex = None
+    if SEGMENTTABLE and not SUMMARYONLY:
+        segmentindex = StravaSegmentIndex(syncstate.segment_ids if syncstate else None)
+        if checkpoint:
+            segmentindex.written |= checkpoint.segments
+    if SUMMARYONLY:
+        # the listing pages are the only requests
+        bundles = stravaapi.strava_summarybundles(after, skipids)
+    else:
+        # stream the athlete activity IDs page by page; detail requests start while later pages are still listed
+        my_activities = stravaapi.strava_iteractivities(after)
+        if skipids:
+            # only the activities we haven't exported before need detail requests
+            my_activities = (i for i in my_activities if i not in skipids)
+
+        # iterate through the Activities. detail, kudos and comment requests run in the fetch worker pool
+        # and come back here in the original activity order
+        bundles = stravaapi.strava_fetchbundles(my_activities, workers)
+    if EXPORTMAPGEOMETRY:
+        bundles = mgbatchgeometry(bundles)
+    for activity_n, bundle in bundles:
+        # respdata_activity holds the json structure response from the API request
+        stat, failedrequest, respdata_activity, respdata_kudos, respdata_comments = bundle
+        if not stat:
+            return failedrequest, countrequests
+        countrequests += 1 + (respdata_kudos is not None) + (respdata_comments is not None)
+        # decode the activity response data; the Activity row then laps, segments, splits, kudos and comments
+        if BATCHUNITS and hasattr(output, 'addbatch'):
+            for rectype, records in mgbundlebatches(activity_n, bundle, segmentindex):
+                started = time.perf_counter()
+                output.addbatch(rectype, activity_n, records)
+                stravaapi.metrics.converted(rectype, time.perf_counter() - started, len(records))
+        else:
+            for rectype, record in mgbundlerecords(activity_n, bundle, segmentindex):
+                started = time.perf_counter()
+                output.add(rectype, activity_n, record)
+                stravaapi.metrics.converted(rectype, time.perf_counter() - started)
+
+        if rollups:
+            rollups.update(activity_n, respdata_activity)
+        if syncstate:
+            syncstate.markexported(activity_n, respdata_activity)
+        if checkpoint:
+            checkpoint.completed(activity_n, output, segmentindex.takenew() if segmentindex else ())
+        elif segmentindex:
+            segmentindex.takenew()
+        # if your activity list is huge, these 2 lines can be used as a limit for partial list of activities
+        ## if countrequests > 10:
+        ##   break
+    if rollups and after is None and stravaapi.activity_listok and stravaapi.listed_athlete is not None:
+        # the whole listing went by: whatever the rollups hold of this athlete beyond it was deleted on strava
+        rollups.reconcile(stravaapi.listed_ids, stravaapi.listed_athlete)
+    return None, countrequests
+
 
 #a main function entry point for simply testing the class and functions here
 if __name__ == '__main__':
     #
     #create an instance of the StravaAPIauthenticator(access code). 
-    auth = StravaAPIauthenticator() 
-    # authenticator instance will return a runtime validated Access Token from Strava
-    mytoken = auth.saa_getaccesstoken()
+    # an offline cache replay never talks to strava, so it needs no token
+    tokenstore = None
+    if RESPONSECACHE and CACHEOFFLINE:
+        mytoken = 'offline-replay'
+    else:
+        # saved tokens skip the App Code prompts; the store keeps refreshing them while the export runs
+        tokenstore = StravaTokenStore(TOKENSTOREFILE, M1_STRAVA_CLIENT_ID, M1_STRAVA_CLIENT_SECRET) if TOKENSTOREFILE else None
+        auth = StravaAPIauthenticator(tokenstore=tokenstore)
+        # authenticator instance will return a runtime validated Access Token from Strava
+        mytoken = auth.saa_getaccesstoken()
+        if tokenstore is not None and mytoken:
+            tokenstore.start()
     if not mytoken:
         print('authenticator Access Token sequence failed')
         exit()
 
-    # flag to enable redirection of print() to a .csv file
+    # flag to write the rows to .csv files
     # turn this off False if you just want to test with std output
     doredirection = DOREDIRECTION
 
-    # redirect output into a CSV file if this flag is true. 
-    if doredirection : # doredirection:
-        redirector = MG_OutputRedirect('stravadata.csv')
-    countrequests = 0
-    newcountactivities = 0
+    # incremental sync picks up from the saved high-water mark and appends to the previous run's csv files
+    syncstate = StravaSyncState(SYNCSTATEFILE) if INCREMENTALSYNC else None
 
-    # output the banner with column titles
-    hdrrow = StravaActivityOut('Activity',None, None, gethdrrow=True )
-    print(hdrrow)
-    for i in ['laps','segment_efforts','splits_metric','splits_standard']:
-            segstrs=ActivityCompoundFuncs[i](i, None, None, gethdrrow=True)
-            print("0,0-%s:header,"%i,segstrs[0])
+    # a checkpoint journal lets an interrupted export resume; it needs plain csv files to cut back to
+    checkpoint = None
+    if CHECKPOINTFILE:
+        if EXPORTFORMAT != 'csv' or OUTPUTCOMPRESSION or not doredirection:
+            print('checkpointing needs uncompressed csv files (DOREDIRECTION); continuing without it')
+        else:
+            checkpoint = StravaCheckpoint(CHECKPOINTFILE, resume=RESUMEEXPORT)
+
+    # every record goes to the output: the buffered csv sink (csv.writer keeps text with commas or quotes in its
+    # column) or its typed table in the columnar export
+    if EXPORTFORMAT == 'sqlite':
+        output = StravaSQLiteStore(SQLITEFILE)
+    elif EXPORTFORMAT != 'csv':
+        output = StravaColumnarExport(COLUMNARDIR, EXPORTFORMAT)
+    else:
+        appendfiles = dict(syncstate.outputfiles) if syncstate else {}
+        if checkpoint:
+            appendfiles.update(checkpoint.resumefiles())
+        output = MG_OutputSink('stravadata', appendfiles=appendfiles, tostdout=not doredirection)
+        if syncstate:
+            syncstate.outputfiles = output.filenames
+    # the rollup tables go into the sqlite store, or their own file next to the other outputs
+    rollups = None
+    if ROLLUPS:
+        rollups = StravaRollups(output.db if EXPORTFORMAT == 'sqlite' else ROLLUPFILE)
 
     # instantiate the API engine. 
-    stravaapi = StravaCSVgenerator(mytoken)
-
-    # get a list of the athlete activities IDs
-    my_activities = stravaapi.strava_getactivities()
-    if not len(my_activities):
-        redirector = MG_OutputRedirect('',False)
+    responsecache = StravaResponseCache(RESPONSECACHE, offline=CACHEOFFLINE) if RESPONSECACHE else None
+    streamstore = StravaStreamStore(STREAMSDIR) if STREAMSDIR else None
+    archive = StravaResponseArchive(RESPONSEARCHIVE) if RESPONSEARCHIVE else None
+    stravaapi = StravaCSVgenerator(mytoken, responsecache=responsecache, streamstore=streamstore, tokenstore=tokenstore,
+                                   archive=archive)
+
+    # profiling: the csv sink formats through timed converters, and / or the loop runs under cProfile
+    profiler = None
+    if PROFILECONVERTERS and EXPORTFORMAT == 'csv':
+        profiler = MGConverterProfiler()
+        output.formatters = mgcompileformatters(profiler=profiler)
+    if PROFILECPROFILE:
+        import cProfile
+        cprofiler = cProfile.Profile()
+        cprofiler.enable()
+    failedrequest, countrequests = mgexportactivities(stravaapi, output, syncstate, checkpoint=checkpoint,
+                                                      rollups=rollups)
+    if PROFILECPROFILE:
+        cprofiler.disable()
+        cprofiler.dump_stats(PROFILECPROFILE)
+    if profiler:
+        if PROFILEREPORT:
+            with open(PROFILEREPORT, 'w') as f:
+                f.write(profiler.report())
+        else:
+            print(profiler.report())
+        if PROFILECOLLAPSED:
+            profiler.writecollapsed(PROFILECOLLAPSED)
+    if checkpoint:
+        checkpoint.close(output, finished=not failedrequest and stravaapi.activity_listok)
+    if rollups:
+        rollups.close()
+    output.close()
+    if streamstore:
+        streamstore.close()
+    if archive:
+        archive.close()
+    if syncstate:
+        # keeps what was already written so the next run doesn't append it twice
+        syncstate.save(finished=not failedrequest and stravaapi.activity_listok)
+    if tokenstore:
+        tokenstore.stop()
+    if METRICSREPORT or METRICSPROMFILE:
+        report = stravaapi.metrics.report(stravaapi.ratescheduler, activity_requests=countrequests,
+                                          failed_request=failedrequest)
+        if METRICSREPORT:
+            stravaapi.metrics.writejson(METRICSREPORT, report)
+        if METRICSPROMFILE:
+            stravaapi.metrics.writeprometheus(METRICSPROMFILE, report)
+    if failedrequest:
+        print('%s failed'%failedrequest)
+        exit()
+    if not stravaapi.activity_listok or (not syncstate and not countrequests):
         print('GetActivities failed')
         exit(1)
-
-    # iterate through the list of Activities. reqeust detail inside the loop
-    for activity_n in  my_activities:
-        # activity request to get each athlete activity item detail by event Id
-        # respdata_activity holds the json structure response from the API request
-        stat, respdata_activity = stravaapi.strava_activityrequest(activity_n) # 
-        if not stat:
-            redirector = MG_OutputRedirect('',False)
-            print('GetActivities failed')
-            exit()
-        countrequests += 1
-        # decode the activity response data to get top level Activity info
-        activityrow = StravaActivityOut('Activity', respdata_activity, activity_n ) # 
-        print(activityrow)
-
-        # decode the activity response data secondary details if present for an activity; Laps, Segments, splits_metric, splits_standard
-        # TBD add photos, maps, ...
-        for i in ['laps','segment_efforts','splits_metric','splits_standard']:
-            if i in respdata_activity.keys():
-                segstrs=ActivityCompoundFuncs[i](i, respdata_activity[i],activity_n, False)
-                for sstr in segstrs:
-                    print('%s'%sstr)        
-
-        # get the kudos for activity by id 
-        if respdata_activity['kudos_count'] > 0:
-            # make the api request for kudos
-            stat,respdata = stravaapi.stravakudorequest( activity_n)  # !
-            #url = "https://www.strava.com/api/v3/activities/%d/kudos"%activity_n.id # "Authorization: Bearer [[access_token['access_token']]]"    
-            if not stat:
-                redirector = MG_OutputRedirect('',False)
-                print('GetKudos failed')
-                exit()
-            countrequests += 1
-            mystrs = mgkudoout(respdata)
-            for kud in mystrs:
-                print('%d,kudo,'%activity_n , kud)
-
-        #  activities/comments
-        # activities/{id}/kudos?page=&per_page=" "Authoriz
-        if respdata_activity['comment_count'] > 0:
-            # web api request to get comments by activity Id
-            stat, respdata = stravaapi.stravacommentrequest(activity_n )
-            if not stat:
-                redirector = MG_OutputRedirect('',False)
-                print('Get Comments failed')
-                exit()
-            countrequests += 1
-            # output a list of comments
-            mystrs = mgcommentout(respdata) #print('comment data --->',respdata)
-            for comm in mystrs:
-                try:
-                    print('%d,comment,'%activity_n ,comm)
-                except:
-                    print('%d,<special chars comment>'%activity_n )
-
-        newcountactivities = countrequests
-        # if your activity list is huge, these 2 lines can be used as a limit for partial list of activities
-        ## if newcountactivities > 10:
-        ##   break
-    #reset redirector
-    if doredirection:
-        redirector.makestdoutredirect('',True)
@@ -0,0 +1,271 @@
+#
+# MGstravabench.py - benchmarks for MGstravaapp.py @(python 3.7)
+#
+# formatters: formats the same synthetic activities with the original string-concatenation converters
+#   (StravaActivityOut, mglapsout, mgsplitsout, mgsegmenteffortsout) and with the compiled row formatters
+#   written through csv.writer, and reports rows/sec for each record type.
+#     python MGstravabench.py formatters [--activities 2000]
+#
+# export: end-to-end export of a synthetic athlete served by the local mock strava server (MGstravamock.py)
+#   through StravaCSVgenerator, the fetch worker pool and the csv sink. reports requests/sec, rows/sec,
+#   peak memory and total wall time, so regressions in the fetch or formatting path show up early.
+#   peak memory is the process peak RSS (mock server included); --tracemalloc measures the python heap instead,
+#   which is slower but the only option on windows
+#     python MGstravabench.py export [--activities 2000] [--workers 8] [--latency 0.02] [--rate429 0.0]
+#
+# records: memory held by a synthetic 10k activity history parsed from json, kept as the raw dicts vs converted to
+#   the slotted records (MGRecord) with the dicts dropped, measured with tracemalloc; also checks that both give the
+#   same rows and times the parse and the conversion
+#     python MGstravabench.py records [--activities 10000]
+#
+# archive: writes synthetic detail responses into a StravaResponseArchive and reports its size against the raw
+#   bodies, the replay time (inflate and slice, no parsing) and the parse time of every installed json backend
+#   (orjson, ujson, json), plus the random lookup time
+#     python MGstravabench.py archive [--activities 5000]
+#
+import sys
+import io
+import os
+import csv
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+try:
+    import resource # not on windows; peak memory falls back to tracemalloc there
+except ImportError:
+    resource = None
+
+import MGstravaapp as mg
+from MGstravamock import mgsyntheticactivity, MockAthlete, MockRateLimiter, MockStravaServer
+
+#
+# formatter micro-benchmark
+#
+COMPOUNDITEMS = ['laps', 'segment_efforts', 'splits_metric', 'splits_standard']
+
+# original converters: one string per row built by concatenation, written as text
+def mglegacyformat(rectype, activities, out):
+    for activity in activities:
+        if rectype == 'Activity':
+            out.write(mg.StravaActivityOut('Activity', activity, activity['id']) + '\n')
+        else:
+            for row in mg.ActivityCompoundFuncs[rectype](rectype, activity[rectype], activity['id'], False):
+                out.write(row + '\n')
+
+# compiled formatter through csv.writer
+def mgcompiledformat(rectype, activities, out):
+    csvout = csv.writer(out, lineterminator='\n')
+    rowfunc = mg.MGROWFORMATTERS[rectype]
+    tag = mg.MGROWTEMPLATES[rectype][3]
+    for activity in activities:
+        idstr = str(activity['id'])
+        if rectype == 'Activity':
+            csvout.writerow([idstr, tag] + rowfunc(activity, activity['id']))
+        else:
+            csvout.writerows([idstr, tag] + rowfunc(item, activity['id']) for item in activity[rectype])
+
+def mgtimeformatter(formatfunc, rectype, activities, repeat=5):
+    best = None
+    for i in range(repeat):
+        out = io.StringIO()
+        started = time.perf_counter()
+        formatfunc(rectype, activities, out)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+# rows/sec per record type, legacy vs compiled (best of 5 runs)
+def mgformatterbenchmark(nactivities=2000, seed=1):
+    rnd = random.Random(seed)
+    activities = [mgsyntheticactivity(n, rnd) for n in range(1, nactivities+1)]
+    print('%-16s %10s %14s %16s %8s'%('record type', 'rows', 'legacy rows/s', 'compiled rows/s', 'speedup'))
+    for rectype in ['Activity'] + COMPOUNDITEMS:
+        nrows = len(activities) if rectype == 'Activity' else sum(len(a[rectype]) for a in activities)
+        legacy = mgtimeformatter(mglegacyformat, rectype, activities)
+        compiled = mgtimeformatter(mgcompiledformat, rectype, activities)
+        print('%-16s %10d %14.0f %16.0f %7.1fx'%(rectype, nrows, nrows/legacy, nrows/compiled, legacy/compiled))
+
+
+#
+# end-to-end export benchmark against the mock server
+#
+# run one export and return its measurements. the mock's rate window is shortened to windowseconds and the
+# client's scheduler uses the same window, so 429 handling is exercised without waiting 15 real minutes
+def mgexportbenchmark(nactivities=2000, workers=mg.FETCHWORKERS, latency=0.02, rate429=0.0, limit15min=10**9,
+                      windowseconds=5, seed=1, compression=None, splitbytype=False, usetracemalloc=False):
+    usetracemalloc = usetracemalloc or resource is None
+    server = MockStravaServer(MockAthlete(nactivities, seed), latency=latency,
+                              ratelimiter=MockRateLimiter(limit15min, 10**9, windowseconds, rate429, seed))
+    apibase = server.start()
+    outdir = tempfile.mkdtemp(prefix='mgstravabench-')
+    try:
+        scheduler = mg.StravaRateScheduler(limit15min, 10**9, margin=0, windowseconds=windowseconds)
+        stravaapi = mg.StravaCSVgenerator('bench-token', ratescheduler=scheduler, apibase=apibase)
+        output = mg.MG_OutputSink('bench', outdir + os.sep, compression=compression, splitbytype=splitbytype)
+        nrows = 0
+        if usetracemalloc:
+            tracemalloc.start()
+        started = time.perf_counter()
+        for activity_n, bundle in stravaapi.strava_fetchbundles(stravaapi.strava_iteractivities(), workers):
+            if not bundle[0]:
+                raise RuntimeError('%s failed'%bundle[1])
+            for rectype, record in mg.mgbundlerecords(activity_n, bundle):
+                output.add(rectype, activity_n, record)
+                nrows += 1
+        output.close()
+        walltime = time.perf_counter() - started
+        if usetracemalloc:
+            peakmemory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            # ru_maxrss is kilobytes on linux, bytes on macos
+            peakmemory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*(1 if sys.platform == 'darwin' else 1024)
+        outputbytes = sum(os.path.getsize(os.path.join(outdir, f)) for f in os.listdir(outdir))
+    finally:
+        server.stop()
+        for f in os.listdir(outdir):
+            os.remove(os.path.join(outdir, f))
+        os.rmdir(outdir)
+    return {'activities': nactivities, 'workers': workers, 'latency': latency, 'requests': server.totalrequests(),
+            'requests_by_endpoint': dict(server.requests), 'rows': nrows, 'walltime': walltime,
+            'requests_per_sec': server.totalrequests()/walltime, 'rows_per_sec': nrows/walltime,
+            'peak_memory_bytes': peakmemory, 'memory_method': 'tracemalloc' if usetracemalloc else 'rss', 'bytes_received': server.bytessent, 'output_bytes': outputbytes}
+
+def mgprintexportresult(result):
+    print('activities %d  workers %d  latency %.3fs'%(result['activities'], result['workers'], result['latency']))
+    print('  wall time       %10.2f s'%result['walltime'])
+    print('  requests        %10d  (%s)'%(result['requests'], ', '.join('%s %d'%i for i in sorted(result['requests_by_endpoint'].items()))))
+    print('  requests/sec    %10.1f'%result['requests_per_sec'])
+    print('  rows            %10d'%result['rows'])
+    print('  rows/sec        %10.1f'%result['rows_per_sec'])
+    print('  peak memory     %10.1f MB (%s)'%(result['peak_memory_bytes']/1e6,
+          'python heap, tracemalloc' if result['memory_method'] == 'tracemalloc' else 'process peak rss'))
+    print('  received        %10.1f MB   written %.1f MB'%(result['bytes_received']/1e6, result['output_bytes']/1e6))
+
+
+#
+# record memory benchmark
+#
+# parse every synthetic detail response and keep the whole history, either as the parsed dicts or as slotted
+# records; returns (the history, python heap bytes it holds, seconds spent parsing/converting)
+def mgloadhistory(bodies, slotted):
+    activityclass = mg.MGRECORDCLASSES['Activity']
+    history = []
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    elapsed = 0.0
+    for body in bodies:
+        started = time.perf_counter()
+        activity = json.loads(body)
+        if slotted:
+            activity = activityclass.fromdict(activity, {})
+        elapsed += time.perf_counter() - started
+        history.append(activity)
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return history, held, elapsed
+
+def mgrecordbenchmark(nactivities=10000, seed=1):
+    rnd = random.Random(seed)
+    # the response bodies are made up front (outside the measurement) so only what the history holds is counted
+    bodies = [json.dumps(mgsyntheticactivity(n, rnd)).encode() for n in range(1, nactivities+1)]
+    dicts, dictbytes, dictseconds = mgloadhistory(bodies, False)
+    sample = [(a['id'], [mg.MGROWFORMATTERS[rectype](rec, a['id']) for rectype, rec in mg.mgbundlerecords(a['id'], (True, None, a, None, None))])
+              for a in dicts[::max(1, nactivities//200)]]
+    nrecords = sum(1 + sum(len(a[rectype]) for rectype in COMPOUNDITEMS) for a in dicts)
+    del dicts
+    records, recordbytes, recordseconds = mgloadhistory(bodies, True)
+    for activity_n, rows in sample:
+        activity = records[activity_n - 1]
+        assert rows == [mg.MGROWFORMATTERS[rectype](rec, activity_n) for rectype, rec in mg.mgbundlerecords(activity_n, (True, None, activity, None, None))]
+    print('activities %d  records %d (activity, laps, segment efforts, splits)  json %.1f MB'%(
+          nactivities, nrecords, sum(len(body) for body in bodies)/1e6))
+    print('%-16s %12s %14s %12s'%('history', 'heap MB', 'bytes/record', 'load s'))
+    print('%-16s %12.1f %14.0f %12.2f'%('json dicts', dictbytes/1e6, dictbytes/nrecords, dictseconds))
+    print('%-16s %12.1f %14.0f %12.2f'%('slotted records', recordbytes/1e6, recordbytes/nrecords, recordseconds))
+    print('%-16s %11.1fx'%('smaller', dictbytes/recordbytes))
+
+
+#
+# response archive benchmark
+#
+def mgarchivebenchmark(nactivities=5000, seed=1, lookups=500):
+    rnd = random.Random(seed)
+    bodies = [json.dumps(mgsyntheticactivity(n, rnd), separators=(',', ':')).encode() for n in range(1, nactivities+1)]
+    rawbytes = sum(len(body) for body in bodies)
+    archivedir = tempfile.mkdtemp(prefix='mgstravabench-')
+    try:
+        archive = mg.StravaResponseArchive(archivedir)
+        started = time.perf_counter()
+        for n, body in enumerate(bodies, 1):
+            archive.append('activity', n, 200, body)
+        archive.close()
+        writeseconds = time.perf_counter() - started
+        archivebytes = os.path.getsize(archive.datafile)
+        indexbytes = os.path.getsize(archive.indexfile)
+        archive = mg.StravaResponseArchive(archivedir)
+        started = time.perf_counter()
+        replayed = [body for endpoint, key, fetched, status, body in archive.records('activity')]
+        replayseconds = time.perf_counter() - started
+        assert replayed == bodies
+        backends = []
+        for name in ['orjson', 'ujson', 'json']:
+            backend, loads, dumps = mg.mgjsonbackend(name)
+            if backend != name:
+                continue # not installed
+            started = time.perf_counter()
+            for body in replayed:
+                loads(body)
+            backends.append((name, time.perf_counter() - started))
+        keys = [rnd.randint(1, nactivities) for i in range(lookups)]
+        started = time.perf_counter()
+        for key in keys:
+            archive.getbody('activity', key)
+        lookupseconds = (time.perf_counter() - started)/lookups
+        archive.close()
+    finally:
+        for f in os.listdir(archivedir):
+            os.remove(os.path.join(archivedir, f))
+        os.rmdir(archivedir)
+    print('responses %d  raw %.1f MB  archive %.1f MB (%.1fx)  index %.2f MB'%(nactivities, rawbytes/1e6, archivebytes/1e6,
+          rawbytes/archivebytes, indexbytes/1e6))
+    print('  write           %8.2f s   %8.1f MB/s raw'%(writeseconds, rawbytes/1e6/writeseconds))
+    print('  replay bytes    %8.2f s   %8.1f MB/s raw'%(replayseconds, rawbytes/1e6/replayseconds))
+    for name, seconds in backends:
+        print('  parse %-9s %8.2f s   %8.1f MB/s  %6.2fx json'%(name, seconds, rawbytes/1e6/seconds, backends[-1][1]/seconds))
+    print('  random lookup   %8.2f ms'%(lookupseconds*1000))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='MGstravaapp.py benchmarks')
+    commands = parser.add_subparsers(dest='command')
+    formatters = commands.add_parser('formatters', help='legacy vs compiled row formatter rows/sec')
+    formatters.add_argument('--activities', type=int, default=2000)
+    export = commands.add_parser('export', help='end-to-end export against the local mock server')
+    export.add_argument('--activities', type=int, default=2000)
+    export.add_argument('--workers', type=int, default=mg.FETCHWORKERS)
+    export.add_argument('--latency', type=float, default=0.02, help='mean mock response latency in seconds')
+    export.add_argument('--rate429', type=float, default=0.0, help='share of requests answered with a random 429')
+    export.add_argument('--limit15min', type=int, default=10**9, help='mock short window request limit')
+    export.add_argument('--window', type=int, default=5, help='short rate window in seconds (mock and client)')
+    export.add_argument('--compression', choices=['gzip', 'zstd'], default=None)
+    export.add_argument('--splitbytype', action='store_true')
+    export.add_argument('--tracemalloc', action='store_true', help='measure the python heap peak instead of process rss')
+    archivecmd = commands.add_parser('archive', help='response archive size, replay and json backend parse speed')
+    archivecmd.add_argument('--activities', type=int, default=5000)
+    records = commands.add_parser('records', help='memory of a parsed history: json dicts vs slotted records')
+    records.add_argument('--activities', type=int, default=10000)
+    args = parser.parse_args()
+    if args.command == 'export':
+        mgprintexportresult(mgexportbenchmark(args.activities, args.workers, args.latency, args.rate429, args.limit15min,
+                                              args.window, compression=args.compression, splitbytype=args.splitbytype,
+                                              usetracemalloc=args.tracemalloc))
+    elif args.command == 'archive':
+        mgarchivebenchmark(args.activities)
+    elif args.command == 'records':
+        mgrecordbenchmark(args.activities)
+    else:
+        mgformatterbenchmark(args.activities if args.command else 2000)
@@ -0,0 +1,164 @@
+#
+# MGstravaharvest.py - multi-athlete export under one strava application @(python 3.7)
+#
+# every athlete connected to the application has its own access token, but all of them draw from the application's
+# one rate budget ("< 600 requests per 15 minutes, < 30,000 per day"). this harvests a roster of athletes across
+# worker processes:
+#   - one StravaSharedRateScheduler in shared memory paces every process against the application-wide usage and
+#     gives each athlete being harvested an equal share of each window
+#   - athletes with a sync state from an earlier run (incremental, usually a handful of requests) are queued ahead
+#     of first-time backfills, so the cheap updates are never stuck behind a multi-thousand-request history
+#   - each athlete gets its own output directory with its csv files (or columnar tables, or sqlite store), sync state
+#     and saved tokens
+#
+# the roster is a json list of athletes:
+#     [{"athlete": "jdoe", "access_token": "83ebeabdec09f6670863766f792ead24d61fe3f9"}, ...]
+# an entry with "refresh_token" (and "expires_at", "client_id", "client_secret" unless M1_STRAVA_CLIENT_ID / SECRET
+# are coded) is kept fresh by a StravaTokenStore in the athlete's directory, so the roster only needs it once
+#
+#     python MGstravaharvest.py roster.json --outdir y:/harvest --processes 4
+#
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import multiprocessing
+
+import MGstravaapp as mg
+
+# per-athlete directory under the harvest output directory
+def mgathletedir(outdir, entry):
+    return os.path.join(outdir, str(entry['athlete']))
+
+# incremental jobs first, then backfills; roster order within each group
+def mgharvestorder(roster, outdir):
+    incremental = []
+    backfill = []
+    for entry in roster:
+        syncstate = mg.StravaSyncState(os.path.join(mgathletedir(outdir, entry), 'stravasync-state.json'))
+        (backfill if syncstate.highwater is None else incremental).append(entry)
+    return incremental + backfill
+
+# export one athlete into its directory; runs inside a worker process with the slot's view of the shared scheduler
+def mgharvestathlete(entry, outdir, scheduler, apibase=mg.STRAVAAPIBASE, fetchworkers=mg.FETCHWORKERS):
+    athletedir = mgathletedir(outdir, entry)
+    os.makedirs(athletedir, exist_ok=True)
+    syncstate = mg.StravaSyncState(os.path.join(athletedir, 'stravasync-state.json'))
+    backfill = syncstate.highwater is None
+    if mg.EXPORTFORMAT == 'sqlite':
+        output = mg.StravaSQLiteStore(os.path.join(athletedir, 'stravadata.sqlite'))
+    elif mg.EXPORTFORMAT != 'csv':
+        output = mg.StravaColumnarExport(os.path.join(athletedir, 'columnar'), mg.EXPORTFORMAT)
+    else:
+        output = mg.MG_OutputSink('stravadata', athletedir + os.sep, appendfiles=syncstate.outputfiles)
+        syncstate.outputfiles = output.filenames
+    rollups = None
+    if mg.ROLLUPS:
+        rollups = mg.StravaRollups(output.db if mg.EXPORTFORMAT == 'sqlite' else
+                                   os.path.join(athletedir, 'stravadata-rollups.sqlite'))
+    tokenstore = mg.StravaTokenStore(os.path.join(athletedir, 'stravatokens.json'),
+                                     entry.get('client_id', mg.M1_STRAVA_CLIENT_ID),
+                                     entry.get('client_secret', mg.M1_STRAVA_CLIENT_SECRET),
+                                     seed={key: value for key, value in entry.items() if key != 'athlete'})
+    if tokenstore.tokens.get('refresh_token'):
+        tokenstore.usable() # refreshes an expired access token before the first request
+        tokenstore.start()
+    archive = mg.StravaResponseArchive(os.path.join(athletedir, 'archive')) if mg.RESPONSEARCHIVE else None
+    started = time.time()
+    failedrequest = 'interrupted'
+    scheduler.activate(True)
+    try:
+        stravaapi = mg.StravaCSVgenerator(tokenstore.accesstoken, ratescheduler=scheduler, apibase=apibase,
+                                          tokenstore=tokenstore, archive=archive)
+        failedrequest, countrequests = mg.mgexportactivities(stravaapi, output, syncstate, fetchworkers, rollups=rollups)
+        if not failedrequest and not stravaapi.activity_listok:
+            failedrequest = 'GetActivities'
+    finally:
+        tokenstore.stop()
+        scheduler.activate(False)
+        if rollups:
+            rollups.close()
+        if archive:
+            archive.close()
+        output.close()
+        # what was written is kept even when the athlete failed part way, but only a finished athlete moves its
+        # high-water mark: a partial backfill stays a backfill and lists everything again next time
+        syncstate.save(finished=failedrequest is None)
+    return {'athlete': entry['athlete'], 'ok': failedrequest is None, 'failedrequest': failedrequest,
+            'backfill': backfill, 'requests': countrequests, 'seconds': time.time() - started}
+
+# worker process: take athletes off the job queue until the None sentinel
+def mgharvestworker(slot, jobs, results, scheduler, outdir, apibase, fetchworkers):
+    scheduler.forslot(slot)
+    while True:
+        entry = jobs.get()
+        if entry is None:
+            break
+        try:
+            result = mgharvestathlete(entry, outdir, scheduler, apibase, fetchworkers)
+        except Exception as err:
+            result = {'athlete': entry['athlete'], 'ok': False, 'failedrequest': repr(err)}
+        results.put(result)
+
+# harvest every athlete of the roster with 'processes' worker processes; returns one result dict per athlete.
+# a worker killed outright (out of memory, a crash in a native module, SystemExit) never puts its athlete's result,
+# so the results are polled every pollseconds; once every worker has exited, the athletes without a result are
+# reported as failed
+def mgharvest(roster, outdir, processes=4, apibase=mg.STRAVAAPIBASE, fetchworkers=mg.FETCHWORKERS,
+              limit15min=mg.RATELIMIT15MIN, limit24hr=mg.RATELIMIT24HR, windowseconds=15*60, pollseconds=5):
+    processes = max(1, min(processes, len(roster)))
+    scheduler = mg.StravaSharedRateScheduler(processes, limit15min, limit24hr, windowseconds=windowseconds)
+    jobs = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    for entry in mgharvestorder(roster, outdir):
+        jobs.put(entry)
+    for i in range(processes):
+        jobs.put(None)
+    workers = [multiprocessing.Process(target=mgharvestworker,
+                                       args=(slot, jobs, results, scheduler, outdir, apibase, fetchworkers))
+               for slot in range(processes)]
+    for worker in workers:
+        worker.start()
+    harvested = []
+    while len(harvested) < len(roster):
+        try:
+            harvested.append(results.get(timeout=pollseconds))
+        except queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                break
+    # a worker flushes its results before it exits; take any that arrived with the last poll
+    while len(harvested) < len(roster):
+        try:
+            harvested.append(results.get(timeout=1))
+        except queue.Empty:
+            break
+    for worker in workers:
+        worker.join()
+    finished = [result['athlete'] for result in harvested]
+    exitcodes = [worker.exitcode for worker in workers if worker.exitcode]
+    for entry in roster:
+        if entry['athlete'] in finished:
+            finished.remove(entry['athlete'])
+        else:
+            harvested.append({'athlete': entry['athlete'], 'ok': False,
+                              'failedrequest': 'worker process died (exit codes %s)'%exitcodes})
+    return harvested
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='export every athlete of a roster under one shared strava rate budget')
+    parser.add_argument('roster', help='json list of {"athlete": name, "access_token": token}')
+    parser.add_argument('--outdir', default=mg.BASEPATH + 'stravaharvest')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--fetchworkers', type=int, default=mg.FETCHWORKERS, help='fetch threads per process')
+    parser.add_argument('--apibase', default=mg.STRAVAAPIBASE)
+    args = parser.parse_args()
+    with open(args.roster, 'r') as f:
+        roster = json.load(f)
+    harvested = mgharvest(roster, args.outdir, args.processes, args.apibase, args.fetchworkers)
+    for result in harvested:
+        print('%-20s %-11s %s'%(result['athlete'], 'backfill' if result.get('backfill') else 'incremental',
+                                'ok, %d requests'%result['requests'] if result['ok'] else '%s failed'%result['failedrequest']))
+    if not all(result['ok'] for result in harvested):
+        sys.exit(1)
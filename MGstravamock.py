@@ -0,0 +1,378 @@
+#
+# MGstravamock.py - local stand-in for the strava REST API @(python 3.7)
+#
+# serves synthetic athletes so MGstravaapp.py can be benchmarked and tested without spending real API quota.
+#   GET /api/v3/athlete
+#   GET /api/v3/athlete/activities?per_page=&page=&after=
+#   GET /api/v3/athletes/{id}/stats      (counts and totals of rides, runs and swims, like strava's)
+#   GET /api/v3/activities/{id}          (detail with laps, splits and segment efforts)
+#   GET /api/v3/activities/{id}/kudos
+#   GET /api/v3/activities/{id}/comments
+#   GET /api/v3/activities/{id}/streams?keys=&key_by_type=true   (one sample per second of elapsed time)
+#   POST /oauth/token   (grant_type=refresh_token; only with a token lifetime, see MockStravaServer.issuetoken)
+# every response carries X-RateLimit-Limit / X-RateLimit-Usage headers. requests over the limits get a 429, and a
+# random share of requests can be turned into 429s to exercise the client's rate scheduler.
+#
+#     python MGstravamock.py --activities 5000 --latency 0.05 --port 8123
+#   then set STRAVAAPIBASE = "http://127.0.0.1:8123/api/v3" (any access token is accepted)
+#
+import sys
+import json
+import time
+import gzip
+import calendar
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+#
+# synthetic strava data. shaped like the detail responses documented in the MGstravaapp.py templates
+#
+SPORTTYPES = ['Ride', 'Run', 'Walk', 'Swim', 'Hike']
+
+def mgsyntheticsegment(segment_id, rnd):
+    lat, lng = 37.7 + rnd.random()*0.2, -122.3 + rnd.random()*0.2
+    return {'id': segment_id, 'resource_state': 2, 'name': 'Segment %d, the climb'%segment_id,
+            'activity_type': 'Ride', 'distance': rnd.uniform(200, 8000), 'average_grade': rnd.uniform(-2, 8),
+            'maximum_grade': rnd.uniform(0, 15), 'elevation_high': rnd.uniform(10, 400), 'elevation_low': rnd.uniform(0, 10),
+            'start_latlng': [lat, lng], 'end_latlng': [lat + 0.01, lng + 0.01], 'start_latitude': lat, 'start_longitude': lng,
+            'end_latitude': lat + 0.01, 'end_longitude': lng + 0.01, 'climb_category': rnd.randint(0, 3), 'city': 'Oakland',
+            'state': 'California', 'country': 'United States', 'private': False, 'hazardous': False, 'starred': False}
+
+# one activity detail response; laps, splits and segment efforts sized like a typical hour-long ride
+def mgsyntheticactivity(activity_n, rnd, segmentpool=200):
+    start = 1262304000 + activity_n*86400
+    start_date = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(start))
+    distance = rnd.uniform(2000, 80000)
+    moving_time = int(distance / rnd.uniform(2, 9))
+    laps = [{'id': activity_n*1000 + i, 'resource_state': 2, 'name': 'Lap %d'%(i+1),
+             'activity': {'id': activity_n, 'resource_state': 1}, 'athlete': {'id': 5292665, 'resource_state': 1},
+             'elapsed_time': 600, 'moving_time': 590, 'start_date': start_date, 'start_date_local': start_date,
+             'distance': 1609.34, 'start_index': i*80, 'end_index': i*80 + 79, 'total_elevation_gain': rnd.uniform(0, 40),
+             'average_speed': rnd.uniform(2, 9), 'max_speed': rnd.uniform(9, 15), 'average_cadence': rnd.uniform(60, 95),
+             'average_heartrate': rnd.uniform(110, 170), 'max_heartrate': rnd.uniform(170, 190), 'lap_index': i+1,
+             'split': i+1, 'pace_zone': rnd.randint(0, 5)} for i in range(rnd.randint(1, 8))]
+    splits = [{'distance': 1000.0, 'elapsed_time': rnd.randint(150, 600), 'elevation_difference': rnd.uniform(-10, 10),
+               'moving_time': rnd.randint(150, 600), 'split': i+1, 'average_speed': rnd.uniform(2, 9),
+               'average_heartrate': rnd.uniform(110, 170), 'pace_zone': 0} for i in range(int(distance//1000) + 1)]
+    efforts = [{'id': activity_n*10000 + i, 'resource_state': 2, 'name': 'Segment %d'%i,
+                'activity': {'id': activity_n, 'resource_state': 1}, 'athlete': {'id': 5292665, 'resource_state': 1},
+                'elapsed_time': rnd.randint(60, 1800), 'moving_time': rnd.randint(60, 1800), 'start_date': start_date,
+                'start_date_local': start_date, 'distance': rnd.uniform(200, 8000), 'start_index': 50, 'end_index': 235,
+                'average_cadence': rnd.uniform(60, 95), 'average_heartrate': rnd.uniform(110, 170), 'max_heartrate': 180.0,
+                'segment': mgsyntheticsegment(rnd.randint(1, segmentpool), rnd), 'kom_rank': None, 'pr_rank': None,
+                'achievements': [], 'hidden': False} for i in range(rnd.randint(0, 12))]
+    return {'resource_state': 3, 'athlete': {'id': 5292665, 'resource_state': 1}, 'name': 'Morning %s #%d'%(rnd.choice(SPORTTYPES), activity_n),
+            'distance': distance, 'moving_time': moving_time, 'elapsed_time': moving_time + rnd.randint(0, 900),
+            'total_elevation_gain': rnd.uniform(0, 900), 'type': rnd.choice(SPORTTYPES), 'id': activity_n,
+            'external_id': 'garmin_push_%d'%activity_n, 'upload_id': activity_n + 7, 'start_date': start_date,
+            'start_date_local': start_date, 'timezone': '(GMT-08:00) America/Los_Angeles', 'utc_offset': -25200.0,
+            'start_latlng': [37.8, -122.26], 'end_latlng': [37.81, -122.25], 'location_city': None, 'location_state': None,
+            'location_country': 'United States', 'start_latitude': 37.8, 'start_longitude': -122.26, 'achievement_count': 0,
+            'kudos_count': rnd.randint(0, 3), 'comment_count': rnd.randint(0, 1), 'athlete_count': 1, 'photo_count': 0,
+            'map': {'id': 'a%d'%activity_n, 'polyline': '_p~iF~ps|U_ulLnnqC_mqNvxq`@', 'resource_state': 3,
+                    'summary_polyline': '_p~iF~ps|U_ulLnnqC_mqNvxq`@'},
+            'photos': {'primary': None, 'count': 0}, 'device_name': 'Garmin Edge 530', 'embed_token': 'f434587211db7ce5',
+            'available_zones': [], 'trainer': False, 'commute': rnd.random() < 0.3, 'manual': False, 'private': False,
+            'visibility': 'everyone', 'flagged': False, 'gear_id': 'b%d'%rnd.randint(1, 3), 'from_accepted_tag': False,
+            'upload_id_str': str(activity_n + 7), 'average_speed': distance/moving_time, 'max_speed': 14.2,
+            'average_cadence': 82.5, 'average_temp': 18.0, 'average_watts': 151.2, 'weighted_average_watts': 176,
+            'kilojoules': 676.9, 'device_watts': True, 'has_heartrate': True, 'average_heartrate': 143.9,
+            'max_heartrate': 187.0, 'heartrate_opt_out': False, 'display_hide_heartrate_option': False, 'max_watts': 678,
+            'elev_high': 133.3, 'elev_low': 6.1, 'pr_count': 0, 'total_photo_count': 0, 'has_kudoed': False,
+            'suffer_score': 98.0, 'description': None, 'calories': 710.0, 'perceived_exertion': None,
+            'prefer_perceived_exertion': None, 'segment_efforts': efforts, 'splits_metric': splits,
+            'splits_standard': splits, 'laps': laps}
+
+
+def mgsynthetickudos(activity_n, count):
+    return [{'resource_state': 2, 'firstname': 'Kudoer%d'%i, 'lastname': 'K.'} for i in range(count)]
+
+def mgsyntheticcomments(activity_n, count):
+    return [{'id': activity_n*10 + i, 'activity_id': activity_n, 'post_id': None, 'resource_state': 2,
+             'text': 'Nice one, see you "next" week %d'%i, 'mentions_metadata': None, 'created_at': '2019-04-19T18:27:08Z',
+             'athlete': {'resource_state': 2, 'firstname': 'Lucas', 'lastname': 'L.'}} for i in range(count)]
+
+# per-second sample channels for an activity, keyed by type like strava's key_by_type=true response
+def mgsyntheticstreams(detail, keys):
+    rnd = random.Random(detail['id'])
+    n = detail['elapsed_time']
+    speed = detail['distance']/max(n, 1)
+    lat, lng = detail['start_latlng']
+    channels = {
+        'time': lambda: list(range(n)),
+        'distance': lambda: [round(i*speed, 1) for i in range(n)],
+        'latlng': lambda: [[round(lat + i*1e-5, 6), round(lng + i*1e-5, 6)] for i in range(n)],
+        'altitude': lambda: [round(20 + 10*rnd.random(), 1) for i in range(n)],
+        'velocity_smooth': lambda: [round(speed + rnd.uniform(-1, 1), 2) for i in range(n)],
+        'heartrate': lambda: [rnd.randint(110, 180) for i in range(n)],
+        'cadence': lambda: [rnd.randint(70, 95) for i in range(n)],
+        'watts': lambda: [rnd.randint(80, 300) for i in range(n)],
+        'temp': lambda: [18]*n,
+        'moving': lambda: [True]*n,
+        'grade_smooth': lambda: [round(rnd.uniform(-5, 5), 1) for i in range(n)],
+        }
+    return {key: {'data': channels[key](), 'series_type': 'distance', 'original_size': n, 'resolution': 'high'}
+            for key in keys if key in channels}
+
+# the keys of a detail response that also appear in the activities listing (summary representation)
+SUMMARYKEYS = ['resource_state', 'athlete', 'name', 'distance', 'moving_time', 'elapsed_time', 'total_elevation_gain',
+               'type', 'id', 'external_id', 'upload_id', 'start_date', 'start_date_local', 'timezone', 'utc_offset',
+               'start_latlng', 'end_latlng', 'location_city', 'location_state', 'location_country', 'start_latitude',
+               'start_longitude', 'achievement_count', 'kudos_count', 'comment_count', 'athlete_count', 'photo_count',
+               'map', 'trainer', 'commute', 'manual', 'private', 'visibility', 'flagged', 'gear_id', 'from_accepted_tag',
+               'upload_id_str', 'average_speed', 'max_speed', 'average_watts', 'weighted_average_watts', 'kilojoules',
+               'device_watts', 'has_heartrate', 'average_heartrate', 'max_heartrate', 'elev_high', 'elev_low', 'pr_count',
+               'total_photo_count', 'has_kudoed', 'suffer_score']
+
+# a synthetic athlete: activity details are generated on first use from a per-activity seed, so any athlete size
+# costs nothing until it is requested and every run serves identical data
+class MockAthlete:
+    def __init__(self, nactivities=700, seed=1, athlete_id=5292665):
+        self.nactivities = nactivities
+        self.seed = seed
+        self.athlete_id = athlete_id
+        self.details = {}
+        self.lock = threading.Lock()
+
+    # newest first, like strava's listing
+    def activity_ids(self):
+        return range(self.nactivities, 0, -1)
+
+    def detail(self, activity_n):
+        if activity_n < 1 or activity_n > self.nactivities:
+            return None
+        with self.lock:
+            if activity_n not in self.details:
+                rnd = random.Random(self.seed*1000003 + activity_n)
+                self.details[activity_n] = mgsyntheticactivity(activity_n, rnd)
+            return self.details[activity_n]
+
+    def summary(self, activity_n):
+        detail = self.detail(activity_n)
+        summary = {key: detail[key] for key in SUMMARYKEYS if key in detail}
+        summary['resource_state'] = 2
+        summary['map'] = {'id': detail['map']['id'], 'summary_polyline': detail['map']['summary_polyline'], 'resource_state': 2}
+        return summary
+
+    # all_*_totals of the athlete stats; like strava's, walks and hikes aren't counted anywhere
+    def stats(self):
+        totals = {}
+        for activity_n in self.activity_ids():
+            detail = self.detail(activity_n)
+            total = totals.setdefault(detail['type'], {'count': 0, 'distance': 0.0, 'moving_time': 0, 'elapsed_time': 0,
+                                                       'elevation_gain': 0.0})
+            total['count'] += 1
+            total['distance'] += detail['distance']
+            total['moving_time'] += detail['moving_time']
+            total['elapsed_time'] += detail['elapsed_time']
+            total['elevation_gain'] += detail['total_elevation_gain']
+        empty = {'count': 0, 'distance': 0.0, 'moving_time': 0, 'elapsed_time': 0, 'elevation_gain': 0.0}
+        return {'biggest_ride_distance': None, 'biggest_climb_elevation_gain': None,
+                'all_ride_totals': totals.get('Ride', empty), 'all_run_totals': totals.get('Run', empty),
+                'all_swim_totals': totals.get('Swim', empty)}
+
+    def athlete(self):
+        return {'id': self.athlete_id, 'resource_state': 3, 'firstname': 'John', 'lastname': 'Doe', 'city': 'Oakland'}
+
+# fixed rate windows like strava's (short window aligned to multiples of windowseconds, daily window at midnight UTC)
+# plus an optional share of random 429s
+class MockRateLimiter:
+    def __init__(self, limit15min=600, limit24hr=30000, windowseconds=15*60, rate429=0.0, seed=1):
+        self.limit15min = limit15min
+        self.limit24hr = limit24hr
+        self.windowseconds = windowseconds
+        self.rate429 = rate429
+        self.rnd = random.Random(seed)
+        self.lock = threading.Lock()
+        self.base15min = self.base24hr = None
+        self.usage15min = self.usage24hr = 0
+
+    # count one request; returns (allowed, usage header, limit header)
+    def request(self):
+        with self.lock:
+            now = time.time()
+            if self.base15min != now - now % self.windowseconds:
+                self.base15min = now - now % self.windowseconds
+                self.usage15min = 0
+            if self.base24hr != now - now % 86400:
+                self.base24hr = now - now % 86400
+                self.usage24hr = 0
+            self.usage15min += 1
+            self.usage24hr += 1
+            allowed = self.usage15min <= self.limit15min and self.usage24hr <= self.limit24hr
+            if allowed and self.rate429 and self.rnd.random() < self.rate429:
+                allowed = False
+            return allowed, '%d,%d'%(self.usage15min, self.usage24hr), '%d,%d'%(self.limit15min, self.limit24hr)
+
+class MockStravaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, so the client's connection pool is exercised
+    wbufsize = 64*1024 # headers and body leave in one write (avoids the nagle / delayed-ack stall)
+
+    def log_message(self, format, *args):
+        pass # quiet; the server counts requests instead
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency*(0.5 + server.jitter.random()))
+        if not server.tokenvalid(self.headers.get('Authorization', '')):
+            return self.reply(401, {'message': 'Authorization Error', 'errors': [{'resource': 'Athlete',
+                              'field': 'access_token', 'code': 'invalid'}]}, None, None, 'unauthorized')
+        allowed, usage, limit = server.ratelimiter.request()
+        if not allowed:
+            return self.reply(429, {'message': 'Rate Limit Exceeded', 'errors': [{'resource': 'Application', 'code': 'exceeded'}]},
+                              usage, limit, 'rate429')
+        url = urlsplit(self.path)
+        query = dict(parse_qsl(url.query))
+        parts = [i for i in url.path.split('/') if i]
+        athlete = server.athlete
+        if parts[:2] != ['api', 'v3']:
+            return self.reply(404, {'message': 'Record Not Found'}, usage, limit, 'other')
+        parts = parts[2:]
+        if parts == ['athlete']:
+            return self.reply(200, athlete.athlete(), usage, limit, 'athlete')
+        if len(parts) == 3 and parts[0] == 'athletes' and parts[2] == 'stats':
+            if parts[1] != str(athlete.athlete_id):
+                return self.reply(404, {'message': 'Record Not Found'}, usage, limit, 'other')
+            return self.reply(200, athlete.stats(), usage, limit, 'stats')
+        if parts == ['athlete', 'activities']:
+            per_page = min(int(query.get('per_page', 30)), 200)
+            page = int(query.get('page', 1))
+            ids = list(athlete.activity_ids())
+            if 'after' in query:
+                after = int(query['after'])
+                ids = [i for i in ids if server.startepoch(i) > after]
+                ids.reverse() # strava returns oldest first when after= is given
+            ids = ids[(page-1)*per_page:page*per_page]
+            return self.reply(200, [athlete.summary(i) for i in ids], usage, limit, 'list')
+        if len(parts) >= 2 and parts[0] == 'activities' and parts[1].isdigit():
+            detail = athlete.detail(int(parts[1]))
+            if detail is None:
+                return self.reply(404, {'message': 'Record Not Found'}, usage, limit, 'other')
+            if len(parts) == 2:
+                return self.reply(200, detail, usage, limit, 'activity')
+            if parts[2:] == ['kudos']:
+                return self.reply(200, mgsynthetickudos(detail['id'], detail['kudos_count']), usage, limit, 'kudos')
+            if parts[2:] == ['comments']:
+                return self.reply(200, mgsyntheticcomments(detail['id'], detail['comment_count']), usage, limit, 'comments')
+            if parts[2:] == ['streams']:
+                keys = [i for i in query.get('keys', 'time').split(',') if i]
+                return self.reply(200, mgsyntheticstreams(detail, keys), usage, limit, 'streams')
+        return self.reply(404, {'message': 'Record Not Found'}, usage, limit, 'other')
+
+    # token refresh; the old access token stays valid until its own expiry like strava's
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        form = dict(parse_qsl(self.rfile.read(length).decode()))
+        form.update(parse_qsl(urlsplit(self.path).query))
+        if urlsplit(self.path).path != '/oauth/token' or form.get('grant_type') != 'refresh_token' or \
+                form.get('refresh_token') not in server.refreshtokens:
+            return self.reply(400, {'message': 'Bad Request'}, None, None, 'other')
+        return self.reply(200, server.issuetoken(form['refresh_token']), None, None, 'token')
+
+    def reply(self, status, respdata, usage, limit, endpoint):
+        body = json.dumps(respdata).encode()
+        gzipped = 'gzip' in self.headers.get('Accept-Encoding', '')
+        if gzipped:
+            body = gzip.compress(body, 1)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        if usage is not None: # not on token or authorization errors, which aren't counted
+            self.send_header('X-RateLimit-Limit', limit)
+            self.send_header('X-RateLimit-Usage', usage)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(endpoint, len(body))
+
+# the threaded mock server; start() runs it on a daemon thread and returns the api base url for StravaCSVgenerator
+class MockStravaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # tokenlifetime (seconds) turns on token checking: only tokens from issuetoken() are accepted, until they expire
+    def __init__(self, athlete, port=0, latency=0.0, ratelimiter=None, host='127.0.0.1', tokenlifetime=None):
+        ThreadingHTTPServer.__init__(self, (host, port), MockStravaHandler)
+        self.tokenlifetime = tokenlifetime
+        self.accesstokens = {} # access token: expires_at
+        self.refreshtokens = set()
+        self.athlete = athlete
+        self.latency = latency
+        self.jitter = random.Random(athlete.seed)
+        self.ratelimiter = ratelimiter if ratelimiter else MockRateLimiter(limit15min=10**9, limit24hr=10**9)
+        self.statslock = threading.Lock()
+        self.requests = {}
+        self.bytessent = 0
+        self.startepochs = {}
+
+    # a token exchange response like strava's; the refresh token stays the same once issued
+    def issuetoken(self, refreshtoken=None):
+        with self.statslock:
+            accesstoken = 'mock-access-%d'%(len(self.accesstokens) + 1)
+            refreshtoken = refreshtoken or 'mock-refresh-%d'%(len(self.refreshtokens) + 1)
+            expires_at = int(time.time() + (self.tokenlifetime or 6*60*60))
+            self.accesstokens[accesstoken] = expires_at
+            self.refreshtokens.add(refreshtoken)
+        return {'token_type': 'Bearer', 'access_token': accesstoken, 'refresh_token': refreshtoken,
+                'expires_at': expires_at, 'expires_in': expires_at - int(time.time())}
+
+    def tokenvalid(self, authorization):
+        if not self.tokenlifetime:
+            return True
+        expires_at = self.accesstokens.get(authorization.replace('Bearer ', '', 1))
+        return expires_at is not None and expires_at > time.time()
+
+    def tokenurl(self):
+        return 'http://%s:%d/oauth/token'%self.server_address[:2]
+
+    def startepoch(self, activity_n):
+        if activity_n not in self.startepochs:
+            detail = self.athlete.detail(activity_n)
+            self.startepochs[activity_n] = calendar.timegm(time.strptime(detail['start_date'], '%Y-%m-%dT%H:%M:%SZ'))
+        return self.startepochs[activity_n]
+
+    def count(self, endpoint, nbytes):
+        with self.statslock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.bytessent += nbytes
+
+    def totalrequests(self):
+        with self.statslock:
+            return sum(self.requests.values())
+
+    def apibase(self):
+        return 'http://%s:%d/api/v3'%self.server_address[:2]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self.apibase()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='local mock of the strava API for MGstravaapp.py')
+    parser.add_argument('--activities', type=int, default=700, help='synthetic athlete size')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--port', type=int, default=8123)
+    parser.add_argument('--latency', type=float, default=0.05, help='mean seconds added to every response')
+    parser.add_argument('--limit15min', type=int, default=600)
+    parser.add_argument('--limit24hr', type=int, default=30000)
+    parser.add_argument('--window', type=int, default=15*60, help='short rate window in seconds')
+    parser.add_argument('--rate429', type=float, default=0.0, help='share of requests answered with a random 429')
+    args = parser.parse_args()
+    server = MockStravaServer(MockAthlete(args.activities, args.seed), args.port, args.latency,
+                              MockRateLimiter(args.limit15min, args.limit24hr, args.window, args.rate429, args.seed))
+    print('mock strava API for %d activities at %s'%(args.activities, server.apibase()))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,158 @@
+#
+# MGstravaquery.py - query the sqlite store written by MGstravaapp.py (EXPORTFORMAT = 'sqlite') @(python 3.7)
+#
+# the store keeps the activities, laps, splits, segment efforts, segments, kudos and comments in indexed tables, so
+# the usual questions are an index lookup instead of a scan of the csv. distances, speeds and elevations are in the
+# export's units (miles / mph / feet with STDUNITS), times in minutes
+#
+#     python MGstravaquery.py y:/stravadata.sqlite tables
+#     python MGstravaquery.py y:/stravadata.sqlite activities --type Ride --year 2019 --min-distance 50
+#     python MGstravaquery.py y:/stravadata.sqlite segment "Lake Merritt"      (best efforts, by segment id or name)
+#     python MGstravaquery.py y:/stravadata.sqlite rollups --period month --type Ride --last 12
+#     python MGstravaquery.py y:/stravadata.sqlite sql "SELECT gear_id, SUM(distance) FROM activities GROUP BY 1"
+#
+# rollups reads the totals StravaRollups keeps (ROLLUPS = True; in the store or in ROLLUPFILE), in strava's units
+# (meters, seconds). --csv prints csv instead of the aligned table; the row count and query time go to stderr
+#
+import sys
+import csv
+import time
+import sqlite3
+import argparse
+
+import MGstravaapp as mg
+
+# the columns of an activity listing
+ACTIVITYCOLUMNS = ['id', 'start_date_local', 'type', 'name', 'distance', 'moving_time', 'total_elevation_gain',
+                   'average_speed', 'gear_id']
+
+def mgconnect(dbfile):
+    # read only, so a query never blocks (or creates) the store an export is writing
+    return sqlite3.connect('file:%s?mode=ro'%dbfile, uri=True)
+
+# run a query; returns (column names, rows, milliseconds)
+def mgquery(db, sql, params=()):
+    started = time.perf_counter()
+    cursor = db.execute(sql, params)
+    rows = cursor.fetchall()
+    return [i[0] for i in cursor.description or []], rows, 1000*(time.perf_counter() - started)
+
+# the row count of every table
+def mgtables(db):
+    tables = [row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type='table'"
+                                           " AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+    return mgquery(db, ' UNION ALL '.join("SELECT '%s' AS 'table', COUNT(*) AS 'rows' FROM %s"%(table, table)
+                                          for table in tables))
+
+# activities filtered on the indexed columns (start_date, type, gear_id) and the distance, newest first
+def mgactivities(db, sporttype=None, year=None, after=None, before=None, mindistance=None, gear=None, limit=None):
+    where = []
+    params = []
+    if sporttype:
+        where.append('type = ?')
+        params.append(sporttype)
+    if year:
+        after, before = '%04d-01-01'%year, '%04d-01-01'%(year + 1)
+    if after:
+        where.append('start_date >= ?')
+        params.append(after)
+    if before:
+        where.append('start_date < ?')
+        params.append(before)
+    if mindistance is not None:
+        where.append('distance >= ?')
+        params.append(mindistance)
+    if gear:
+        where.append('gear_id = ?')
+        params.append(gear)
+    sql = 'SELECT %s FROM activities%s ORDER BY start_date DESC'%(', '.join(ACTIVITYCOLUMNS),
+                                                                   ' WHERE ' + ' AND '.join(where) if where else '')
+    if limit:
+        sql += ' LIMIT %d'%limit
+    return mgquery(db, sql, params)
+
+# the efforts on a segment, fastest first; the segment is given by id or by (part of) its name
+def mgsegmentefforts(db, segment, limit=None):
+    if segment.isdigit():
+        segmentids = [int(segment)]
+    else:
+        segmentids = [row[0] for row in db.execute('SELECT id FROM segments WHERE name LIKE ?', ('%%%s%%'%segment,))]
+    sql = ('SELECT e.segment_id, s.name, e.activity_id, a.start_date_local, e.elapsed_time, e.moving_time,'
+           ' e.average_heartrate FROM segment_efforts e JOIN segments s ON s.id = e.segment_id'
+           ' LEFT JOIN activities a ON a.id = e.activity_id WHERE e.segment_id IN (%s)'
+           ' ORDER BY e.segment_id, e.elapsed_time'%', '.join('?'*len(segmentids)))
+    if limit:
+        sql += ' LIMIT %d'%limit
+    return mgquery(db, sql, segmentids)
+
+# the rollup totals of the last 'last' periods, newest first
+def mgrollups(db, period='week', sporttype=None, athlete=None, last=None):
+    where = ['period = ?']
+    params = [period]
+    if sporttype:
+        where.append('type = ?')
+        params.append(sporttype)
+    if athlete:
+        where.append('athlete_id = ?')
+        params.append(athlete)
+    if last:
+        # the last periods with activities of the selection
+        where.append('period_start IN (SELECT DISTINCT period_start FROM rollups WHERE %s'
+                     ' ORDER BY period_start DESC LIMIT %d)'%(' AND '.join(where), last))
+        params += params
+    return mgquery(db, 'SELECT period_start, athlete_id, type, activities, distance, moving_time, total_elevation_gain,'
+                       ' kudos_count FROM rollups WHERE %s ORDER BY period_start DESC, athlete_id, type'%' AND '.join(where),
+                   params)
+
+def mgprintrows(columns, rows, ascsv=False, out=sys.stdout):
+    if ascsv:
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(columns)
+        writer.writerows(rows)
+        return
+    text = [['' if val is None else '%.2f'%val if isinstance(val, float) else str(val) for val in row] for row in rows]
+    widths = [min(40, max([len(name)] + [len(row[i]) for row in text])) for i, name in enumerate(columns)]
+    out.write('  '.join(name.ljust(width) for name, width in zip(columns, widths)).rstrip() + '\n')
+    for row in text:
+        out.write('  '.join(val[:width].ljust(width) for val, width in zip(row, widths)).rstrip() + '\n')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='query the MGstravaapp.py sqlite store')
+    parser.add_argument('dbfile', nargs='?', default=mg.SQLITEFILE)
+    parser.add_argument('--csv', action='store_true', help='print csv')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('tables', help='row count per table')
+    activities = commands.add_parser('activities', help='activities, newest first')
+    activities.add_argument('--type', help='Ride, Run, ...')
+    activities.add_argument('--year', type=int)
+    activities.add_argument('--after', help='start date, e.g. 2019-06-01')
+    activities.add_argument('--before', help='start date, exclusive')
+    activities.add_argument('--min-distance', type=float, help='in the export units')
+    activities.add_argument('--gear', help='gear id')
+    activities.add_argument('--limit', type=int)
+    segment = commands.add_parser('segment', help='efforts on a segment, fastest first')
+    segment.add_argument('segment', help='segment id or part of its name')
+    segment.add_argument('--limit', type=int)
+    rollups = commands.add_parser('rollups', help='weekly / monthly totals per sport type')
+    rollups.add_argument('--period', default='week', help='week, month or year (see ROLLUPPERIODS)')
+    rollups.add_argument('--type', help='Ride, Run, ...')
+    rollups.add_argument('--athlete', type=int, help='athlete id')
+    rollups.add_argument('--last', type=int, help='the last N periods')
+    sql = commands.add_parser('sql', help='any sql statement')
+    sql.add_argument('sql')
+    sql.add_argument('params', nargs='*')
+    args = parser.parse_args()
+    db = mgconnect(args.dbfile)
+    if args.command == 'activities':
+        columns, rows, ms = mgactivities(db, args.type, args.year, args.after, args.before, args.min_distance,
+                                         args.gear, args.limit)
+    elif args.command == 'segment':
+        columns, rows, ms = mgsegmentefforts(db, args.segment, args.limit)
+    elif args.command == 'rollups':
+        columns, rows, ms = mgrollups(db, args.period, args.type, args.athlete, args.last)
+    elif args.command == 'sql':
+        columns, rows, ms = mgquery(db, args.sql, args.params)
+    else:
+        columns, rows, ms = mgtables(db)
+    mgprintrows(columns, rows, args.csv)
+    sys.stderr.write('(%d rows in %.1f ms)\n'%(len(rows), ms))
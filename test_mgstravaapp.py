@@ -0,0 +1,411 @@
+#
+# test_mgstravaapp.py - regression tests for MGstravaapp.py @(python 3.7)
+#
+#     python -m pytest -q
+#
+import os
+import csv
+import copy
+import time
+import random
+import zlib
+
+import MGstravaapp as mg
+from MGstravamock import mgsyntheticactivity, MockAthlete, MockRateLimiter, MockStravaServer, MockStravaHandler, SUMMARYKEYS
+
+# a segment as strava sends it inside a segment effort; grades are percentages
+SEGMENT = {'id': 229781, 'resource_state': 2, 'name': 'Hawk Hill', 'activity_type': 'Ride', 'distance': 2684.82,
+           'average_grade': 5.0, 'maximum_grade': 14.2, 'elevation_high': 245.2, 'elevation_low': 92.4,
+           'climb_category': 1, 'city': 'San Francisco', 'state': 'CA', 'country': 'United States',
+           'private': False, 'hazardous': False, 'starred': False}
+
+def test_segment_grade_not_converted(monkeypatch):
+    monkeypatch.setattr(mg, 'STDUNITS', True)
+    header = mg.mgtemplateheader(mg.SegmentTableKeys)
+    grades = [header.index('average_grade'), header.index('maximum_grade')]
+    # csv: the nested segment columns and the segment table row
+    assert mg.mgsegmentout('segment', SEGMENT).split(',')[grades[0] - 1] == ' 5.00'
+    row = mg.mgcompiletemplate(mg.SegmentTableKeys)(SEGMENT, 1)
+    assert [row[i] for i in grades] == [' 5.00', '14.20']
+    # batch: a column of segments
+    rows = mg.mgcompilebatch(mg.SegmentTableKeys)([SEGMENT]*mg.MGBATCHMINROWS, 1)
+    assert [rows[0][i] for i in grades] == [' 5.00', '14.20']
+    # the elevations next to them are still converted
+    assert row[header.index('elevation_high')] == '%5.2f'%(245.2*mg.FEETPERMETER)
+    # typed: the columnar / sqlite value
+    columns = {name: func for name, typename, func, path in mg.mgcolumnarschema(mg.SegmentTableKeys)}
+    assert columns['average_grade'](5.0) == 5.0
+    assert columns['maximum_grade'](14.2) == 14.2
+
+def mgrollupactivity(athlete_id, distance, start_date='2019-09-10T08:11:08Z'):
+    return {'athlete': {'id': athlete_id, 'resource_state': 1}, 'type': 'Ride', 'start_date_local': start_date,
+            'distance': distance, 'moving_time': 3600, 'total_elevation_gain': 100.0, 'kudos_count': 1}
+
+def test_rollups_reconcile_one_athlete():
+    rollups = mg.StravaRollups(':memory:', periods=['month'])
+    rollups.update(1, mgrollupactivity(100, 1000.0))
+    rollups.update(2, mgrollupactivity(100, 2000.0))
+    rollups.update(11, mgrollupactivity(200, 5000.0))
+    rollups.update(12, mgrollupactivity(200, 7000.0))
+    # athlete 100's full listing lost activity 2; athlete 200's activities aren't in it and must stay
+    assert rollups.reconcile({1}, 100) == 1
+    totals = dict(rollups.db.execute('SELECT athlete_id, distance FROM rollups ORDER BY athlete_id'))
+    assert totals == {100: 1000.0, 200: 12000.0}
+    assert [row[0] for row in rollups.db.execute('SELECT activity_id FROM rollup_contributions ORDER BY 1')] == [1, 11, 12]
+    rollups.close()
+
+def test_row_templates_follow_settings(monkeypatch):
+    activity = mgsyntheticactivity(7, random.Random(7))
+    activity['segment_efforts'] = activity['segment_efforts'] or [dict(activity['laps'][0], segment={'id': 1})]
+    # set after import, like the command line or a harvest does
+    monkeypatch.setattr(mg, 'SEGMENTTABLE', True)
+    header = mg.mgtableheader('segment_efforts')
+    assert 'segment_id' in header and 'average_grade' not in header
+    assert '0-segment:header' in [row[1] for row in mg.mgheaderrows()]
+    index = mg.StravaSegmentIndex()
+    rows = [row for rectype, row in mg.mgbundlerows(7, (True, None, activity, None, None), segmentindex=index)
+            if rectype == 'segment_efforts']
+    assert rows and all(len(row) == len(header) and row[header.index('segment_id')].isdigit() for row in rows)
+    monkeypatch.setattr(mg, 'SEGMENTTABLE', False)
+    assert 'average_grade' in mg.mgtableheader('segment_efforts')
+
+def test_response_bytes():
+    import requests
+    response = requests.models.Response()
+    response.status_code = 200
+    # a body read without a Content-Length (chunked) counts its length
+    response._content = b'{"id": 2696839465}'
+    assert mg.mgresponsebytes(response) == 18
+    # a streamed response not read yet falls back to the header
+    streamed = requests.models.Response()
+    streamed.headers['Content-Length'] = '1234'
+    assert mg.mgresponsebytes(streamed) == 1234
+
+# a mock server handler answering 404 to the detail requests of the server's 'failing' ids (the listing still has them)
+class MGFlakyHandler(MockStravaHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] in ['/api/v3/activities/%d'%i for i in getattr(self.server, 'failing', ())]:
+            return self.reply(404, {'message': 'Record Not Found'}, None, None, 'other')
+        return MockStravaHandler.do_GET(self)
+
+def mgmockexport(server, outdir, syncstate):
+    stravaapi = mg.StravaCSVgenerator('mock', apibase=server.apibase,
+                                      ratescheduler=mg.StravaRateScheduler(10**6, 10**9, 0))
+    output = mg.MG_OutputSink('stravadata', outdir + os.sep, appendfiles=syncstate.outputfiles)
+    syncstate.outputfiles = output.filenames
+    failedrequest, countrequests = mg.mgexportactivities(stravaapi, output, syncstate, workers=2)
+    output.close()
+    syncstate.save(finished=not failedrequest and stravaapi.activity_listok)
+    return failedrequest
+
+def test_sync_resumes_after_failed_run(tmp_path):
+    server = MockStravaServer(MockAthlete(30))
+    server.RequestHandlerClass = MGFlakyHandler
+    server.failing = {12}
+    server.apibase = server.start()
+    try:
+        statefile = str(tmp_path/'state.json')
+        assert mgmockexport(server, str(tmp_path), mg.StravaSyncState(statefile)) is not None
+        syncstate = mg.StravaSyncState(statefile)
+        # the newest activities were exported, but the mark didn't move past the ones never reached
+        assert syncstate.exported_ids and syncstate.highwater is None
+        server.failing = ()
+        assert mgmockexport(server, str(tmp_path), syncstate) is None
+        syncstate = mg.StravaSyncState(statefile)
+        assert syncstate.exported_ids == set(range(1, 31)) and syncstate.highwater is not None
+        with open(syncstate.outputfiles['all'], 'r') as f:
+            exported = [row[0] for row in csv.reader(f) if row[1:2] == ['Activity']]
+        assert sorted(map(int, exported)) == list(range(1, 31))
+    finally:
+        server.stop()
+
+def test_shared_scheduler_slot_usage_kept_across_athletes():
+    scheduler = mg.StravaSharedRateScheduler(2, limit15min=10, limit24hr=1000, margin=0)
+    # a second worker's view: the same shared memory and lock on slot 1
+    copy.copy(scheduler).forslot(1).activate(True)
+    scheduler.forslot(0).activate(True)
+    for i in range(5): # the slot's share: 10 requests between 2 athletes
+        scheduler.acquire()
+    # the slot's next athlete in the same window starts from the 5 requests already used
+    scheduler.activate(False)
+    scheduler.activate(True)
+    assert scheduler.slotcounters[0] == 5
+    scheduler.base15mins -= scheduler.windowseconds
+    scheduler.rollwindows(time.time())
+    assert scheduler.slotcounters[0] == 0 and scheduler.slotcounters[1] == 5
+
+def mgmockapi(server, **kwargs):
+    return mg.StravaCSVgenerator('mock', apibase=server.apibase, ratescheduler=mg.StravaRateScheduler(10**6, 10**9, 0),
+                                 **kwargs)
+
+def test_listing_paths_share_pages(tmp_path):
+    server = MockStravaServer(MockAthlete(450))
+    server.apibase = server.start()
+    try:
+        cache = mg.StravaResponseCache(str(tmp_path/'cache.sqlite'))
+        concurrent = [summary['id'] for summary in mgmockapi(server, responsecache=cache).strava_itersummaries(listworkers=4)]
+        listed = server.requests['list']
+        # the sequential listing pages the same way and finds every page in the cache
+        sequential = [summary['id'] for summary in mgmockapi(server, responsecache=cache).strava_itersummaries(listworkers=1)]
+        assert sequential == concurrent == list(range(450, 0, -1))
+        assert server.requests['list'] == listed
+    finally:
+        server.stop()
+
+# an output as the checkpoint sees it: the files and their flushed lengths
+class MGJournalOutput:
+    def __init__(self, fname):
+        self.filenames = {'all': fname}
+
+    def offsets(self):
+        return {'all': os.path.getsize(self.filenames['all'])}
+
+def test_checkpoint_resume_after_torn_journal(tmp_path):
+    journalfile = str(tmp_path/'journal')
+    output = MGJournalOutput(str(tmp_path/'rows.csv'))
+    (tmp_path/'rows.csv').write_text('1,Activity\n')
+    checkpoint = mg.StravaCheckpoint(journalfile, every=1)
+    checkpoint.completed(1, output)
+    checkpoint.journal.close()
+    with open(journalfile, 'a') as f:
+        f.write('{"files": {"all": "rows') # crash in the middle of a journal write
+    checkpoint = mg.StravaCheckpoint(journalfile, resume=True, every=1)
+    assert checkpoint.done == {1}
+    checkpoint.completed(2, output)
+    checkpoint.journal.close()
+    # a second crash and resume still sees everything since the first
+    assert mg.StravaCheckpoint(journalfile, resume=True).done == {1, 2}
+
+# a mock server with strava's rate windows shortened to 'windowseconds', started at the beginning of a window
+def mgratelimitedserver(limit15min, windowseconds=2):
+    server = MockStravaServer(MockAthlete(5), ratelimiter=MockRateLimiter(limit15min, 10000, windowseconds))
+    server.apibase = server.start()
+    time.sleep(windowseconds - time.time() % windowseconds)
+    return server
+
+def test_scheduler_follows_ratelimit_headers():
+    server = mgratelimitedserver(50)
+    try:
+        for i in range(10): # another client of the application
+            server.ratelimiter.request()
+        scheduler = mg.StravaRateScheduler(600, 30000, margin=0, windowseconds=2)
+        stravaapi = mg.StravaCSVgenerator('mock', apibase=server.apibase, ratescheduler=scheduler)
+        assert stravaapi.stravaathleterequest()[0]
+        # the server's limits and usage replace the defaults and the scheduler's own count
+        assert (scheduler.limit15min, scheduler.limit24hr) == (50, 10000)
+        assert scheduler.requestcounterper15min == 11 and scheduler.remaining()[0] == 39
+    finally:
+        server.stop()
+
+def test_scheduler_paces_to_the_window():
+    server = mgratelimitedserver(5)
+    try:
+        scheduler = mg.StravaRateScheduler(5, 10000, margin=1, windowseconds=2)
+        stravaapi = mg.StravaCSVgenerator('mock', apibase=server.apibase, ratescheduler=scheduler)
+        started = time.time()
+        assert all(stravaapi.stravaathleterequest()[0] for i in range(6))
+        # 4 requests a window (5 less the margin): the fifth waited for the next window, and nothing got a 429
+        assert 1 < time.time() - started < 4
+        assert 'rate429' not in server.requests
+    finally:
+        server.stop()
+
+def test_scheduler_waits_out_a_429():
+    server = mgratelimitedserver(5)
+    try:
+        scheduler = mg.StravaRateScheduler(5, 10000, margin=0, windowseconds=2)
+        stravaapi = mg.StravaCSVgenerator('mock', apibase=server.apibase, ratescheduler=scheduler)
+        for i in range(5): # another client uses the whole window
+            server.ratelimiter.request()
+        started = time.time()
+        assert stravaapi.stravaathleterequest()[0]
+        # one 429, then the retry waited for the window boundary instead of backing off blindly
+        assert server.requests['rate429'] == 1 and server.requests['athlete'] == 1
+        assert 1 < time.time() - started < 3
+        counters = stravaapi.metrics.report()['endpoints']['athlete']
+        assert counters['rate_limited'] == 1 and counters['status'] == {'429': 1, '200': 1}
+    finally:
+        server.stop()
+
+def test_response_cache_ttl_and_offline(tmp_path):
+    cachefile = str(tmp_path/'cache.sqlite')
+    cache = mg.StravaResponseCache(cachefile, ttls={'activity': 60})
+    cache.put('activity', 7, b'{"id": 7}')
+    assert cache.get('activity', 7) == {'id': 7}
+    assert cache.get('kudos', 7) is None # no entry; an endpoint without a ttl is never fresh either
+    cache.db.execute('UPDATE responses SET fetched=fetched-120')
+    assert cache.get('activity', 7) is None # stale
+    cache.close()
+    # offline takes anything it has, and a miss doesn't go to strava
+    offline = mg.StravaResponseCache(cachefile, ttls={'activity': 60}, offline=True)
+    assert offline.get('activity', 7) == {'id': 7}
+    server = MockStravaServer(MockAthlete(5))
+    server.apibase = server.start()
+    try:
+        stravaapi = mgmockapi(server, responsecache=offline)
+        assert stravaapi.strava_activityrequest(7)[0] is True
+        assert stravaapi.strava_activityrequest(3)[0] is False
+        assert server.totalrequests() == 0
+    finally:
+        server.stop()
+
+def test_response_cache_evicts_least_recently_used(tmp_path):
+    bodies = {key: ('"%s"'%os.urandom(400).hex()).encode() for key in 'abcd'}
+    size = max(len(zlib.compress(body)) for body in bodies.values())
+    cache = mg.StravaResponseCache(str(tmp_path/'cache.sqlite'), ttls={'activity': 60}, maxbytes=int(3.5*size))
+    for key in 'abc':
+        cache.put('activity', key, bodies[key])
+        time.sleep(0.01)
+    assert cache.get('activity', 'a') # a is used again, so b is now the least recently used
+    time.sleep(0.01)
+    cache.put('activity', 'd', bodies['d']) # past maxbytes: evicted down to 90% of it
+    assert [key for key in 'abcd' if cache.get('activity', key) is not None] == ['a', 'c', 'd']
+    assert cache.totalbytes == cache.db.execute('SELECT SUM(size) FROM responses').fetchone()[0] <= 0.9*cache.maxbytes
+
+# an export with a checkpoint journal that dies hard (no journal close) at its 'crashat'th activity
+def mgcheckpointexport(server, outdir, resume, crashat=None):
+    checkpoint = mg.StravaCheckpoint(os.path.join(outdir, 'journal'), resume=resume, every=7)
+    output = mg.MG_OutputSink('stravadata', outdir + os.sep, appendfiles=checkpoint.resumefiles())
+    add = output.add
+    activities = []
+    def crashingadd(rectype, activity_n, record):
+        if rectype == 'Activity':
+            activities.append(activity_n)
+            if len(activities) == crashat:
+                raise KeyboardInterrupt
+        add(rectype, activity_n, record)
+    output.add = crashingadd
+    try:
+        mg.mgexportactivities(mgmockapi(server), output, checkpoint=checkpoint)
+    except KeyboardInterrupt:
+        # the rows written since the last journal line reach the file, but the journal doesn't hear of them
+        output.flush()
+        return
+    checkpoint.close(output, finished=True)
+    output.close()
+
+def mgcsvrows(outdir):
+    with open([os.path.join(outdir, i) for i in os.listdir(outdir) if i.endswith('.csv')][0], 'r', encoding='utf-8') as f:
+        return list(csv.reader(f))
+
+def test_checkpoint_resume_writes_every_row_once(tmp_path):
+    server = MockStravaServer(MockAthlete(60))
+    server.apibase = server.start()
+    try:
+        os.mkdir(str(tmp_path/'once'))
+        mgcheckpointexport(server, str(tmp_path/'once'), False)
+        resumed = str(tmp_path/'resumed')
+        os.mkdir(resumed)
+        mgcheckpointexport(server, resumed, False, crashat=25) # rows of activities 19-24 are past the journal
+        mgcheckpointexport(server, resumed, True, crashat=10)
+        mgcheckpointexport(server, resumed, True)
+        assert not os.path.exists(os.path.join(resumed, 'journal'))
+        assert mgcsvrows(resumed) == mgcsvrows(str(tmp_path/'once'))
+    finally:
+        server.stop()
+
+def mgstoreactivity(store, activity):
+    for rectype, record in mg.mgbundlerecords(activity['id'], (True, None, activity, None, None)):
+        store.add(rectype, activity['id'], record)
+
+def test_sqlite_store_reexport_and_summary_upsert(tmp_path):
+    store = mg.StravaSQLiteStore(str(tmp_path/'store.sqlite'))
+    activity = mgsyntheticactivity(7, random.Random(7))
+    activity['laps'] = activity['laps'][:1] + [dict(activity['laps'][0], id=71)]
+    mgstoreactivity(store, activity)
+    mgstoreactivity(store, mgsyntheticactivity(8, random.Random(8)))
+    assert store.db.execute('SELECT COUNT(*) FROM laps WHERE activity_id=7').fetchone()[0] == 2
+    # the detail exported again (a lap removed on strava): its child rows are replaced, the other activity's kept
+    activity['laps'] = activity['laps'][:1]
+    mgstoreactivity(store, activity)
+    assert store.db.execute('SELECT COUNT(*) FROM laps WHERE activity_id=7').fetchone()[0] == 1
+    assert store.db.execute('SELECT COUNT(*) FROM laps WHERE activity_id=8').fetchone()[0] > 0
+    assert store.db.execute('SELECT COUNT(*) FROM activities').fetchone()[0] == 2
+    # a summary (an incremental listing) updates what it carries and keeps the detail-only columns
+    summary = {key: activity[key] for key in SUMMARYKEYS if key in activity}
+    summary.update(resource_state=2, name='Renamed')
+    store.add('Activity', 7, summary)
+    assert store.db.execute('SELECT name, calories FROM activities WHERE id=7').fetchone() == ('Renamed', activity['calories'])
+    assert store.db.execute('SELECT COUNT(*) FROM laps WHERE activity_id=7').fetchone()[0] == 1
+    # a summary of an activity the store hasn't seen is inserted
+    store.add('Activity', 9, dict(summary, id=9))
+    assert store.db.execute('SELECT name, calories FROM activities WHERE id=9').fetchone() == ('Renamed', None)
+    store.close()
+
+def test_token_store_refreshes_an_expired_token(tmp_path):
+    server = MockStravaServer(MockAthlete(5), tokenlifetime=3600)
+    server.apibase = server.start()
+    try:
+        expired = dict(server.issuetoken(), expires_at=int(time.time()) - 10)
+        tokenstore = mg.StravaTokenStore(str(tmp_path/'tokens.json'), 'id', 'secret', tokenurl=server.tokenurl(),
+                                         seed=expired)
+        assert tokenstore.usable()
+        assert tokenstore.accesstoken != expired['access_token']
+        assert tokenstore.expiresin() > 3000 and server.requests['token'] == 1
+        # the refreshed token is written out for the next run, which starts without a refresh
+        reloaded = mg.StravaTokenStore(str(tmp_path/'tokens.json'), tokenurl=server.tokenurl())
+        assert reloaded.usable() and reloaded.accesstoken == tokenstore.accesstoken
+        assert server.requests['token'] == 1
+    finally:
+        server.stop()
+
+def test_token_store_renews_on_401(tmp_path):
+    server = MockStravaServer(MockAthlete(5), tokenlifetime=3600)
+    server.apibase = server.start()
+    try:
+        tokenstore = mg.StravaTokenStore(str(tmp_path/'tokens.json'), 'id', 'secret', tokenurl=server.tokenurl(),
+                                         seed=server.issuetoken())
+        stravaapi = mgmockapi(server, tokenstore=tokenstore)
+        assert stravaapi.strava_activityrequest(1)[0]
+        # the token revoked on strava before its expiry: the 401 refreshes it and the request is retried
+        stale = tokenstore.accesstoken
+        server.accesstokens[stale] = 0
+        assert stravaapi.strava_activityrequest(2)[0]
+        assert tokenstore.accesstoken != stale
+        assert server.requests['unauthorized'] == 1 and server.requests['token'] == 1
+        # a second thread that got 401 with the same stale token reuses the new one instead of refreshing again
+        assert tokenstore.renew(stale) and server.requests['token'] == 1
+        # without a refresh token the 401 fails the request, no retries
+        stravaapi = mgmockapi(server, tokenstore=mg.StravaTokenStore(str(tmp_path/'none.json'),
+                                                                      seed={'access_token': stale}))
+        assert not stravaapi.strava_activityrequest(3)[0]
+        assert server.requests['unauthorized'] == 2
+    finally:
+        server.stop()
+
+def mgarchiveappend(archive, first, last):
+    for activity_n in range(first, last):
+        archive.append('activity', activity_n, 200, b'{"id": %d, "name": "Run %d"}'%(activity_n, activity_n))
+
+def mgarchivesizes(archive):
+    return os.path.getsize(archive.datafile), os.path.getsize(archive.indexfile)
+
+def test_response_archive_cuts_a_torn_block_on_open(tmp_path):
+    archivedir = str(tmp_path/'archive')
+    archive = mg.StravaResponseArchive(archivedir, blockbytes=200)
+    mgarchiveappend(archive, 0, 20)
+    archive.close()
+    sizes = mgarchivesizes(archive)
+    # a crash after a block was written but before it was indexed
+    with open(archive.datafile, 'ab') as f:
+        f.write(zlib.compress(b'{"id": 20}'))
+    archive = mg.StravaResponseArchive(archivedir, blockbytes=200)
+    assert mgarchivesizes(archive) == sizes
+    mgarchiveappend(archive, 20, 30)
+    archive.close()
+    sizes = mgarchivesizes(archive)
+    # a crash in the middle of an index line: its block goes too
+    with open(archive.datafile, 'ab') as f:
+        f.write(b'\x1f\x8b\x08 partial block')
+    with open(archive.indexfile, 'ab') as f:
+        f.write(b'{"offset": %d, "size": 17, "reco'%sizes[0])
+    archive = mg.StravaResponseArchive(archivedir, blockbytes=200)
+    assert mgarchivesizes(archive) == sizes
+    assert [archive.get('activity', i)['id'] for i in range(30)] == list(range(30))
+    # appends after the cut land where the torn block was and read back after another open
+    mgarchiveappend(archive, 30, 35)
+    archive.close()
+    archive = mg.StravaResponseArchive(archivedir, blockbytes=200)
+    assert [int(key) for endpoint, key, fetched, status, body in archive.records()] == list(range(35))
+    assert archive.get('activity', 34) == {'id': 34, 'name': 'Run 34'}
+    archive.close()